@@ -0,0 +1,113 @@
+"""a download rate limit shared by every transfer of the process
+
+The rate follows conf['bandwidth_schedule'], a list of
+('HH:MM', 'HH:MM', bytes_per_second) windows in local time, and falls
+back to conf['bytes_per_second'] outside of them. The rate is looked up
+on every chunk so a new window applies to transfers already running.
+Downloaders that take a fixed rate get an equal share of it per running
+transfer and are restarted when their share changes.
+"""
+
+import time
+import threading
+from sync_logging import LOG
+
+__SHARED = []
+__SHARED_LOCK = threading.Lock()
+
+
+def parse_clock(clock):
+    """'HH:MM' to minutes since midnight"""
+    hours, minutes = clock.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class Governor(object):
+
+    """Token bucket whose rate follows a time of day schedule"""
+
+    def __init__(self, default_rate, schedule=None):
+        """constructor
+
+        :default_rate: bytes per second outside the schedule, 0 unlimited
+        :schedule: list of ('HH:MM', 'HH:MM', bytes_per_second) windows
+        """
+        self.default_rate = default_rate
+        self.schedule = [(parse_clock(start), parse_clock(end), rate)
+                         for start, end, rate in schedule or ()]
+        self.__tokens = 0.0
+        self.__stamp = time.time()
+        self.__current = None
+        # transfers running at a fixed rate, see share()
+        self.__fixed = 0
+        self.__lock = threading.Lock()
+
+    def rate(self, now=None):
+        """the bytes per second allowed at now, 0 for unlimited"""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                # window wrapping midnight
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.default_rate
+
+    def started(self):
+        """a transfer at a fixed rate started, the shares get smaller"""
+        with self.__lock:
+            self.__fixed += 1
+
+    def finished(self):
+        """a transfer at a fixed rate ended, the shares get larger"""
+        with self.__lock:
+            self.__fixed -= 1
+
+    def share(self):
+        """the rate of each running transfer at a fixed rate, 0 for
+        unlimited
+
+        for downloaders that only take a rate when they start, it changes
+        with the schedule and as transfers start and end
+        """
+        with self.__lock:
+            transfers = self.__fixed
+        return int(self.rate() / max(1, transfers))
+
+    def consume(self, count):
+        """blocks until count more bytes may be transferred"""
+        with self.__lock:
+            now = time.time()
+            rate = self.rate(now)
+            if rate != self.__current:
+                LOG.info('download rate limit is now %d bytes/s', rate)
+                self.__current = rate
+                self.__tokens = min(self.__tokens, rate)
+            if not rate:
+                self.__stamp = now
+                return
+
+            self.__tokens = min(
+                rate, self.__tokens + (now - self.__stamp) * rate)
+            self.__stamp = now
+            self.__tokens -= count
+            wait = -self.__tokens / rate if self.__tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def shared(conf):
+    """the Governor of the process, created on first use
+
+    :conf: configuration object
+    """
+    with __SHARED_LOCK:
+        if not __SHARED:
+            __SHARED.append(Governor(
+                conf.get('bytes_per_second'),
+                conf.get('bandwidth_schedule')))
+        return __SHARED[0]
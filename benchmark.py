@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the sync against a synthetic account served by fake_putio.
+
+Runs the parts of one sync iteration in phases and reports for each the
+wall time, the api calls it made and, for downloads, the throughput:
+    cold crawl    the first crawl with an empty tree cache
+    warm crawl    crawling again without changes on put.io
+    incremental   crawling after --touch files were added
+    download      fetching up to --download files into a temporary dir
+and at the end the peak resident memory of the process.
+
+e.g. a large flat account over a slow link:
+    ./benchmark.py --depth 1 --fanout 200 --files 500 --latency 0.05
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import fake_putio
+import putio_api
+import remote_tree
+import tree_cache
+import tree_crawler
+import download_scheduler
+import zip_bundle
+
+
+def peak_rss():
+    """peak resident memory of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Phase(object):
+
+    """Times a phase and counts the api calls made during it"""
+
+    def __init__(self, name, fake, report):
+        """constructor
+
+        :name: shown in the report
+        :fake: the FakePutio serving the account
+        :report: list the results are appended to
+        """
+        self.name = name
+        self.fake = fake
+        self.report = report
+        self.result = {'phase': name}
+        self.__started = None
+        self.__before = None
+
+    def __enter__(self):
+        """starts the clock"""
+        self.__before = self.fake.stats()
+        self.__started = time.time()
+        return self.result
+
+    def __exit__(self, *exc_info):
+        """stops the clock and records the calls"""
+        self.result['seconds'] = round(time.time() - self.__started, 3)
+        after = self.fake.stats()
+        calls = {}
+        for endpoint, count in after['calls'].iteritems():
+            made = count - self.__before['calls'].get(endpoint, 0)
+            if made:
+                calls[endpoint] = made
+        self.result['calls'] = calls
+        statuses = {}
+        for status, count in after['statuses'].iteritems():
+            made = count - self.__before['statuses'].get(status, 0)
+            if made:
+                statuses[status] = made
+        self.result['statuses'] = statuses
+        self.result['errors'] = after['errors'] - self.__before['errors']
+        self.result['bytes_served'] = \
+            after['bytes_served'] - self.__before['bytes_served']
+        self.report.append(self.result)
+
+
+def crawl(crawler, cache, tree, result):
+    """one crawl and the write of the tree cache, like an iteration"""
+    tree = crawler.crawl(tree)
+    result['changed'] = cache.save(tree)
+    result['items'] = sum(1 for _ in remote_tree.iteritems(tree))
+    return tree
+
+
+def download(conf, tree, count, result):
+    """downloads up to count files of the tree into conf['localdir']"""
+    files = [(abspath, remoteitem)
+             for abspath, remoteitem in remote_tree.iterpaths(tree, '')
+             if not remoteitem.isdir()][:count]
+    files_to_dirs = {}
+    for abspath, remoteitem in files:
+        target = os.path.join(conf.get('localdir'), *abspath.split('/'))
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        files_to_dirs[remoteitem] = target
+    targets = files_to_dirs.values()
+
+    scheduler = download_scheduler.DownloadScheduler(conf)
+    scheduler.start()
+    try:
+        for bundle in zip_bundle.plan(conf, files_to_dirs):
+            scheduler.submit(bundle, bundle.members[0][1])
+        for remoteitem, target in files_to_dirs.iteritems():
+            scheduler.submit(remoteitem, target)
+        jobs = scheduler.join()
+    finally:
+        scheduler.shutdown()
+
+    done = [job for job in jobs if job.state == download_scheduler.JOB_DONE]
+    result['jobs'] = len(jobs)
+    result['files'] = sum(1 for target in targets if os.path.isfile(target))
+    result['failed'] = len(jobs) - len(done)
+    result['bytes'] = sum(job.remoteitem.size for job in done)
+
+
+def run(args):
+    """runs every phase, returns the report"""
+    account, fake = fake_putio.from_args(args)
+    putio_api.CLIENT = putio_api.ApiClient(fake.start())
+    workdir = tempfile.mkdtemp(prefix='putiosync-bench-')
+    conf = dict(oauthtoken='fake',
+                parallel_downloads=args.parallel_downloads,
+                url_prefetch=args.parallel_downloads * 2,
+                downloader=args.downloader,
+                conn_per_downloads=args.connections,
+                max_connections=args.max_connections,
+                adaptive_connections=not args.fixed_connections,
+                crawl_concurrency=args.crawl_concurrency,
+                localdir=os.path.join(workdir, 'mirror'),
+                download_order='fifo',
+                bundle_max_file_size=args.bundle_size,
+                bundle_min_files=args.bundle_min_files,
+                bundle_max_files=args.bundle_max_files,
+                folder_priorities={},
+                bytes_per_second=0,
+                bandwidth_schedule=[])
+    os.makedirs(conf.get('localdir'))
+    cache = tree_cache.TreeCache(os.path.join(workdir, 'tree.sqlite'))
+    cache.open()
+    report = [{'phase': 'account',
+               'items': len(account.items),
+               'bytes': account.used()}]
+    try:
+        crawler = tree_crawler.TreeCrawler(conf)
+        with Phase('cold crawl', fake, report) as result:
+            tree = crawl(crawler, cache, {}, result)
+        with Phase('warm crawl', fake, report) as result:
+            tree = crawl(crawler, cache, tree, result)
+        account.touch(args.touch)
+        with Phase('incremental', fake, report) as result:
+            tree = crawl(crawler, cache, tree, result)
+        if args.download:
+            with Phase('download', fake, report) as result:
+                download(conf, tree, args.download, result)
+            result['bytes_per_second'] = \
+                int(result['bytes'] / max(result['seconds'], 0.001))
+    finally:
+        cache.close()
+        # idle keep-alive connections would outlive the server
+        putio_api.CLIENT.pool.close()
+        fake.stop()
+        shutil.rmtree(workdir, True)
+
+    report.append({'phase': 'process', 'peak_rss': peak_rss()})
+    return report
+
+
+def __print_report(report):
+    """prints a report for humans"""
+    for result in report:
+        result = dict(result)
+        print '%-12s' % result.pop('phase'),
+        calls = result.pop('calls', None)
+        statuses = result.pop('statuses', None)
+        print ' '.join('%s=%s' % item for item in sorted(result.items()))
+        if calls:
+            print '%-12s' % '', ' '.join(
+                '%s=%d' % item for item in sorted(calls.items()))
+        if statuses:
+            print '%-12s' % '', ' '.join(
+                'http %d=%d' % item for item in sorted(statuses.items()))
+
+
+def argument_parser():
+    """the options of the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    fake_putio.add_account_args(parser)
+    parser.add_argument('--touch', type=int, default=10,
+                        help='files added before the incremental crawl')
+    parser.add_argument('--download', type=int, default=20,
+                        help='how many files to download, 0 to skip')
+    parser.add_argument('--downloader', default='native',
+                        choices=('native', 'axel'))
+    parser.add_argument('--parallel-downloads', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=4,
+                        help='the most connections of one download')
+    parser.add_argument('--max-connections', type=int, default=16,
+                        help='the most connections of all downloads')
+    parser.add_argument('--fixed-connections', action='store_true',
+                        help='dont adapt the connections to the host')
+    parser.add_argument('--crawl-concurrency', type=int, default=4)
+    parser.add_argument('--bundle-size', type=int, default=0,
+                        help='fetch files up to this size as zips, '
+                        '0 to download every file alone')
+    parser.add_argument('--bundle-min-files', type=int, default=5)
+    parser.add_argument('--bundle-max-files', type=int, default=200)
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    return parser
+
+
+def __readargs():
+    """parses the options and runs the benchmark"""
+    args = argument_parser().parse_args()
+    report = run(args)
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        __print_report(report)
+
+
+if __name__ == '__main__':
+    __readargs()
@@ -0,0 +1,178 @@
+"""crc32 helpers to check mirrored files against the put.io listing"""
+
+import zlib
+import threading
+import Queue
+from sync_logging import LOG
+
+READ_CHUNK_SIZE = 1024 * 1024
+# reflected polynomial of crc32 as used by zlib
+__POLYNOMIAL = 0xedb88320
+# block length -> operators appending 1, 2, 4... blocks of zero bytes,
+# filled in once per length
+__REPEAT_OPERATORS = {}
+
+
+def update(crc, data):
+    """folds data into a running crc32"""
+    return zlib.crc32(data, crc) & 0xffffffff
+
+
+def matches(crc, expected):
+    """compares a crc32 to the hex string put.io returns
+
+    :returns: True if they are equal or nothing is expected
+    """
+    if not expected:
+        return True
+    return crc == int(expected, 16)
+
+
+def file_crc32(path):
+    """crc32 of a file read in chunks, in constant memory"""
+    crc = 0
+    with open(path, 'rb') as binfile:
+        while True:
+            chunk = binfile.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = update(crc, chunk)
+
+
+def __gf2_times(matrix, vector):
+    """multiplies a 32x32 gf(2) matrix by a vector"""
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def __gf2_square(matrix):
+    """squares a 32x32 gf(2) matrix"""
+    return [__gf2_times(matrix, matrix[row]) for row in range(32)]
+
+
+def combine(crc1, crc2, length2):
+    """crc32 of two concatenated blocks, from the crc32 of each block
+
+    port of zlib's crc32_combine, which python 2 doesn't expose
+
+    :crc1: crc32 of the first block
+    :crc2: crc32 of the second block
+    :length2: length of the second block in bytes
+    """
+    if length2 <= 0:
+        return crc1
+
+    # operator for one zero bit, then two and four zero bits
+    odd = [__POLYNOMIAL] + [1 << row for row in range(31)]
+    even = __gf2_square(odd)
+    odd = __gf2_square(even)
+
+    # apply length2 zero bytes to crc1
+    while True:
+        even = __gf2_square(odd)
+        if length2 & 1:
+            crc1 = __gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+        odd = __gf2_square(even)
+        if length2 & 1:
+            crc1 = __gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+    return crc1 ^ crc2
+
+
+def __zeros_operator(length):
+    """the gf(2) matrix that appends length zero bytes to a crc32"""
+    # operator for one zero bit, squared three times for one zero byte
+    power = [__POLYNOMIAL] + [1 << row for row in range(31)]
+    for _ in range(3):
+        power = __gf2_square(power)
+
+    operator = None
+    while length:
+        if length & 1:
+            operator = power if operator is None else \
+                [__gf2_times(power, operator[row]) for row in range(32)]
+        length >>= 1
+        if length:
+            power = __gf2_square(power)
+    return operator
+
+
+def repeated(crc, block_crc, length, count):
+    """crc32 after appending count copies of a block to crc
+
+    takes log2(count) steps rather than count * length bytes
+
+    :crc: crc32 of the data before the copies, 0 if none
+    :block_crc: crc32 of the block
+    :length: length of the block in bytes
+    :count: how many copies are appended
+    """
+    if count <= 0 or length <= 0:
+        return crc
+
+    operators = __REPEAT_OPERATORS.get(length)
+    if operators is None:
+        operators = [__zeros_operator(length)]
+        while len(operators) < 64:
+            operators.append(__gf2_square(operators[-1]))
+        operators = __REPEAT_OPERATORS.setdefault(length, operators)
+
+    part = block_crc
+    for operator in operators:
+        # part is the crc32 of a run of copies, the operator appends as
+        # many zero bytes as the run is long
+        if count & 1:
+            crc = __gf2_times(operator, crc) ^ part
+        count >>= 1
+        if not count:
+            return crc
+        part = __gf2_times(operator, part) ^ part
+    raise ValueError('cant repeat a block %d times' % count)
+
+
+def verify_files(files, workers):
+    """checks files on disk against their expected crc32 on a thread pool
+
+    :files: list of (path, expected crc32 hex) tuples
+    :workers: how many files are read at the same time
+    :returns: the paths whose crc32 doesn't match
+    """
+    pending = Queue.Queue()
+    for item in files:
+        pending.put(item)
+    mismatched = []
+
+    def work():
+        """checks files until the queue is empty"""
+        while True:
+            try:
+                path, expected = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if not matches(file_crc32(path), expected):
+                    LOG.warn('crc32 mismatch: %s', path)
+                    mismatched.append(path)
+            except (IOError, OSError):
+                LOG.error('cant verify %s', path, exc_info=True)
+
+    threads = [threading.Thread(target=work) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return mismatched
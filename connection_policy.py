@@ -0,0 +1,187 @@
+"""how many connections each download opens
+
+A small file gets one connection, a large one up to one per
+MIN_BYTES_PER_CONNECTION, but never more than the level learned for its
+cdn host. The level climbs while large transfers from the host get
+faster with more connections, turns around when they get slower, and is
+halved when a transfer fails, which is how a cdn that rate limits shows.
+The connections of all running downloads never exceed
+conf['max_connections'], a download waits for some to be free.
+"""
+
+import threading
+import time
+from urlparse import urlsplit
+from sync_logging import LOG
+import metrics
+
+# a transfer isn't split into connections smaller than this
+MIN_BYTES_PER_CONNECTION = 4 * 1024 * 1024
+# only transfers this large say something about the host, the rate of
+# smaller ones is mostly latency
+ADAPT_MIN_BYTES = 16 * 1024 * 1024
+# a rate within this share of the last is no change
+RATE_TOLERANCE = 0.1
+# weight of the newest transfer in the rate of a host
+RATE_WEIGHT = 0.5
+# how often a waiting download looks for free connections
+WAIT_SECONDS = 1
+
+__SHARED = []
+__SHARED_LOCK = threading.Lock()
+
+
+class HostState(object):
+
+    """What was learned about the transfers from a cdn host"""
+
+    __slots__ = ('level', 'rate', 'direction')
+
+    def __init__(self, level):
+        """constructor
+
+        :level: the connections of the next large transfer
+        """
+        self.level = level
+        # bytes per second of the large transfers at about this level
+        self.rate = None
+        # +1 while adding connections helps, -1 while removing them does
+        self.direction = 1
+
+
+class Grant(object):
+
+    """The connections given to one transfer"""
+
+    __slots__ = ('host', 'count', 'started', 'adapt')
+
+    def __init__(self, host, count, adapt):
+        """constructor"""
+        self.host = host
+        self.count = count
+        self.started = time.time()
+        self.adapt = adapt
+
+
+class ConnectionPolicy(object):
+
+    """Picks and caps the connection count of every transfer"""
+
+    def __init__(self, maximum, total, adaptive=True):
+        """constructor
+
+        :maximum: the most connections of one transfer
+        :total: the most connections of every transfer together,
+            0 for no cap
+        :adaptive: learn the level of each host, else every large
+            transfer uses maximum
+        """
+        self.maximum = max(1, maximum or 1)
+        self.total = total or 0
+        self.adaptive = adaptive
+        self.hosts = {}
+        self.open = 0
+        self.__cond = threading.Condition()
+
+    def wanted(self, host, filesize):
+        """the connections a transfer of filesize from host should use"""
+        count = min(self.maximum,
+                    max(1, filesize // MIN_BYTES_PER_CONNECTION))
+        if self.adaptive:
+            with self.__cond:
+                state = self.__state(host)
+                count = min(count, state.level)
+        return count
+
+    def acquire(self, url, filesize, stop=None):
+        """waits until connections are free for a transfer
+
+        :url: where the file is fetched from
+        :filesize: bytes the transfer fetches
+        :stop: optional threading.Event that ends the wait
+        :returns: the Grant to release(), None if stopped
+        """
+        host = urlsplit(url).netloc
+        wanted = self.wanted(host, filesize)
+        with self.__cond:
+            while self.total and self.open >= self.total:
+                if stop and stop.is_set():
+                    return None
+                self.__cond.wait(WAIT_SECONDS)
+            count = wanted
+            if self.total:
+                count = min(count, self.total - self.open)
+            self.open += count
+            metrics.CONNECTIONS_OPEN.set(self.open)
+        LOG.debug('%d connections for %d bytes from %s', count, filesize,
+                  host)
+        # a transfer cut short by the cap doesn't say much about the host
+        return Grant(host, count, count == wanted and
+                     filesize >= ADAPT_MIN_BYTES)
+
+    def release(self, grant, transferred, succeeded):
+        """frees the connections of a transfer and learns from it
+
+        :grant: returned by acquire()
+        :transferred: bytes fetched
+        :succeeded: True if the transfer completed, False if it failed,
+            None if it says nothing about the host (stopped, url expired)
+        """
+        seconds = max(time.time() - grant.started, 0.001)
+        with self.__cond:
+            self.open -= grant.count
+            metrics.CONNECTIONS_OPEN.set(self.open)
+            self.__cond.notify_all()
+            if not self.adaptive or succeeded is None:
+                return
+            state = self.__state(grant.host)
+            if succeeded is False:
+                state.level = max(1, state.level // 2)
+                state.rate = None
+                state.direction = 1
+                LOG.info('transfer from %s failed, %d connections from now',
+                         grant.host, state.level)
+            elif grant.adapt and transferred >= ADAPT_MIN_BYTES:
+                self.__climb(grant.host, state, transferred / seconds)
+            metrics.HOST_CONNECTIONS.labels(grant.host).set(state.level)
+
+    def __state(self, host):
+        """the HostState of a host, the lock must be held"""
+        state = self.hosts.get(host)
+        if state is None:
+            # starts in the middle so both directions are tried
+            state = self.hosts[host] = HostState(
+                max(1, (self.maximum + 1) // 2))
+            metrics.HOST_CONNECTIONS.labels(host).set(state.level)
+        return state
+
+    def __climb(self, host, state, rate):
+        """moves the level of a host one step towards its best rate"""
+        if state.rate is not None:
+            if rate < state.rate * (1 - RATE_TOLERANCE):
+                state.direction = -state.direction
+            elif rate <= state.rate * (1 + RATE_TOLERANCE):
+                # no better and no worse, the level is right
+                state.rate += RATE_WEIGHT * (rate - state.rate)
+                return
+        state.rate = rate if state.rate is None \
+            else state.rate + RATE_WEIGHT * (rate - state.rate)
+        level = min(self.maximum, max(1, state.level + state.direction))
+        if level != state.level:
+            LOG.info('%d connections from %s at %d bytes/s, trying %d',
+                     state.level, host, rate, level)
+        state.level = level
+
+
+def shared(conf):
+    """the ConnectionPolicy of the process, created on first use
+
+    :conf: configuration object
+    """
+    with __SHARED_LOCK:
+        if not __SHARED:
+            __SHARED.append(ConnectionPolicy(
+                conf.get('conn_per_downloads'),
+                conf.get('max_connections'),
+                conf.get('adaptive_connections', True)))
+        return __SHARED[0]
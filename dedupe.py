@@ -0,0 +1,223 @@
+"""gives a queued file the content of an identical file already mirrored
+
+put.io lists the size and crc32 of every file, two files with the same
+pair are taken to be copies. A queued file whose copy is in the mirror
+is linked to it instead of downloaded, by conf['dedupe']:
+'hardlink' - both names share the blocks, falls back to reflink
+'reflink'  - copy on write clone (btrfs, xfs), falls back to copy
+'copy'     - a plain local copy
+The copy in the mirror is checked against the size and crc32 before it
+is used, a file changed or cut short locally is never spread.
+
+The index keeps a hash of (size, crc32) and the id of every file in two
+sorted arrays, a few bytes per file next to the tree it was built from.
+"""
+
+import os
+import bisect
+import fcntl
+import shutil
+from array import array
+from sync_logging import LOG
+import checksum
+import remote_tree
+import ranged_download
+import disk_space
+
+MODES = ('hardlink', 'reflink', 'copy')
+# linux ioctl cloning a whole file, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def content_key(remoteitem):
+    """the hash files with the same content share, None if unknown"""
+    if remoteitem.isdir() or not remoteitem.size or not remoteitem.crc32:
+        return None
+    return hash((remoteitem.size, remoteitem.crc32.lower()))
+
+
+class ContentIndex(object):
+
+    """Finds the mirrored copies of a file by its size and crc32"""
+
+    def __init__(self, localdir, tree, locations):
+        """constructor
+
+        :localdir: the mirror root
+        :tree: the remote tree whose files are mirrored
+        :locations: remote_tree.locations() of tree
+        """
+        self.localdir = localdir
+        self.locations = locations
+        pairs = sorted((key, remoteitem.itemid)
+                       for key, remoteitem in
+                       ((content_key(item), item)
+                        for item in remote_tree.iteritems(tree))
+                       if key is not None)
+        self.keys = array('l', (key for key, _ in pairs))
+        self.itemids = array('l', (itemid for _, itemid in pairs))
+        # path -> did it match the listing
+        self.checked = {}
+
+    def __len__(self):
+        """how many files are indexed"""
+        return len(self.keys)
+
+    def source(self, remoteitem, skip=()):
+        """a mirrored file with the content of remoteitem
+
+        :skip: paths not to use, e.g. files still downloading
+        :returns: its path, None if there is no intact copy
+        """
+        key = content_key(remoteitem)
+        if key is None:
+            return None
+        start = bisect.bisect_left(self.keys, key)
+        for position in xrange(start, len(self.keys)):
+            if self.keys[position] != key:
+                break
+            itemid = self.itemids[position]
+            if itemid == remoteitem.itemid:
+                continue
+            relpath = remote_tree.relpath(self.locations, itemid)
+            if not relpath:
+                continue
+            path = os.path.join(self.localdir, relpath)
+            if path not in skip and self.__intact(path, remoteitem):
+                return path
+        return None
+
+    def __intact(self, path, remoteitem):
+        """does the file at path have the size and crc32 of remoteitem"""
+        intact = self.checked.get(path)
+        if intact is None:
+            intact = os.path.isfile(path) and \
+                os.path.getsize(path) == remoteitem.size and \
+                checksum.matches(checksum.file_crc32(path),
+                                 remoteitem.crc32)
+            self.checked[path] = intact
+            if not intact:
+                LOG.debug('%s doesnt match put.io, not linking it', path)
+        return intact
+
+
+def link(conf, source, target):
+    """gives target the content of source
+
+    :conf: configuration object
+    :source: an intact mirrored file
+    :target: where the copy goes, an older file there is replaced
+    :returns: True if target has the content
+    """
+    mode = conf.get('dedupe')
+    temp = target + ranged_download.PART_SUFFIX
+    attempts = MODES[MODES.index(mode):] if mode in MODES else ('copy',)
+    for attempt in attempts:
+        try:
+            if os.path.lexists(temp):
+                os.remove(temp)
+            if attempt == 'hardlink':
+                os.link(source, temp)
+            elif attempt == 'reflink':
+                __reflink(source, temp)
+            else:
+                __copy(conf, source, temp)
+            replaced = disk_space.tree_size(target)
+            os.rename(temp, target)
+        except (IOError, OSError) as error:
+            LOG.info('cant %s %s to %s: %s', attempt, source, target, error)
+            continue
+
+        if attempt != 'copy':
+            # a copy was counted by its reservation. a hard link shares
+            # the blocks of source, a clone is counted in full like
+            # tree_size() does
+            disk_space.shared(conf).added(
+                0 if attempt == 'hardlink' else os.path.getsize(target),
+                replaced)
+
+        print '\n [!] Linked %s to its copy %s' % (target, source)
+        LOG.info('%s %s to its copy %s', attempt, target, source)
+        return True
+
+    if os.path.lexists(temp):
+        os.remove(temp)
+    return False
+
+
+def __reflink(source, temp):
+    """clones source into temp sharing its blocks"""
+    with open(source, 'rb') as src:
+        with open(temp, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def __copy(conf, source, temp):
+    """copies source into temp within the space of the mirror"""
+    ledger = disk_space.shared(conf)
+    size = os.path.getsize(source)
+    reservation = ledger.reserve(size, temp[:-len(
+        ranged_download.PART_SUFFIX)], temp)
+    copied = False
+    try:
+        shutil.copyfile(source, temp)
+        copied = True
+    finally:
+        ledger.release(reservation, copied)
+
+
+def deduplicate(conf, content, files_to_dirs, downloading):
+    """links the queued files whose content is already mirrored
+
+    :conf: configuration object
+    :content: ContentIndex of the mirror
+    :files_to_dirs: dict of remoteitem -> target of the queued files, the
+        linked and deferred ones are removed from it
+    :downloading: dict of remoteitem -> target of the files downloading
+    :returns: list of (remoteitem, target, source) to link once the
+        download of source finished, see link_deferred()
+    """
+    if not conf.get('dedupe'):
+        return []
+
+    busy = set(downloading.itervalues())
+    busy.update(files_to_dirs.itervalues())
+    # key -> the first file of that content to be downloaded
+    fetching = {}
+    for remoteitem, target in downloading.iteritems():
+        fetching.setdefault(content_key(remoteitem), target)
+
+    deferred = []
+    for remoteitem, target in sorted(files_to_dirs.items(),
+                                     key=lambda item: item[0].itemid):
+        key = content_key(remoteitem)
+        if key is None:
+            continue
+        source = content.source(remoteitem, busy)
+        if source and link(conf, source, target):
+            del files_to_dirs[remoteitem]
+        elif key in fetching:
+            deferred.append((remoteitem, target, fetching[key]))
+            del files_to_dirs[remoteitem]
+        else:
+            fetching[key] = target
+
+    if deferred:
+        LOG.info('%d files wait for the download of a copy', len(deferred))
+    return deferred
+
+
+def link_deferred(conf, deferred):
+    """links the files deferred by deduplicate() to their downloaded copy
+
+    a file whose copy failed is queued again by the next iteration
+
+    :returns: how many were linked
+    """
+    linked = 0
+    for remoteitem, target, source in deferred:
+        if os.path.isfile(source) and \
+                os.path.getsize(source) == remoteitem.size and \
+                link(conf, source, target):
+            linked += 1
+    return linked
@@ -0,0 +1,251 @@
+"""keeps track of the space the mirror uses and the downloads will need
+
+Every running download reserves the bytes it has yet to write on the
+filesystem of the mirror, so parallel downloads don't each count the same
+free space. The size of the mirror is measured once and then kept up to
+date as files are downloaded and deleted.
+"""
+
+import os
+import threading
+import time
+from sync_logging import LOG
+import local_index
+import ranged_download
+import metrics
+
+# share of the mirror filesystem that is always left free
+RESERVED_SHARE = 0.1
+# how long a download waits before looking for free space again
+SPACE_WAIT_SECONDS = 60
+
+__SHARED = []
+__SHARED_LOCK = threading.Lock()
+
+
+def allocated(path):
+    """bytes the file at path occupies on disk, 0 if it doesn't exist
+
+    counts blocks rather than the length so preallocated sparse part
+    files only count what was written
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(info, 'st_blocks', None)
+    if blocks is None:
+        return info.st_size
+    return min(info.st_size, blocks * 512)
+
+
+def tree_size(path):
+    """total size of the complete files at or below path
+
+    part files of unfinished downloads are left out, the reservation of
+    their download accounts for them. The trash is counted, its files
+    take the space until they are purged. Hard linked files are counted
+    once, a single file only if it has no other link
+    """
+    if not os.path.isdir(path):
+        name = os.path.basename(path)
+        if ranged_download.partial_target(name) is not None or \
+                not os.path.isfile(path):
+            return 0
+        info = os.stat(path)
+        return info.st_size if info.st_nlink == 1 else 0
+
+    total = 0
+    inodes = set()
+    pending = [path]
+    while pending:
+        parent = pending.pop()
+        try:
+            entries = local_index.scan(parent)
+        except OSError:
+            LOG.debug('cant list %s', parent, exc_info=True)
+            continue
+        for name, entry in entries.iteritems():
+            if entry.isdir:
+                pending.append(os.path.join(parent, name))
+            elif entry.size > 0 and \
+                    ranged_download.partial_target(name) is None:
+                if entry.inode is not None:
+                    if entry.inode in inodes:
+                        continue
+                    inodes.add(entry.inode)
+                total += entry.size
+    return total
+
+
+class Reservation(object):
+
+    """The space set aside for one download"""
+
+    __slots__ = ('filesize', 'writepath', 'replaced')
+
+    def __init__(self, filesize, writepath, replaced):
+        """constructor
+
+        :filesize: size of the file once downloaded
+        :writepath: the file the download writes into
+        :replaced: size of the file the download replaces
+        """
+        self.filesize = filesize
+        self.writepath = writepath
+        self.replaced = replaced
+
+    def outstanding(self):
+        """bytes reserved but not written yet"""
+        return max(0, self.filesize - allocated(self.writepath))
+
+
+class SpaceLedger(object):
+
+    """Free space of the mirror filesystem minus what downloads reserved"""
+
+    def __init__(self, localdir):
+        """constructor
+
+        :localdir: the mirror root, it may not exist yet
+        """
+        self.localdir = localdir
+        # the Trash emptied when a download waits for space, set by
+        # trash.shared()
+        self.trashcan = None
+        self.__mirror_bytes = None
+        self.__reservations = []
+        self.__lock = threading.Lock()
+
+    def __statvfs(self):
+        """statvfs of the filesystem that holds the mirror"""
+        path = os.path.abspath(self.localdir)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return os.statvfs(path)
+
+    def free_space(self):
+        """free bytes on the mirror filesystem"""
+        stat = self.__statvfs()
+        return stat.f_bavail * stat.f_frsize
+
+    def disk_size(self):
+        """total bytes of the mirror filesystem"""
+        stat = self.__statvfs()
+        return stat.f_blocks * stat.f_frsize
+
+    def min_space_to_reserve(self):
+        """bytes always left free on the mirror filesystem"""
+        return self.disk_size() * RESERVED_SHARE
+
+    def outstanding(self):
+        """bytes the running downloads have yet to write"""
+        with self.__lock:
+            return self.__outstanding()
+
+    def __outstanding(self):
+        """outstanding(), the lock must be held"""
+        return sum(reservation.outstanding()
+                   for reservation in self.__reservations)
+
+    def available(self):
+        """free bytes not promised to a running download"""
+        return self.free_space() - self.min_space_to_reserve() - \
+            self.outstanding()
+
+    def mirror_size(self):
+        """size of the mirrored files, measured on first use"""
+        if self.__mirror_bytes is None:
+            LOG.info('measuring the size of the mirror %s', self.localdir)
+            measured = tree_size(self.localdir)
+            with self.__lock:
+                if self.__mirror_bytes is None:
+                    self.__mirror_bytes = measured
+            LOG.info('the mirror holds %d bytes', self.__mirror_bytes)
+        return self.__mirror_bytes
+
+    def removing(self, path):
+        """records that path is about to be deleted from the mirror"""
+        if self.__mirror_bytes is None:
+            return
+        size = tree_size(path)
+        with self.__lock:
+            self.__mirror_bytes = max(0, self.__mirror_bytes - size)
+
+    def freed(self, size):
+        """records bytes deleted from the mirror, e.g. by the trash purge"""
+        with self.__lock:
+            if self.__mirror_bytes is not None:
+                self.__mirror_bytes = max(0, self.__mirror_bytes - size)
+
+    def added(self, size, replaced):
+        """records a file put into the mirror without a download
+
+        :size: bytes it takes on disk, 0 for a hard link
+        :replaced: bytes freed by the file it replaced
+        """
+        with self.__lock:
+            if self.__mirror_bytes is not None:
+                self.__mirror_bytes = max(
+                    0, self.__mirror_bytes + size - replaced)
+
+    def reserve(self, filesize, targetfile, writepath, stop=None):
+        """waits until the filesystem can take a download, then reserves
+        the space for it
+
+        :filesize: size of the file to download
+        :targetfile: where the file will be
+        :writepath: the file the download writes into, bytes already in
+            it from an earlier attempt are not reserved again
+        :stop: optional threading.Event that ends the wait
+        :returns: the Reservation to release(), None if stopped
+        """
+        # an older copy, or the start of the file an interrupted download
+        # left behind, is already counted in the mirror size
+        replaced = 0
+        if os.path.isfile(targetfile):
+            replaced = os.path.getsize(targetfile)
+        reservation = Reservation(filesize, writepath, replaced)
+        wait = stop.wait if stop else time.sleep
+        while True:
+            with self.__lock:
+                available = self.free_space() - \
+                    self.min_space_to_reserve() - self.__outstanding()
+                if available >= reservation.outstanding():
+                    self.__reservations.append(reservation)
+                    return reservation
+
+            print '\n[!] Suspending download: not enough free space for:' \
+                '\n %s' % targetfile
+            LOG.warn('not enough free space to download %s, need %d '
+                     'bytes, %d available', targetfile,
+                     reservation.outstanding(), available)
+            metrics.SPACE_SUSPENSIONS.labels('download').inc()
+            if self.trashcan:
+                self.trashcan.empty()
+            wait(SPACE_WAIT_SECONDS)
+            if stop and stop.is_set():
+                return None
+
+    def release(self, reservation, completed):
+        """ends a reservation
+
+        :reservation: returned by reserve()
+        :completed: True if the file was downloaded into the mirror
+        """
+        with self.__lock:
+            self.__reservations.remove(reservation)
+            if completed and self.__mirror_bytes is not None:
+                self.__mirror_bytes += \
+                    reservation.filesize - reservation.replaced
+
+
+def shared(conf):
+    """the SpaceLedger of the process, created on first use
+
+    :conf: configuration object
+    """
+    with __SHARED_LOCK:
+        if not __SHARED:
+            __SHARED.append(SpaceLedger(conf.get('localdir')))
+        return __SHARED[0]
@@ -0,0 +1,144 @@
+"""the order in which queued downloads are started
+
+Jobs are ordered by conf['download_order']:
+'fifo'     - in the order the sync found them
+'smallest' - smallest file first, the most files per hour
+'newest'   - most recently added to put.io first (put.io ids only grow)
+'fair'     - one file of each top level folder in turn, so a folder full
+             of large files doesn't hold back the others
+
+conf['folder_priorities'] maps folders relative to the mirror root, like
+'movies' or 'tv/current', to a priority. Jobs below a folder with a
+higher priority start before any other, the policy orders jobs of equal
+priority. Both can be changed while jobs are queued, see reorder().
+"""
+
+import heapq
+import os
+import threading
+import Queue
+import time
+from sync_logging import LOG
+
+POLICIES = ('fifo', 'smallest', 'newest', 'fair')
+
+
+class DownloadQueue(object):
+
+    """Thread safe priority queue of DownloadJobs, Queue.Queue alike"""
+
+    def __init__(self, conf):
+        """constructor
+
+        :conf: configuration object
+        """
+        self.root = conf.get('localdir')
+        self.policy = 'fifo'
+        self.priorities = {}
+        self.__heap = []
+        self.__seq = 0
+        # fair share state: the round of the last started job and the
+        # last round given to each top level folder
+        self.__vtime = 0
+        self.__rounds = {}
+        self.__lock = threading.Condition()
+        self.reorder(conf.get('download_order') or 'fifo',
+                     conf.get('folder_priorities') or {})
+
+    def __len__(self):
+        """how many jobs are queued"""
+        with self.__lock:
+            return len(self.__heap)
+
+    def put(self, job):
+        """queues a job"""
+        with self.__lock:
+            self.__seq += 1
+            entry = [None, self.__seq, job]
+            entry[0] = self.__key(entry)
+            heapq.heappush(self.__heap, entry)
+            self.__lock.notify()
+
+    def get(self, timeout=None):
+        """takes the first job, waits up to timeout seconds for one
+
+        :raises: Queue.Empty if no job was queued in time
+        """
+        with self.__lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.__heap:
+                remaining = None if deadline is None \
+                    else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Queue.Empty
+                self.__lock.wait(remaining)
+            entry = heapq.heappop(self.__heap)
+            if self.policy == 'fair':
+                self.__vtime = entry[0][1]
+            return entry[2]
+
+    def get_nowait(self):
+        """takes the first job without waiting
+
+        :raises: Queue.Empty if there is none
+        """
+        return self.get(0)
+
+    def reorder(self, policy=None, priorities=None):
+        """changes the order of the queued and the future jobs
+
+        :policy: one of POLICIES, None keeps the current one
+        :priorities: dict of folder -> priority, None keeps the current one
+        :raises: ValueError for an unknown policy
+        """
+        if policy is not None and policy not in POLICIES:
+            raise ValueError('unknown download order %s, use one of %s' % (
+                policy, ', '.join(POLICIES)))
+
+        with self.__lock:
+            if policy is not None:
+                self.policy = policy
+            if priorities is not None:
+                self.priorities = dict(
+                    (folder.strip('/'), priority)
+                    for folder, priority in priorities.iteritems())
+
+            # fair rounds are handed out again in the order jobs were found
+            entries = sorted(self.__heap, key=lambda entry: entry[1])
+            self.__vtime = 0
+            self.__rounds = {}
+            for entry in entries:
+                entry[0] = self.__key(entry)
+            heapq.heapify(entries)
+            self.__heap = entries
+        LOG.info('download order is %s, folder priorities %s',
+                 self.policy, self.priorities)
+
+    def __relpath(self, job):
+        """the folders of the target of a job relative to the mirror root"""
+        relpath = os.path.relpath(job.targetfile, self.root)
+        return relpath.split(os.sep)[:-1]
+
+    def __priority(self, folders):
+        """the priority of the deepest configured folder above a job"""
+        for depth in range(len(folders), 0, -1):
+            priority = self.priorities.get('/'.join(folders[:depth]))
+            if priority is not None:
+                return priority
+        return 0
+
+    def __key(self, entry):
+        """the sort key of a heap entry, lowest first"""
+        _, seq, job = entry
+        folders = self.__relpath(job)
+        priority = -self.__priority(folders)
+        if self.policy == 'smallest':
+            return (priority, job.remoteitem.size, seq)
+        if self.policy == 'newest':
+            return (priority, -job.remoteitem.itemid, seq)
+        if self.policy == 'fair':
+            top = folders[0] if folders else ''
+            rounds = max(self.__vtime, self.__rounds.get(top, 0)) + 1
+            self.__rounds[top] = rounds
+            return (priority, rounds, seq)
+        return (priority, seq)
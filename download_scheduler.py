@@ -0,0 +1,277 @@
+"""a bounded pool of workers that runs the downloads queued by the sync
+
+Download urls are resolved by a separate stage a few jobs ahead of the
+workers, so a worker finishing a transfer finds the next url ready. A url
+older than URL_MAX_AGE_SECONDS, or one the server answered 403/410 for,
+is resolved again before the transfer (re)starts. Jobs waiting for a url
+are kept in a DownloadQueue which decides which one starts next.
+
+A job can fetch a zip_bundle.Bundle of small files instead of a single
+file, the files the zip didn't deliver are then queued one by one.
+"""
+
+import threading
+import Queue
+import time
+from sync_logging import LOG
+import putio_api
+import sync_utils
+import ranged_download
+import download_queue
+import metrics
+import disk_space
+import zip_bundle
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+# how often the waiting thread wakes up so it stays interruptible
+JOIN_POLL_SECONDS = 0.5
+# signed download urls are resolved again when older than this
+URL_MAX_AGE_SECONDS = 10 * 60
+# how often an expired url is resolved again for the same job
+URL_ATTEMPTS = 3
+
+
+class DownloadJob(object):
+
+    """A single file transfer and its state"""
+
+    def __init__(self, remoteitem, targetfile):
+        """constructor"""
+        self.remoteitem = remoteitem
+        self.targetfile = targetfile
+        self.state = JOB_QUEUED
+        self.download_url = None
+        self.resolved_at = 0
+        self.started_at = None
+
+    def __str__(self):
+        """tostring"""
+        return "DownloadJob(%s -> '%s', state=%s)" % (
+            self.remoteitem, self.targetfile, self.state)
+
+
+class DownloadScheduler(object):
+
+    """Runs queued downloads on conf['parallel_downloads'] worker threads"""
+
+    def __init__(self, conf):
+        """constructor
+
+        :conf: configuration object
+        """
+        self.conf = conf
+        self.workers = max(1, int(conf.get('parallel_downloads') or 1))
+        self.prefetch = max(1, int(conf.get('url_prefetch') or 1))
+        self.jobs = []
+        self.__unresolved = download_queue.DownloadQueue(conf)
+        self.__ready = Queue.Queue(self.prefetch)
+        self.__pending = 0
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__lock = threading.Condition()
+
+    def start(self):
+        """spawns the url resolver and the worker threads"""
+        LOG.info('starting %d download workers', self.workers)
+        threads = [('resolve', self.__resolve_loop)]
+        threads += [('download-%d' % num, self.__work)
+                    for num in range(self.workers)]
+        for name, target in threads:
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, remoteitem, targetfile):
+        """queues a file for download
+
+        :remoteitem: the RemoteItem or zip_bundle.Bundle to download
+        :targetfile: local path the file is written to, for a bundle the
+            path of one of its files
+        :returns: the queued DownloadJob
+        """
+        job = DownloadJob(remoteitem, targetfile)
+        with self.__lock:
+            self.jobs.append(job)
+            self.__pending += 1
+            metrics.DOWNLOAD_JOBS_PENDING.set(self.__pending)
+        self.__unresolved.put(job)
+        return job
+
+    def running(self):
+        """progress of the running transfers
+
+        :returns: list of dicts with the target file, its size, the bytes
+            written so far and for how many seconds it has been running
+        """
+        with self.__lock:
+            now = time.time()
+            jobs = [job for job in self.jobs if job.state == JOB_RUNNING]
+        progress = []
+        for job in jobs:
+            writepath = job.targetfile
+            if sync_utils.native_download(self.conf, job.remoteitem.crc32):
+                writepath += ranged_download.PART_SUFFIX
+            progress.append({'file': job.targetfile,
+                             'size': job.remoteitem.size,
+                             'bytes': disk_space.allocated(writepath),
+                             'seconds': int(now - job.started_at)})
+        return progress
+
+    def reorder(self, policy=None, priorities=None):
+        """changes the order of the jobs that didnt start yet
+
+        only jobs whose url isnt resolved are reordered, at most
+        self.prefetch jobs keep their place
+
+        :policy: one of download_queue.POLICIES, None keeps the current one
+        :priorities: dict of folder -> priority, None keeps the current one
+        :raises: ValueError for an unknown policy
+        """
+        self.__unresolved.reorder(policy, priorities)
+
+    def join(self):
+        """blocks until every queued job finished, returns finished jobs"""
+        with self.__lock:
+            # waits with a timeout so ctrl-c still works in python 2
+            while self.__pending and not self.__stop.is_set():
+                self.__lock.wait(JOIN_POLL_SECONDS)
+            finished, self.jobs = self.jobs, []
+        return finished
+
+    def shutdown(self):
+        """cancels the queued jobs and stops the running transfers"""
+        LOG.info('shutting down download workers')
+        self.__stop.set()
+        for pending in (self.__unresolved, self.__ready):
+            while True:
+                try:
+                    job = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                self.__finish(job, JOB_CANCELLED)
+
+        for thread in self.__threads:
+            thread.join(JOIN_POLL_SECONDS * 10)
+
+    def __finish(self, job, state):
+        """records the final state of a job"""
+        job.state = state
+        if state == JOB_FAILED and not self.__stop.is_set() and \
+                isinstance(job.remoteitem, zip_bundle.Bundle):
+            # queued before this job ends so join() waits for them
+            for remoteitem, targetfile in job.remoteitem.missing:
+                self.submit(remoteitem, targetfile)
+        with self.__lock:
+            self.__pending -= 1
+            metrics.DOWNLOAD_JOBS_PENDING.set(self.__pending)
+            self.__lock.notify_all()
+        metrics.DOWNLOAD_JOBS.labels(state).inc()
+        if state == JOB_DONE and job.started_at:
+            size = job.remoteitem.size
+            metrics.DOWNLOADED_BYTES.inc(size)
+            metrics.JOB_BYTES_PER_SECOND.observe(
+                size / max(time.time() - job.started_at, 0.001))
+        LOG.debug('finished %s', job)
+
+    def __resolve(self, job):
+        """looks up the download url of a job
+
+        :returns: True if the job has a url
+        """
+        if isinstance(job.remoteitem, zip_bundle.Bundle):
+            job.download_url = zip_bundle.resolve(
+                self.conf, job.remoteitem, self.__stop)
+        else:
+            job.download_url = putio_api.get_download_url(
+                self.conf, job.remoteitem.itemid)
+        job.resolved_at = time.time()
+        return job.download_url is not None
+
+    def __resolve_loop(self):
+        """resolver loop: keeps up to self.prefetch resolved jobs ready"""
+        while not self.__stop.is_set():
+            try:
+                job = self.__unresolved.get(timeout=JOIN_POLL_SECONDS)
+            except Queue.Empty:
+                continue
+
+            try:
+                resolved = self.__resolve(job)
+            except Exception:
+                LOG.error('cant resolve %s', job, exc_info=True)
+                resolved = False
+            if not resolved:
+                self.__finish(job, JOB_FAILED)
+                continue
+
+            while True:
+                if self.__stop.is_set():
+                    self.__finish(job, JOB_CANCELLED)
+                    break
+                try:
+                    self.__ready.put(job, timeout=JOIN_POLL_SECONDS)
+                    break
+                except Queue.Full:
+                    continue
+
+    def __work(self):
+        """worker loop: takes resolved jobs until shutdown"""
+        while not self.__stop.is_set():
+            try:
+                job = self.__ready.get(timeout=JOIN_POLL_SECONDS)
+            except Queue.Empty:
+                continue
+
+            state = JOB_FAILED
+            try:
+                state = self.__run(job)
+            except Exception:
+                LOG.error('download job crashed: %s', job, exc_info=True)
+            finally:
+                self.__finish(job, state)
+
+    def __run(self, job):
+        """runs the transfer of a job
+
+        :returns: the final state of the job
+        """
+        with self.__lock:
+            # running() reads both, a running job always has its start
+            job.started_at = time.time()
+            job.state = JOB_RUNNING
+        LOG.debug('running %s', job)
+        for _ in range(URL_ATTEMPTS):
+            if time.time() - job.resolved_at > URL_MAX_AGE_SECONDS:
+                LOG.debug('download url of %s is stale', job)
+                if not self.__resolve(job):
+                    return JOB_FAILED
+
+            try:
+                if isinstance(job.remoteitem, zip_bundle.Bundle):
+                    done = zip_bundle.fetch(
+                        self.conf, job.remoteitem, job.download_url,
+                        self.__stop)
+                else:
+                    done = sync_utils.start_download(
+                        job.remoteitem.size,
+                        job.download_url,
+                        job.targetfile,
+                        self.conf,
+                        self.__stop,
+                        job.remoteitem.crc32)
+            except ranged_download.ExpiredUrlError:
+                LOG.info('download url of %s expired, resolving again', job)
+                job.resolved_at = 0
+                continue
+
+            if self.__stop.is_set():
+                return JOB_CANCELLED
+            return JOB_DONE if done else JOB_FAILED
+
+        return JOB_FAILED
@@ -0,0 +1,158 @@
+"""applies the put.io account events to the cached tree
+
+Instead of listing every directory whose size changed, only the
+directories that contain or contained files named by events newer than
+the saved cursor are listed again. A full crawl still runs every
+conf['full_crawl_seconds'] for the changes the feed doesn't report.
+"""
+
+import time
+from sync_logging import LOG
+import putio_api
+import remote_tree
+
+# how many ancestors are looked up to find a known directory for a file
+MAX_PARENT_LOOKUPS = 32
+# event fields naming the directory a file is in, or was in before a move
+PARENT_KEYS = ('parent_id', 'old_parent_id')
+
+
+class EventFeed(object):
+
+    """Keeps the events cursor and decides between refresh and full crawl"""
+
+    def __init__(self, conf, cache):
+        """constructor
+
+        :conf: configuration object
+        :cache: the TreeCache the cursor is stored in
+        """
+        self.conf = conf
+        self.interval = conf.get('full_crawl_seconds')
+        cursor = cache.getmeta('events_cursor')
+        self.cursor = int(cursor) if cursor is not None else None
+        self.last_full_crawl = float(cache.getmeta('last_full_crawl', 0))
+
+    def meta(self):
+        """the state to store along with the tree"""
+        meta = {'last_full_crawl': self.last_full_crawl}
+        if self.cursor is not None:
+            meta['events_cursor'] = self.cursor
+        return meta
+
+    def sync(self, crawler, tree):
+        """brings tree up to date
+
+        :crawler: the TreeCrawler used to list directories
+        :tree: the cached tree, updated in place when possible
+        :returns: the updated tree
+        """
+        data = putio_api.getevents(self.conf)
+        events = data.get('events') if data else None
+        if events is None:
+            LOG.warn('cant read the events feed, doing a full crawl')
+            return self.__full_crawl(crawler, tree, None)
+
+        latest = max([event.get('id') for event in events] or [self.cursor])
+        if self.__needs_full_crawl(tree, events):
+            return self.__full_crawl(crawler, tree, latest)
+
+        fresh = [event for event in events if event.get('id') > self.cursor]
+        LOG.info('applying %d new events', len(fresh))
+        dirids = self.__touched_dirs(tree, fresh)
+        if dirids is None:
+            return self.__full_crawl(crawler, tree, latest)
+
+        if dirids:
+            tree = crawler.refresh(tree, dirids)
+        self.cursor = latest
+        return tree
+
+    def __needs_full_crawl(self, tree, events):
+        """is the cached tree or the cursor unusable?"""
+        if not tree or self.cursor is None:
+            return True
+        if time.time() - self.last_full_crawl > self.interval:
+            LOG.info('periodic full crawl is due')
+            return True
+        if events and min(event.get('id') for event in events) > self.cursor:
+            # every event in the page is newer, some may have been dropped
+            LOG.info('events cursor %d too old, doing a full crawl',
+                     self.cursor)
+            return True
+        return False
+
+    def __full_crawl(self, crawler, tree, latest):
+        """lists the whole account and moves the cursor to latest"""
+        tree = crawler.crawl(tree)
+        self.last_full_crawl = time.time()
+        if latest is not None:
+            self.cursor = latest
+        return tree
+
+    def __touched_dirs(self, tree, events):
+        """maps events to the ids of the known directories to list again
+
+        the directory a file was in is listed again as well as the one it
+        is in now, so deletes, renames, moves and replacements show up
+
+        :returns: a set of directory ids, None if a file cant be located
+        """
+        parents = {}
+        known = set([0])
+        for remoteitem in remote_tree.iteritems(tree):
+            parents[remoteitem.itemid] = remoteitem.parentid
+            if remoteitem.isdir():
+                known.add(remoteitem.itemid)
+
+        dirids = set()
+        for event in events:
+            fileid = event.get('file_id')
+            if fileid is None:
+                continue
+
+            if fileid in parents:
+                # where the file was
+                dirids.add(parents[fileid])
+            starts = [event.get(key) for key in PARENT_KEYS
+                      if event.get(key) is not None]
+            if not starts:
+                # the event doesnt say where the file is, put.io does
+                data = putio_api.getfile(self.conf, fileid)
+                if not data or 'file' not in data:
+                    if fileid in parents:
+                        LOG.debug('file id %s from event %s is gone',
+                                  fileid, event.get('id'))
+                        continue
+                    LOG.info('cant locate file id %s from event %s',
+                             fileid, event.get('id'))
+                    return None
+                starts = [data.get('file').get('parent_id')]
+
+            for dirid in starts:
+                dirid = self.__locate(dirid, known, event)
+                if dirid is None:
+                    return None
+                LOG.debug('event %s touches directory %d',
+                          event.get('id'), dirid)
+                dirids.add(dirid)
+
+        return dirids
+
+    def __locate(self, dirid, known, event):
+        """the nearest known directory at or above dirid
+
+        :returns: its id, None if it cant be found
+        """
+        lookups = 0
+        while dirid not in known:
+            if lookups == MAX_PARENT_LOOKUPS:
+                return None
+            lookups += 1
+            data = putio_api.getfile(self.conf, dirid)
+            if not data or 'file' not in data:
+                LOG.info('cant locate directory id %s from event %s',
+                         dirid, event.get('id'))
+                return None
+            dirid = data.get('file').get('parent_id')
+        return dirid
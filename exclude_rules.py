@@ -0,0 +1,66 @@
+"""matches account paths against EXCLUDE_LIST in one pass
+
+A rule excludes a path when it is equal to it or when it is a regular
+expression found in it. Equality is a set lookup and the expressions are
+joined into one alternation, so the cost per path doesn't grow with the
+number of rules.
+"""
+
+import re
+import hashlib
+from sync_logging import LOG
+
+
+class ExcludeRules(object):
+
+    """The compiled form of an exclude list"""
+
+    def __init__(self, rules):
+        """constructor
+
+        :rules: EXCLUDE_LIST style list of paths and expressions
+        """
+        self.exact = set(rules)
+        # tells apart trees crawled with other rules
+        self.fingerprint = hashlib.sha1(repr(list(rules))).hexdigest()
+        # rules with groups of their own could clash with the alternation
+        # (backreferences, group names) and inline flags like (?i) would
+        # apply to every rule, so they are searched one by one
+        self.separate = []
+        combined = []
+        for rule in rules:
+            try:
+                compiled = re.compile(rule)
+            except re.error:
+                LOG.warn('exclude rule %s isnt a valid expression, '
+                         'it only matches the exact path', rule)
+                continue
+            if compiled.groups or '(?' in rule:
+                self.separate.append((compiled, rule))
+            else:
+                combined.append(rule)
+
+        self.combined = None
+        self.__combined_rules = combined
+        if combined:
+            self.combined = re.compile(
+                '|'.join('(%s)' % rule for rule in combined))
+
+    def match(self, abspath):
+        """the rule that excludes abspath, None if it isn't excluded
+
+        :abspath: the path in the account, '//movies' for a top level dir
+        """
+        if abspath in self.exact:
+            return abspath
+
+        if self.combined:
+            found = self.combined.search(abspath)
+            if found:
+                return self.__combined_rules[found.lastindex - 1]
+
+        for compiled, rule in self.separate:
+            if compiled.search(abspath):
+                return rule
+
+        return None
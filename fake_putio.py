@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the put.io api, for benchmarks and experiments.
+
+Serves a synthetic account generated from a seed:
+    /v2/files/list        listings with etags, gzipped when asked
+    /v2/files/{id}        details of one item
+    /v2/files/{id}/download  302 to a signed url on the same server
+    /v2/account/info      the disk usage of the account
+    /v2/events/list       the newest files added, moved or deleted
+    /v2/zips/create       POST, bundles file_ids into a zip
+    /v2/zips/{id}         the zip url, after one poll saying it's not ready
+    /cdn/{id}             the file content, with Range support
+    /cdn/zip/{id}         the zip, its files stored uncompressed
+
+File content is a 16 byte pattern derived from the file id, so nothing is
+kept in memory and the crc32 in the listing is computed without reading
+the content. Latency and failures can be injected into every request.
+
+Point PUTIO_API_URL in sync_config.py at the printed url to sync from it:
+    ./fake_putio.py --depth 3 --fanout 10 --files 20
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import zipfile
+import zlib
+from cStringIO import StringIO
+from urlparse import urlsplit, parse_qs
+import checksum
+import putio_api
+from remote_tree import PUTIO_DIR_FTP
+from remote_tree import PUTIO_VIDEO_FTP
+
+PATTERN_SIZE = 16
+WRITE_CHUNK_SIZE = 64 * 1024
+# statuses returned when a failure is injected
+INJECTED_STATUSES = (429, 500, 503)
+# how many events the feed returns, older ones drop off like on put.io
+EVENTS_PAGE_SIZE = 50
+
+
+class SyntheticAccount(object):
+
+    """A generated account tree, items are (name, type, size, parent)"""
+
+    def __init__(self, depth=2, fanout=4, files=10, min_size=1024,
+                 max_size=64 * 1024 * 1024, seed=0):
+        """constructor
+
+        :depth: directory levels below the root
+        :fanout: directories in each directory above the last level
+        :files: files in each directory
+        :min_size: smallest file size in bytes
+        :max_size: largest file size, sizes are log-uniform in between
+        :seed: the same seed generates the same account
+        """
+        self.random = random.Random(seed)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.items = {}
+        self.children = {0: []}
+        # the newest EVENTS_PAGE_SIZE changes, oldest first
+        self.events = []
+        self.__crcs = {}
+        self.__lastid = 0
+        self.__lastevent = 0
+        self.__lock = threading.Lock()
+        self.__populate(0, depth, fanout, files)
+
+    def __populate(self, parent, depth, fanout, files):
+        """adds files and directories below parent"""
+        for num in range(files):
+            self.add_file(parent, 'file-%d.mkv' % num)
+        if depth:
+            for num in range(fanout):
+                dirid = self.add_dir(parent, 'dir-%d' % num)
+                self.__populate(dirid, depth - 1, fanout, files)
+
+    def __add(self, parent, name, filetype, size):
+        """adds an item and grows the size of its ancestors"""
+        with self.__lock:
+            self.__lastid += 1
+            itemid = self.__lastid
+            self.items[itemid] = [name, filetype, 0, parent]
+            self.children[parent].append(itemid)
+            if filetype == PUTIO_DIR_FTP:
+                self.children[itemid] = []
+            self.__grow(itemid, size)
+        return itemid
+
+    def __grow(self, itemid, size):
+        """adds size to an item and every directory above it"""
+        while itemid:
+            self.items[itemid][2] += size
+            itemid = self.items[itemid][3]
+
+    def add_dir(self, parent, name):
+        """adds an empty directory, returns its id"""
+        return self.__add(parent, name, PUTIO_DIR_FTP, 0)
+
+    def add_file(self, parent, name, size=None):
+        """adds a file of a random or the given size, returns its id"""
+        if size is None:
+            size = int(math.exp(self.random.uniform(
+                math.log(self.min_size), math.log(self.max_size))))
+        itemid = self.__add(parent, name, PUTIO_VIDEO_FTP, size)
+        with self.__lock:
+            self.__event('transfer_completed', itemid, parent_id=parent,
+                         transfer_name=name)
+        return itemid
+
+    def remove(self, itemid):
+        """deletes a file or directory with everything in it"""
+        with self.__lock:
+            name, filetype, size, parent = self.items[itemid]
+            self.__grow(parent, -size)
+            self.children[parent].remove(itemid)
+            pending = [itemid]
+            while pending:
+                removed = pending.pop()
+                pending.extend(self.children.pop(removed, ()))
+                del self.items[removed]
+            self.__event('file_deleted', itemid, parent_id=parent)
+
+    def move(self, itemid, parent, name=None):
+        """moves an item into the directory parent, renaming it if given"""
+        with self.__lock:
+            item = self.items[itemid]
+            oldparent = item[3]
+            self.__grow(oldparent, -item[2])
+            self.children[oldparent].remove(itemid)
+            self.children[parent].append(itemid)
+            item[3] = parent
+            item[0] = name or item[0]
+            self.__grow(parent, item[2])
+            self.__event('file_moved', itemid, parent_id=parent,
+                         old_parent_id=oldparent)
+
+    def __event(self, kind, itemid, **fields):
+        """records an event of the feed, the lock must be held"""
+        self.__lastevent += 1
+        fields.update(id=self.__lastevent, type=kind, file_id=itemid,
+                      created_at=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                               time.gmtime()))
+        self.events.append(fields)
+        del self.events[:-EVENTS_PAGE_SIZE]
+
+    def touch(self, count):
+        """adds count files to random directories, like new transfers"""
+        dirs = [itemid for itemid, item in self.items.items()
+                if item[1] == PUTIO_DIR_FTP] or [0]
+        return [self.add_file(self.random.choice(dirs),
+                              'new-%d.mkv' % self.__lastid)
+                for _ in range(count)]
+
+    def recent_events(self):
+        """the events of the feed, newest first"""
+        with self.__lock:
+            return self.events[::-1]
+
+    def used(self):
+        """total size of the account"""
+        return sum(self.items[itemid][2] for itemid in self.children[0])
+
+    def files(self):
+        """ids of every file"""
+        return [itemid for itemid, item in self.items.iteritems()
+                if item[1] != PUTIO_DIR_FTP]
+
+    def pattern(self, itemid):
+        """the bytes a file repeats"""
+        return hashlib.md5(str(itemid)).digest()[:PATTERN_SIZE]
+
+    def content(self, itemid, start, end):
+        """bytes start to end inclusive of a file"""
+        pattern = self.pattern(itemid)
+        size = self.items[itemid][2]
+        # the pattern is shifted so the file ends with a whole copy of it
+        offset = (start - size) % PATTERN_SIZE
+        copies = (end - start) / PATTERN_SIZE + 2
+        return (pattern * copies)[offset:offset + end - start + 1]
+
+    def crc32(self, itemid):
+        """the crc32 of a file as put.io lists it"""
+        crc = self.__crcs.get(itemid)
+        if crc is None:
+            pattern = self.pattern(itemid)
+            size = self.items[itemid][2]
+            copies, head = divmod(size, PATTERN_SIZE)
+            crc = checksum.repeated(
+                checksum.update(0, pattern[PATTERN_SIZE - head:]),
+                checksum.update(0, pattern),
+                PATTERN_SIZE,
+                copies)
+            self.__crcs[itemid] = crc
+        return '%08x' % crc
+
+    def describe(self, itemid):
+        """the api representation of an item"""
+        name, filetype, size, parent = self.items[itemid]
+        return {'id': itemid,
+                'name': name,
+                'file_type': filetype,
+                'size': size,
+                'parent_id': parent,
+                'crc32': None if filetype == PUTIO_DIR_FTP
+                else self.crc32(itemid)}
+
+
+class FakePutio(object):
+
+    """Serves a SyntheticAccount over http on a thread"""
+
+    def __init__(self, account, latency=0, jitter=0, error_rate=0,
+                 cdn_error_rate=0, seed=0):
+        """constructor
+
+        :account: the SyntheticAccount to serve
+        :latency: seconds every api request is delayed
+        :jitter: up to this many more seconds, at random
+        :error_rate: share of api requests answered with a 429 or 5xx
+        :cdn_error_rate: share of content requests answered with a 503
+        :seed: seeds the injected latency and failures
+        """
+        self.account = account
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.cdn_error_rate = cdn_error_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        # http status -> how many api requests were answered with it
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_served = 0
+        # zip id -> [file ids, times its state was fetched]
+        self.zips = {}
+        self.url = None
+        self.__server = None
+        self.__lock = threading.Lock()
+
+    def start(self, host='127.0.0.1', port=0):
+        """starts serving, returns the api url"""
+        fake = self
+
+        class Handler(_Handler):
+
+            """binds the handler to this server"""
+
+            server_fake = fake
+
+        self.__server = _Server((host, port), Handler)
+        thread = threading.Thread(target=self.__server.serve_forever,
+                                  name='fake-putio')
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://%s:%d/v2' % (host, self.__server.server_port)
+        return self.url
+
+    def stop(self):
+        """stops serving"""
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def create_zip(self, fileids):
+        """records a zip of files, returns its id"""
+        with self.__lock:
+            zipid = len(self.zips) + 1
+            self.zips[zipid] = [fileids, 0]
+        return zipid
+
+    def poll_zip(self, zipid):
+        """True if the zip is built, it takes one poll to build"""
+        with self.__lock:
+            self.zips[zipid][1] += 1
+            return self.zips[zipid][1] > 1
+
+    def stats(self):
+        """calls per endpoint, injected errors and content bytes served"""
+        with self.__lock:
+            return {'calls': dict(self.calls),
+                    'statuses': dict(self.statuses),
+                    'errors': self.errors,
+                    'bytes_served': self.bytes_served}
+
+    def count(self, endpoint, served=0):
+        """records a request"""
+        with self.__lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_served += served
+
+    def answered(self, status):
+        """records the status of an api reply"""
+        with self.__lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def inject(self, rate):
+        """the status of an injected failure, None to answer normally"""
+        with self.__lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = rate and self.random.random() < rate
+            if failed:
+                self.errors += 1
+                status = self.random.choice(INJECTED_STATUSES)
+        if delay:
+            time.sleep(delay)
+        return status if failed else None
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """One thread per connection, the sync keeps connections alive"""
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answers the api and content requests"""
+
+    protocol_version = 'HTTP/1.1'
+    server_fake = None
+
+    def log_message(self, *args):
+        """keeps stderr quiet"""
+        pass
+
+    def do_POST(self):
+        """creates a zip"""
+        fake = self.server_fake
+        parts = urlsplit(self.path)
+        form = parse_qs(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))))
+        endpoint = putio_api.RequestScheduler.endpoint(parts.path)
+        fake.count(endpoint)
+        status = fake.inject(fake.error_rate)
+        if status:
+            return self.__reply(status, {'status': 'ERROR'},
+                                {'Retry-After': '0'})
+
+        if parts.path == '/v2/zips/create':
+            fileids = [int(fileid) for fileid
+                       in form.get('file_ids', [''])[0].split(',') if fileid]
+            return self.__reply(200, {'status': 'OK',
+                                      'zip_id': fake.create_zip(fileids)})
+        return self.__reply(404, {'status': 'ERROR',
+                                  'error_type': 'NotFound'})
+
+    def do_GET(self):
+        """routes a request"""
+        fake = self.server_fake
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        content = re.match(r'/cdn/(\d+)$', parts.path)
+        if content:
+            return self.__content(fake, int(content.group(1)))
+        archive = re.match(r'/cdn/zip/(\d+)$', parts.path)
+        if archive:
+            return self.__zip(fake, int(archive.group(1)))
+
+        endpoint = putio_api.RequestScheduler.endpoint(parts.path)
+        fake.count(endpoint)
+        status = fake.inject(fake.error_rate)
+        if status:
+            return self.__reply(status, {'status': 'ERROR'},
+                                {'Retry-After': '0'})
+
+        account = fake.account
+        fileid = re.match(r'/v2/files/(\d+)(/download)?$', parts.path)
+        if parts.path == '/v2/files/list':
+            parent = int(query.get('parent_id', ['0'])[0])
+            if parent not in account.children:
+                return self.__reply(404, {'status': 'ERROR'})
+            files = [account.describe(child)
+                     for child in account.children[parent]]
+            body = {'status': 'OK', 'files': files,
+                    'parent': account.describe(parent) if parent
+                    else {'id': 0, 'name': 'Your Files'}}
+            return self.__reply(200, body, etagged=True)
+        elif parts.path == '/v2/account/info':
+            used = account.used()
+            return self.__reply(200, {'status': 'OK', 'info': {
+                'username': 'fake',
+                'disk': {'used': used, 'size': used * 2, 'avail': used}}})
+        elif parts.path == '/v2/events/list':
+            return self.__reply(200, {
+                'status': 'OK', 'events': account.recent_events()})
+        elif re.match(r'/v2/zips/\d+$', parts.path) and \
+                int(parts.path.split('/')[-1]) in fake.zips:
+            zipid = int(parts.path.split('/')[-1])
+            url = fake.poll_zip(zipid) and 'http://%s/cdn/zip/%d' % (
+                self.headers.get('Host'), zipid)
+            fileids = fake.zips[zipid][0]
+            return self.__reply(200, {
+                'status': 'OK', 'url': url,
+                'missing_files': [fileid for fileid in fileids
+                                  if fileid not in account.items]})
+        elif fileid and fileid.group(1) and int(fileid.group(1)) \
+                in account.items:
+            itemid = int(fileid.group(1))
+            if fileid.group(2):
+                location = 'http://%s/cdn/%d?sig=%d' % (
+                    self.headers.get('Host'), itemid,
+                    random.getrandbits(32))
+                return self.__reply(302, None, {'Location': location})
+            return self.__reply(
+                200, {'status': 'OK', 'file': account.describe(itemid)})
+
+        return self.__reply(404, {'status': 'ERROR',
+                                  'error_type': 'NotFound'})
+
+    def __reply(self, status, body, headers=None, etagged=False):
+        """sends a json reply, gzipped if the client accepts it"""
+        payload = json.dumps(body) if body is not None else ''
+        headers = dict(headers or {})
+        if etagged:
+            etag = '"%08x"' % (zlib.crc32(payload) & 0xffffffff)
+            if self.headers.get('If-None-Match') == etag:
+                status, payload = 304, ''
+            headers['ETag'] = etag
+        self.server_fake.answered(status)
+        if payload and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                gz.write(payload)
+            payload = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        if payload:
+            headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(payload))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __content(self, fake, itemid):
+        """sends the content of a file, whole or the requested range"""
+        account = fake.account
+        if itemid not in account.items or \
+                fake.inject(fake.cdn_error_rate):
+            fake.count('/cdn/{id}')
+            self.send_response(503 if itemid in account.items else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        size = account.items[itemid][2]
+        start, end = 0, size - 1
+        found = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        # an empty file has no range to send, it is answered whole
+        if found and size:
+            start = int(found.group(1))
+            if found.group(2):
+                end = min(end, int(found.group(2)))
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(max(0, end - start + 1)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        fake.count('/cdn/{id}', max(0, end - start + 1))
+        while start <= end:
+            last = min(end, start + WRITE_CHUNK_SIZE - 1)
+            self.wfile.write(account.content(itemid, start, last))
+            start = last + 1
+
+    def __zip(self, fake, zipid):
+        """sends a zip of the files bundled as zipid"""
+        account = fake.account
+        buf = StringIO()
+        archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED)
+        for fileid in fake.zips.get(zipid, [()])[0]:
+            if fileid in account.items:
+                size = account.items[fileid][2]
+                archive.writestr(account.items[fileid][0].encode('utf-8'),
+                                 account.content(fileid, 0, size - 1))
+        archive.close()
+        payload = buf.getvalue()
+        fake.count('/cdn/zip/{id}', len(payload))
+        self.send_response(200 if zipid in fake.zips else 404)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def __readargs():
+    """serves an account until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    add_account_args(parser)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    account, fake = from_args(args)
+    url = fake.start(port=args.port)
+    print 'serving %d items, %d bytes at %s' % (
+        len(account.items), account.used(), url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        fake.stop()
+        print fake.stats()
+
+
+def add_account_args(parser):
+    """adds the account shape and fault injection options to a parser"""
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--files', type=int, default=10,
+                        help='files per directory')
+    parser.add_argument('--min-size', type=int, default=1024)
+    parser.add_argument('--max-size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each api request')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of api requests that fail')
+    parser.add_argument('--cdn-error-rate', type=float, default=0)
+
+
+def from_args(args):
+    """the SyntheticAccount and FakePutio described by parsed args"""
+    account = SyntheticAccount(args.depth, args.fanout, args.files,
+                               args.min_size, args.max_size, args.seed)
+    fake = FakePutio(account, args.latency, args.jitter, args.error_rate,
+                     args.cdn_error_rate, args.seed)
+    return account, fake
+
+
+if __name__ == '__main__':
+    __readargs()
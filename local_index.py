@@ -0,0 +1,114 @@
+"""a cache of the local mirror listings reused between sync iterations
+
+Each directory is read in one pass and its entries kept with their type
+and size. On the next iteration a directory is only read again when its
+mtime changed, which costs a single stat instead of one per file.
+"""
+
+import os
+import stat
+import time
+from sync_logging import LOG
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # the scandir backport for python 2, optional
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# a directory modified this close to its scan may change again within the
+# same mtime tick, such listings are read again the next time
+RACY_SECONDS = 2
+
+
+class LocalEntry(object):
+
+    """A file or directory found in the mirror"""
+
+    __slots__ = ('isdir', 'size', 'inode')
+
+    def __init__(self, isdir, size, inode=None):
+        """constructor
+
+        :inode: (st_dev, st_ino) of a file with other hard links, else None
+        """
+        self.isdir = isdir
+        self.size = size
+        self.inode = inode
+
+
+class LocalIndex(object):
+
+    """Listings of mirror directories keyed by path"""
+
+    def __init__(self):
+        """constructor"""
+        # path -> (mtime, scan time, {name: LocalEntry})
+        self.__dirs = {}
+
+    def listing(self, path):
+        """the entries of a directory, read again only if it changed
+
+        :path: absolute path of the directory
+        :returns: dict of name -> LocalEntry, don't modify it
+        """
+        mtime = os.stat(path).st_mtime
+        cached = self.__dirs.get(path)
+        if cached and cached[0] == mtime and mtime < cached[1] - RACY_SECONDS:
+            return cached[2]
+
+        now = time.time()
+        entries = scan(path)
+        self.__dirs[path] = (mtime, now, entries)
+        return entries
+
+    def invalidate(self, path):
+        """forgets the listing of a directory modified by the sync"""
+        self.__dirs.pop(path, None)
+
+    def forget(self, path):
+        """forgets a directory and every listing below it"""
+        prefix = os.path.join(path, '')
+        for cached in self.__dirs.keys():
+            if cached == path or cached.startswith(prefix):
+                del self.__dirs[cached]
+
+
+def __file_entry(info):
+    """the LocalEntry of a file from its stat"""
+    inode = (info.st_dev, info.st_ino) if info.st_nlink > 1 else None
+    return LocalEntry(False, info.st_size, inode)
+
+
+def scan(path):
+    """reads a directory in one pass, with scandir when available
+
+    :returns: dict of name -> LocalEntry
+    """
+    entries = {}
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    entries[entry.name] = LocalEntry(True, 0)
+                else:
+                    entries[entry.name] = __file_entry(entry.stat())
+            except OSError:
+                LOG.debug('cant stat %s', entry.path, exc_info=True)
+                entries[entry.name] = LocalEntry(False, -1)
+        return entries
+
+    for name in os.listdir(path):
+        try:
+            info = os.stat(os.path.join(path, name))
+            if stat.S_ISDIR(info.st_mode):
+                entries[name] = LocalEntry(True, 0)
+            else:
+                entries[name] = __file_entry(info)
+        except OSError:
+            LOG.debug('cant stat %s in %s', name, path, exc_info=True)
+            entries[name] = LocalEntry(False, -1)
+    return entries
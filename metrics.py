@@ -0,0 +1,302 @@
+"""counters and histograms of the sync, served for prometheus
+
+The metrics are module level so any part of the sync can update them.
+When conf['metrics_port'] is set they are served on localhost:
+    /metrics  prometheus text format
+    /status   json snapshot of what the daemon is doing
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+from sync_logging import LOG
+
+# seconds, for api requests and crawls
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# bytes per second, for transfers
+RATE_BUCKETS = tuple(2 ** power * 1024 for power in range(4, 17, 2))
+
+# every metric created, in the order they are rendered
+REGISTRY = []
+
+
+class _Metric(object):
+
+    """A named metric whose values are kept per label values
+
+    subclasses provide child(), which makes the value of new label values
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        """constructor
+
+        :name: the prometheus name
+        :description: the help line
+        :labelnames: names of the labels the values are split by
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """the value for the given label values"""
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.child()
+            return child
+
+    def samples(self):
+        """yields (suffix, labels dict, value) of every value"""
+        with self.lock:
+            children = self.children.items()
+        for values, child in sorted(children):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                yield suffix, dict(labels, **extra), value
+
+
+class _Value(object):
+
+    """A counter or gauge value"""
+
+    def __init__(self):
+        """constructor"""
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """adds amount"""
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        """replaces the value, for gauges"""
+        self.value = value
+
+    def samples(self):
+        """the value"""
+        yield '', {}, self.value
+
+
+class _Buckets(object):
+
+    """Observations of a histogram"""
+
+    def __init__(self, buckets):
+        """constructor"""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """records an observation"""
+        with self.lock:
+            self.count += 1
+            self.total += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def samples(self):
+        """cumulative buckets, sum and count"""
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.total
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            yield '_bucket', {'le': repr(float(bound))}, cumulative
+        yield '_bucket', {'le': '+Inf'}, count
+        yield '_sum', {}, total
+        yield '_count', {}, count
+
+
+class Counter(_Metric):
+
+    """A value that only goes up"""
+
+    kind = 'counter'
+
+    def child(self):
+        """a new value"""
+        return _Value()
+
+    def inc(self, amount=1):
+        """adds amount to the metric without labels"""
+        self.labels().inc(amount)
+
+
+class Gauge(Counter):
+
+    """A value that goes up and down"""
+
+    kind = 'gauge'
+
+    def set(self, value):
+        """sets the metric without labels"""
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+
+    """Observations counted into buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        """constructor
+
+        :buckets: upper bounds of the buckets, ascending
+        """
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, description, labelnames)
+
+    def child(self):
+        """a new set of buckets"""
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        """records an observation of the metric without labels"""
+        self.labels().observe(value)
+
+
+API_REQUEST_SECONDS = Histogram(
+    'putiosync_api_request_seconds',
+    'time taken by put.io api requests', ('endpoint',))
+API_RESPONSES = Counter(
+    'putiosync_api_responses_total',
+    'put.io api responses by status, error if none arrived',
+    ('endpoint', 'status'))
+CRAWL_SECONDS = Histogram(
+    'putiosync_crawl_seconds', 'time taken to bring the tree up to date')
+CRAWL_DIRS_LISTED = Counter(
+    'putiosync_crawl_dirs_listed_total', 'directories listed on put.io')
+CRAWL_DIRS_SKIPPED = Counter(
+    'putiosync_crawl_dirs_skipped_total',
+    'directories not listed because their size was unchanged')
+SYNC_ITERATIONS = Counter(
+    'putiosync_iterations_total', 'sync iterations by outcome', ('result',))
+DOWNLOAD_JOBS_PENDING = Gauge(
+    'putiosync_download_jobs_pending', 'downloads queued or running')
+DOWNLOAD_JOBS = Counter(
+    'putiosync_download_jobs_total', 'finished downloads by state',
+    ('state',))
+DOWNLOADED_BYTES = Counter(
+    'putiosync_downloaded_bytes_total', 'bytes of completed downloads')
+JOB_BYTES_PER_SECOND = Histogram(
+    'putiosync_job_bytes_per_second',
+    'size of each completed download over the time it ran, url lookups '
+    'and waits for connections or disk space included',
+    buckets=RATE_BUCKETS)
+DOWNLOAD_STALLS = Counter(
+    'putiosync_download_stalls_total',
+    'downloads aborted because they made no progress', ('downloader',))
+CONNECTIONS_OPEN = Gauge(
+    'putiosync_connections_open', 'connections of the running downloads')
+HOST_CONNECTIONS = Gauge(
+    'putiosync_host_connections',
+    'connections a large download from the cdn host opens', ('host',))
+TRASHED = Counter(
+    'putiosync_trashed_total',
+    'files and directories moved into the trash')
+TRASH_PURGED_FILES = Counter(
+    'putiosync_trash_purged_files_total', 'files removed from the trash')
+TRASH_RECLAIMED_BYTES = Counter(
+    'putiosync_trash_reclaimed_bytes_total',
+    'bytes taken back from the trash instead of downloaded')
+SPACE_SUSPENSIONS = Counter(
+    'putiosync_space_suspensions_total',
+    'waits for free disk space, for the account or a single download',
+    ('scope',))
+
+# what the daemon is doing, served as /status, callables are called
+# for their value on every request
+STATUS = {'started': time.time()}
+
+
+def render():
+    """every metric in the prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.description))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                labeltext = '{%s}' % ','.join(
+                    '%s="%s"' % (key, labels[key].replace('"', '\\"'))
+                    for key in sorted(labels))
+            else:
+                labeltext = ''
+            lines.append('%s%s%s %s' % (
+                metric.name, suffix, labeltext, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serves /metrics and /status"""
+
+    def log_message(self, *args):
+        """requests aren't logged"""
+        pass
+
+    def do_GET(self):
+        """answers a scrape"""
+        if self.path == '/metrics':
+            body, ctype = render(), 'text/plain; version=0.0.4'
+        elif self.path == '/status':
+            status = dict((key, value() if callable(value) else value)
+                          for key, value in STATUS.items())
+            status['now'] = time.time()
+            body, ctype = json.dumps(status, sort_keys=True), \
+                'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """Serves scrapes on daemon threads"""
+
+    daemon_threads = True
+
+
+def serve(conf):
+    """serves the metrics on localhost if conf['metrics_port'] is set
+
+    :conf: configuration object
+    :returns: the server, None if disabled or the port is taken
+    """
+    port = conf.get('metrics_port')
+    if not port:
+        return None
+    try:
+        server = _Server(('127.0.0.1', port), _Handler)
+    except IOError:
+        LOG.error('cant serve metrics on port %d', port, exc_info=True)
+        print '\n[E] Cant serve metrics on port %d' % port
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    LOG.info('serving metrics on http://127.0.0.1:%d/metrics', port)
+    return server
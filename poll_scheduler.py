@@ -0,0 +1,162 @@
+"""decides how long the sync waits between iterations
+
+The wait drops to conf['poll_min_seconds'] after an iteration that found
+changes and doubles after every quiet one, up to conf['poll_max_seconds'].
+A line sent to the control socket ends the wait right away, a SIGUSR1
+within SIGNAL_POLL_SECONDS, e.g. after uploading something:
+
+    kill -USR1 <pid>
+    echo sync | nc -U ~/.putiosync/control.sock
+
+Other parts of the sync add their own commands to the socket with
+handle().
+"""
+
+import os
+import signal
+import socket
+import threading
+import time
+from sync_logging import LOG
+
+# a control client that connects and sends nothing is dropped after this
+CONTROL_TIMEOUT_SECONDS = 5
+# how often the wait looks for a SIGUSR1
+SIGNAL_POLL_SECONDS = 1
+
+
+class PollScheduler(object):
+
+    """Adaptive wait between sync iterations that can be woken early"""
+
+    def __init__(self, conf):
+        """constructor
+
+        :conf: configuration object
+        """
+        self.minimum = conf.get('poll_min_seconds')
+        self.maximum = max(self.minimum, conf.get('poll_max_seconds'))
+        self.interval = self.minimum
+        self.socketpath = conf.get('control_socket')
+        self.__wake = threading.Event()
+        # set by the SIGUSR1 handler, which must not take the event's lock
+        # the interrupted thread may hold
+        self.__signalled = False
+        self.__server = None
+        # command -> callable taking the rest of the line, returns a reply
+        self.__commands = {'sync': self.__sync_command}
+
+    def start(self):
+        """installs the SIGUSR1 handler and opens the control socket
+
+        must be called from the main thread
+        """
+        signal.signal(signal.SIGUSR1, self.__on_signal)
+        if self.socketpath:
+            self.__listen()
+
+    def stop(self):
+        """closes the control socket"""
+        if self.__server:
+            self.__server.close()
+            self.__server = None
+            try:
+                os.remove(self.socketpath)
+            except OSError:
+                pass
+
+    def handle(self, command, callback):
+        """adds a command to the control socket
+
+        :command: the first word of the line
+        :callback: called with the rest of the line, returns the reply
+        """
+        self.__commands[command] = callback
+
+    def wake(self):
+        """ends the current or the next wait, not from a signal handler"""
+        self.__wake.set()
+
+    def __on_signal(self, signum, frame):
+        """the SIGUSR1 handler, wait() picks the flag up"""
+        self.__signalled = True
+
+    def record(self, changes):
+        """adapts the interval to the outcome of an iteration
+
+        :changes: how many changes the iteration found
+        """
+        if changes:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.maximum, self.interval * 2)
+        LOG.debug('%d changes, next poll in %d seconds',
+                  changes, self.interval)
+
+    def wait(self):
+        """sleeps for the current interval unless woken
+
+        :returns: True if the wait was ended early
+        """
+        LOG.debug('sleeping for %d seconds', self.interval)
+        deadline = time.time() + self.interval
+        woken = False
+        while not woken:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            woken = self.__wake.wait(min(remaining, SIGNAL_POLL_SECONDS))
+            if self.__signalled:
+                self.__signalled = False
+                woken = True
+        self.__wake.clear()
+        if woken:
+            LOG.info('woken up before the poll interval ended')
+            self.interval = self.minimum
+        return bool(woken)
+
+    def __listen(self):
+        """serves the control socket on a daemon thread"""
+        parent = os.path.dirname(self.socketpath)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(self.socketpath)
+        os.chmod(self.socketpath, 0600)
+        self.__server.listen(4)
+        thread = threading.Thread(target=self.__serve, name='control')
+        thread.daemon = True
+        thread.start()
+
+    def __sync_command(self, _):
+        """the 'sync' command, ends the wait"""
+        self.wake()
+        return 'ok'
+
+    def __serve(self):
+        """accepts control connections, runs the command on each"""
+        while self.__server:
+            try:
+                conn, _ = self.__server.accept()
+            except (socket.error, AttributeError):
+                return
+            try:
+                conn.settimeout(CONTROL_TIMEOUT_SECONDS)
+                line = conn.recv(1024).strip().split(None, 1)
+                callback = self.__commands.get(line[0] if line else None)
+                if callback:
+                    reply = callback(line[1] if len(line) > 1 else '')
+                else:
+                    reply = 'unknown command'
+                conn.sendall('%s\n' % reply)
+            except socket.timeout:
+                LOG.debug('control client sent nothing, closing it')
+            except socket.error:
+                LOG.debug('control connection failed', exc_info=True)
+            except Exception:
+                LOG.error('control command failed', exc_info=True)
+            finally:
+                conn.close()
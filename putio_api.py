@@ -1,22 +1,369 @@
 """this module consists solely of methods that operate the putio API"""
 
 import httplib
-import urllib2
-import gzip
-import StringIO
+import socket
+import threading
+import time
+import re
+import heapq
+import random
+import itertools
+import zlib
 import json
 from urllib import urlencode
+from urlparse import urlsplit
 from sync_logging import LOG
+from sync_config import PUTIO_API_URL
 import exit_helper
+import metrics
 
 USER_AGENT = 'putio-sync-client'
-API_URL = 'https://api.put.io/v2'
+API_URL = PUTIO_API_URL
+# account info is polled often while waiting for disk space
+ACCOUNT_INFO_TTL_SECONDS = 30
+READ_CHUNK_SIZE = 64 * 1024
+
+# returned instead of a listing when the etag passed still matches
+NOT_MODIFIED = 'not modified'
+
+# requests of a lower lane are admitted first
+PRIORITY_DOWNLOAD = 0
+PRIORITY_CRAWL = 1
+MAX_IN_FLIGHT = 8
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 120
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# requests sent again after a failed connection, a POST may have been
+# processed before the connection broke
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class ConnectionPool(object):
+
+    """Keeps idle keep-alive connections to a host for reuse"""
+
+    def __init__(self, baseurl, maxidle=8, timeout=60):
+        """constructor
+
+        :baseurl: url whose scheme and host the connections go to
+        :maxidle: how many idle connections are kept open
+        :timeout: socket timeout in seconds
+        """
+        parts = urlsplit(baseurl)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.maxidle = maxidle
+        self.timeout = timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def __acquire(self):
+        """returns an idle connection or a new one"""
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop(), True
+
+        if self.secure:
+            conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        return conn, False
+
+    def __release(self, conn):
+        """puts a connection back into the pool or closes it"""
+        with self.__lock:
+            if len(self.__idle) < self.maxidle:
+                self.__idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, headers, consume=None, body=None):
+        """performs a request on a pooled connection
+
+        :url: absolute url or path on the pooled host
+        :consume: optional callable reading the body off the response
+        :body: optional request body
+        :returns: tuple of status, dict of lowercase headers and the body
+        """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        while True:
+            conn, reused = self.__acquire()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                content = consume(response) if consume else response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused and method in IDEMPOTENT_METHODS:
+                    # the server dropped an idle keep-alive connection
+                    LOG.debug('stale pooled connection to %s', self.host)
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.__release(conn)
+            return response.status, dict(response.getheaders()), content
+
+    def close(self):
+        """closes the idle connections"""
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+
+class RequestScheduler(object):
+
+    """Admits api requests by priority lane and backs off per endpoint
+
+    An endpoint that answered 429 or 5xx, or that announced an exhausted
+    rate limit, isn't called again before its Retry-After or a jittered
+    exponential backoff passed.
+    """
+
+    def __init__(self, slots):
+        """constructor
+
+        :slots: how many requests may be in flight at the same time
+        """
+        self.slots = slots
+        self.__busy = 0
+        self.__waiting = []
+        self.__tickets = itertools.count()
+        self.__cond = threading.Condition()
+        # endpoint -> (time before which it isn't called, failures in a row)
+        self.__backoff = {}
+
+    @staticmethod
+    def endpoint(url):
+        """the url path with ids replaced, e.g. /v2/files/{id}/download"""
+        return re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path)
+
+    def acquire(self, endpoint, priority):
+        """blocks until the endpoint may be called and a slot is free"""
+        with self.__cond:
+            wait = self.__backoff.get(endpoint, (0, 0))[0] - time.time()
+        if wait > 0:
+            LOG.info('backing off %s for %.1f seconds', endpoint, wait)
+            time.sleep(wait)
+
+        ticket = (priority, next(self.__tickets))
+        with self.__cond:
+            heapq.heappush(self.__waiting, ticket)
+            while self.__waiting[0] != ticket or self.__busy >= self.slots:
+                self.__cond.wait(1)
+            heapq.heappop(self.__waiting)
+            self.__busy += 1
+            # the next waiter may fit into another free slot
+            self.__cond.notify_all()
+
+    def release(self, endpoint, status, headers):
+        """frees the slot and records how the endpoint answered
+
+        :status: the http status, None if the connection failed
+        :headers: dict of lowercase response headers
+        :returns: True if the request should be retried
+        """
+        headers = headers or {}
+        now = time.time()
+        with self.__cond:
+            self.__busy -= 1
+            self.__cond.notify_all()
+            failures = self.__backoff.get(endpoint, (0, 0))[1]
+
+            if status is None or status in RETRY_STATUSES:
+                failures += 1
+                delay = parse_retry_after(headers.get('retry-after'))
+                if delay is None:
+                    delay = min(
+                        BACKOFF_MAX_SECONDS,
+                        BACKOFF_BASE_SECONDS * 2 ** (failures - 1))
+                    delay *= random.uniform(0.5, 1.5)
+                LOG.warn('%s answered %s, retrying in %.1f seconds',
+                         endpoint, status, delay)
+                self.__backoff[endpoint] = (now + delay, failures)
+                return True
+
+            notbefore = 0
+            if headers.get('x-ratelimit-remaining') == '0':
+                notbefore = parse_ratelimit_reset(
+                    headers.get('x-ratelimit-reset'), now)
+            self.__backoff[endpoint] = (notbefore, 0)
+            return False
+
+
+def parse_retry_after(value):
+    """seconds to wait from a Retry-After header, None if missing"""
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_ratelimit_reset(value, now):
+    """time when an exhausted rate limit resets, epoch or delta seconds"""
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return now + BACKOFF_BASE_SECONDS
+    return reset if reset > now / 2 else now + reset
+
+
+def read_inflated(response):
+    """reads a response body, gunzipping it chunk by chunk if needed"""
+    if response.getheader('content-encoding') != 'gzip':
+        return response.read()
+
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    while True:
+        chunk = response.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts.append(inflater.decompress(chunk))
+    parts.append(inflater.flush())
+    return ''.join(parts)
+
+
+class ApiClient(object):
+
+    """The put.io api over a keep-alive connection pool
+
+    Responses can be revalidated with an etag the caller keeps, or kept
+    for a ttl and then revalidated with the etag they came with.
+    """
+
+    def __init__(self, baseurl):
+        """constructor
+
+        :baseurl: the api endpoint e.g. https://api.put.io/v2
+        """
+        self.baseurl = baseurl
+        self.pool = ConnectionPool(baseurl)
+        self.scheduler = RequestScheduler(MAX_IN_FLIGHT)
+        # url -> (time fetched, etag, decoded body)
+        self.__cache = {}
+        self.__lock = threading.Lock()
+
+    def send(self, url, headers, consume=None, priority=PRIORITY_CRAWL,
+             method='GET', body=None):
+        """performs a request through the scheduler, retrying 429 and 5xx
+
+        :returns: tuple of status, dict of lowercase headers and the body
+        """
+        endpoint = RequestScheduler.endpoint(url)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.scheduler.acquire(endpoint, priority)
+            started = time.time()
+            try:
+                response = self.pool.request(
+                    method, url, headers, consume, body)
+            except (httplib.HTTPException, IOError, OSError, zlib.error):
+                metrics.API_RESPONSES.labels(endpoint, 'error').inc()
+                self.scheduler.release(endpoint, None, None)
+                if attempt == MAX_ATTEMPTS or \
+                        method not in IDEMPOTENT_METHODS:
+                    raise
+                LOG.warn('request to %s failed', endpoint, exc_info=True)
+                continue
+
+            status, rheaders = response[0], response[1]
+            metrics.API_REQUEST_SECONDS.labels(endpoint).observe(
+                time.time() - started)
+            metrics.API_RESPONSES.labels(endpoint, status).inc()
+            if not self.scheduler.release(endpoint, status, rheaders) or \
+                    attempt == MAX_ATTEMPTS:
+                return response
+
+    def request(self, conf, resource, params, compress=True, etag=None,
+                ttl=0, priority=PRIORITY_CRAWL, method='GET'):
+        """makes an http call to put.io api
+
+        :conf: configuration object
+        :resource: the REST resource in the api
+        :params: a dictionary of url parameters key-val
+        :compress: ask for a gzipped response
+        :etag: the caller's etag of the response, sent as If-None-Match
+        :ttl: seconds the decoded response is reused without a request
+        :priority: the scheduler lane of the request
+        :method: 'POST' sends params as a form instead of in the url
+        :returns: tuple of decoded response (None if failed, NOT_MODIFIED
+            if etag still matches) and the etag of the response
+        """
+        headers = {'User-Agent': USER_AGENT, 'Accept': 'application/json'}
+        body = None
+        if method == 'POST':
+            body = urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            params = {}
+        params = dict(params, oauth_token=conf.get('oauthtoken'))
+        url = self.baseurl + resource + '?' + urlencode(params)
+        if compress:
+            headers['Accept-Encoding'] = 'gzip'
+
+        cached = None
+        if ttl:
+            with self.__lock:
+                cached = self.__cache.get(url)
+            if cached and time.time() - cached[0] < ttl:
+                return cached[2], cached[1]
+            if cached and cached[1]:
+                etag = cached[1]
+        if etag:
+            headers['If-None-Match'] = etag
+
+        LOG.debug('making http request: %s', url)
+        try:
+            status, headers, content = self.send(
+                url, headers, read_inflated, priority, method, body)
+        except (httplib.HTTPException, IOError, OSError, zlib.error):
+            LOG.error('request failed %s', url, exc_info=True)
+            return None, None
+
+        if status == 304:
+            LOG.debug('not modified: %s', url)
+            if not cached:
+                return NOT_MODIFIED, etag
+            with self.__lock:
+                self.__cache[url] = (time.time(),) + cached[1:]
+            return cached[2], cached[1]
+        elif status == 200:
+            try:
+                data = json.loads(content)
+            except ValueError:
+                LOG.error(
+                    'cant parse api response: %s',
+                    content,
+                    exc_info=True)
+                return None, None
+
+            etag = headers.get('etag')
+            if ttl:
+                with self.__lock:
+                    self.__cache[url] = (time.time(), etag, data)
+            return data, etag
+        elif status == 302:
+            LOG.debug('got redirect: %s', headers.get('location'))
+            return headers, None
+        else:
+            LOG.error('request failed %s status: %s', url, status)
+
+        return None, None
+
+
+# shared by every api call in the process
+CLIENT = ApiClient(API_URL)
 
 
 def accountinfo(conf):
     """returns the account info"""
     resource = '/account/info'
-    return make_api_request(conf, resource, {}, compress=False)
+    return CLIENT.request(
+        conf, resource, {}, compress=False, ttl=ACCOUNT_INFO_TTL_SECONDS)[0]
 
 
 def getfiles(conf, parent_id):
@@ -25,6 +372,48 @@ def getfiles(conf, parent_id):
     return make_api_request(conf, resource, {'parent_id': parent_id})
 
 
+def getfiles_if_changed(conf, parent_id, etag):
+    """like getfiles but returns NOT_MODIFIED if etag still matches
+
+    :returns: tuple of the listing and its etag
+    """
+    resource = '/files/list'
+    return CLIENT.request(conf, resource, {'parent_id': parent_id},
+                          etag=etag)
+
+
+def getfile(conf, fileid):
+    """fetches the details of a single file or directory"""
+    resource = '/files/%d' % fileid
+    return make_api_request(conf, resource, {})
+
+
+def getevents(conf):
+    """fetches the latest events of the account, newest first"""
+    resource = '/events/list'
+    return make_api_request(conf, resource, {})
+
+
+def create_zip(conf, fileids):
+    """asks put.io to bundle files into one zip archive
+
+    :returns: the id of the zip, None if failed
+    """
+    resource = '/zips/create'
+    response = CLIENT.request(
+        conf, resource, {'file_ids': ','.join(str(fileid)
+                                             for fileid in fileids)},
+        compress=False, priority=PRIORITY_DOWNLOAD, method='POST')[0]
+    return response.get('zip_id') if response else None
+
+
+def getzip(conf, zipid):
+    """fetches the state of a zip, its url is set once it was built"""
+    resource = '/zips/%d' % zipid
+    return CLIENT.request(
+        conf, resource, {}, compress=False, priority=PRIORITY_DOWNLOAD)[0]
+
+
 def make_api_request(conf, resource, params, compress=True):
     """makes an http call to put.io api
 
@@ -34,54 +423,7 @@ def make_api_request(conf, resource, params, compress=True):
     :returns: raw response from http response or None if failed
 
     """
-    params['oauth_token'] = conf.get('oauthtoken')
-    url = API_URL + resource + '?' + urlencode(params)
-    LOG.debug('making http request: %s', url)
-    req = urllib2.Request(url)
-    req.add_header('User-Agent', USER_AGENT)
-    req.add_header('Accept', 'application/json')
-    if compress:
-        req.add_header('Accept-Encoding', 'gzip;q=1.0,deflate;q=0.5,*;q=0')
-    try:
-        response = urllib2.urlopen(req)
-        if response.getcode() == 200:
-            content = response.read()
-            try:
-                if compress:
-                    try:
-                        inflated = gzip.GzipFile(
-                            fileobj=StringIO.StringIO(content))
-
-                        return json.loads(inflated.read())
-                    except IOError:
-                        LOG.error(
-                            'request failed due to IO error, content',
-                            exc_info=True)
-
-                        return json.loads(content)
-                else:
-                    return json.loads(content)
-            except ValueError:
-                LOG.error(
-                    'cant parse api response: %s',
-                    content,
-                    exc_info=True)
-
-                return None
-        elif response.getcode() == 302:
-            LOG.debug('got redirect: %s', str(response.info()))
-            return response.info()
-        else:
-            LOG.error('request failed %s status: %s', url, response.getcode())
-
-    except urllib2.HTTPError as exc:
-        LOG.error(
-            'request failed %s status: %s message: %s',
-            url,
-            exc.code,
-            exc.reason)
-
-    return None
+    return CLIENT.request(conf, resource, params, compress)[0]
 
 
 def get_download_url(conf, fileid):
@@ -96,18 +438,17 @@ def get_download_url(conf, fileid):
         'trying to dereference download url for file id: %s',
         str(fileid))
     try:
-        conn = httplib.HTTPSConnection('api.put.io')
-        url = API_URL + \
+        url = CLIENT.baseurl + \
             '/files/%s/download?oauth_token=' + conf.get('oauthtoken')
         url = url % fileid
-        conn.request("GET", url, None, {'User-Agent': USER_AGENT})
-        response = conn.getresponse()
-        if response.status == 302:
-            return response.getheader('Location')
+        status, headers, _ = CLIENT.send(
+            url, {'User-Agent': USER_AGENT}, priority=PRIORITY_DOWNLOAD)
+        if status == 302:
+            return headers.get('location')
         else:
             LOG.error(
                 'putio api returned status %d for download: %s',
-                response.status, url)
+                status, url)
             return None
     except (httplib.HTTPException, IOError, OSError):
         LOG.error(
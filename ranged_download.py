@@ -0,0 +1,361 @@
+"""a resumable multi-connection http downloader, the alternative to axel
+
+The file is fetched into targetfile + PART_SUFFIX with one Range request
+per segment, each written straight at its offset. The progress of every
+segment is kept in targetfile + STATE_SUFFIX so an interrupted or stalled
+transfer resumes where it stopped. Each segment folds its bytes into a
+crc32 as they are written, the segment crcs are combined to check the
+file against put.io without reading it again. The part file is renamed
+to targetfile once every byte arrived and the crc32 matched.
+"""
+
+import os
+import json
+import time
+import socket
+import httplib
+import threading
+from urlparse import urlsplit
+from sync_logging import LOG
+import checksum
+import bandwidth
+import metrics
+
+PART_SUFFIX = '.putiosync-part'
+STATE_SUFFIX = '.putiosync-state'
+STATE_TEMP_SUFFIX = STATE_SUFFIX + '.tmp'
+
+CHUNK_SIZE = 64 * 1024
+# files are never split into segments smaller than this
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+STATE_SAVE_SECONDS = 5
+# a transfer without progress for this long is aborted, it resumes later
+STALL_SECONDS = 60
+SOCKET_TIMEOUT = 30
+MAX_REDIRECTS = 5
+SEGMENT_ATTEMPTS = 3
+# how often a file whose crc32 doesn't match is fetched again right away
+CRC_ATTEMPTS = 2
+
+
+class ExpiredUrlError(IOError):
+
+    """The server refused the download url, it has to be resolved again"""
+
+
+class Segment(object):
+
+    """A byte range of the file and how much of it was written"""
+
+    def __init__(self, start, end, done=0, crc=None):
+        """constructor
+
+        :start: offset of the first byte
+        :end: offset of the last byte, inclusive
+        :done: bytes of the range already written
+        :crc: crc32 of the bytes written, None if unknown
+        """
+        self.start = start
+        self.end = end
+        self.done = done
+        self.crc = 0 if done == 0 else crc
+        self.__lock = threading.Lock()
+
+    def remaining(self):
+        """bytes of the range still missing"""
+        return self.end - self.start + 1 - self.done
+
+    def advance(self, chunk):
+        """accounts for a chunk written at the end of the done bytes"""
+        with self.__lock:
+            if self.crc is not None:
+                self.crc = checksum.update(self.crc, chunk)
+            self.done += len(chunk)
+
+    def reset(self):
+        """marks the whole range as missing"""
+        with self.__lock:
+            self.done = 0
+            self.crc = 0
+
+    def snapshot(self):
+        """consistent [start, end, done, crc] for the state file"""
+        with self.__lock:
+            return [self.start, self.end, self.done, self.crc]
+
+
+def partial_target(name):
+    """returns the file name a part or state file belongs to, else None"""
+    for suffix in (PART_SUFFIX, STATE_SUFFIX, STATE_TEMP_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def download(filesize, download_url, targetfile, conf, stop=None,
+             crc32=None, connections=None):
+    """downloads a file with up to connections range requests at a time
+
+    :filesize: expected size of the file
+    :download_url: where to fetch the file from
+    :targetfile: local path of the file
+    :conf: configuration object
+    :stop: optional threading.Event, when set the transfer is aborted
+    :crc32: expected crc32 hex string as listed by put.io, if known
+    :connections: defaults to conf['conn_per_downloads'], a resumed
+        download keeps its segments and fetches that many at a time
+    :returns: True if the file was downloaded completely
+    :raises ExpiredUrlError: the url has to be resolved again, the
+        progress is saved
+    """
+    partfile = targetfile + PART_SUFFIX
+    statefile = targetfile + STATE_SUFFIX
+    stop = stop or threading.Event()
+    connections = connections or conf.get('conn_per_downloads') or 1
+
+    segments = __load_state(statefile, partfile, filesize)
+    if segments is None:
+        segments = __plan(filesize, connections)
+        with open(partfile, 'wb') as out:
+            out.truncate(filesize)
+        __save_state(statefile, filesize, segments)
+    else:
+        LOG.info('resuming download of %s, %d bytes missing',
+                 targetfile, sum(seg.remaining() for seg in segments))
+
+    print '\nStarting download :%s' % download_url
+    LOG.info('starting native download :%s into %s',
+             download_url, targetfile)
+    for _ in range(CRC_ATTEMPTS):
+        if not __transfer(download_url, partfile, statefile, filesize,
+                          segments, conf, stop, connections):
+            LOG.warn('download of %s incomplete, it will be resumed',
+                     targetfile)
+            return False
+
+        if os.path.getsize(partfile) != filesize:
+            LOG.error('download %s has wrong size, restarting it',
+                      targetfile)
+            __discard(partfile, statefile)
+            return False
+
+        crc = __combined_crc(segments)
+        if crc is None:
+            # resumed from a state file without segment crcs
+            crc = checksum.file_crc32(partfile)
+        if checksum.matches(crc, crc32):
+            os.rename(partfile, targetfile)
+            os.remove(statefile)
+            return True
+
+        LOG.error('crc32 of %s is %08x, expected %s, fetching it again',
+                  targetfile, crc, crc32)
+        for segment in segments:
+            segment.reset()
+        __save_state(statefile, filesize, segments)
+
+    return False
+
+
+def __transfer(download_url, partfile, statefile, filesize, segments, conf,
+               stop, connections):
+    """fetches the missing bytes of every segment, connections at a time
+
+    :returns: True if no byte is missing anymore
+    """
+    limiter = bandwidth.shared(conf)
+    abort = threading.Event()
+    expired = threading.Event()
+    pending = [segment for segment in segments if segment.remaining()]
+    pending.reverse()
+    workers = []
+    for _ in range(min(connections, len(pending))):
+        worker = threading.Thread(
+            target=__fetch_pending,
+            args=(download_url, partfile, pending, limiter, abort,
+                  expired))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    completed = __supervise(workers, segments, statefile, filesize, stop)
+    abort.set()
+    for worker in workers:
+        worker.join()
+    __save_state(statefile, filesize, segments)
+    if expired.is_set():
+        raise ExpiredUrlError('download url of %s expired' % partfile)
+    return completed and not any(seg.remaining() for seg in segments)
+
+
+def __combined_crc(segments):
+    """crc32 of the whole file from the segment crcs, None if unknown"""
+    crc = 0
+    for segment in segments:
+        if segment.crc is None:
+            return None
+        crc = checksum.combine(crc, segment.crc, segment.done)
+    return crc
+
+
+def __supervise(workers, segments, statefile, filesize, stop):
+    """waits for the segment workers, saving progress along the way
+
+    :returns: False if the transfer was stopped or stalled
+    """
+    progress = sum(seg.done for seg in segments)
+    last_progress = last_save = time.time()
+    while any(worker.is_alive() for worker in workers):
+        # returns as soon as the transfer ends rather than a second later
+        next(worker for worker in workers if worker.is_alive()).join(1)
+        if stop.is_set():
+            LOG.info('download interrupted, saving progress')
+            return False
+
+        now = time.time()
+        current = sum(seg.done for seg in segments)
+        if current != progress:
+            progress, last_progress = current, now
+        elif now - last_progress > STALL_SECONDS:
+            metrics.DOWNLOAD_STALLS.labels('native').inc()
+            LOG.error('download stalled for %d seconds, aborting',
+                      STALL_SECONDS)
+            return False
+
+        if now - last_save > STATE_SAVE_SECONDS:
+            __save_state(statefile, filesize, segments)
+            last_save = now
+
+    return True
+
+
+def __fetch_pending(url, partfile, pending, limiter, abort, expired):
+    """fetches segments taken from pending until none is left"""
+    while not abort.is_set():
+        try:
+            segment = pending.pop()
+        except IndexError:
+            return
+        __fetch(url, partfile, segment, limiter, abort, expired)
+
+
+def __fetch(url, partfile, segment, limiter, abort, expired):
+    """downloads the missing bytes of a segment into the part file"""
+    attempts = SEGMENT_ATTEMPTS
+    while segment.remaining() and not abort.is_set():
+        try:
+            response = open_range(
+                url, segment.start + segment.done, segment.end)
+            # unbuffered so the saved progress never runs ahead of the disk
+            with open(partfile, 'r+b', 0) as out:
+                out.seek(segment.start + segment.done)
+                while segment.remaining() and not abort.is_set():
+                    chunk = response.read(
+                        min(CHUNK_SIZE, segment.remaining()))
+                    if not chunk:
+                        break
+                    limiter.consume(len(chunk))
+                    out.write(chunk)
+                    segment.advance(chunk)
+            response.close()
+            if not segment.remaining() or abort.is_set():
+                return
+            LOG.warn('segment %d-%d of %s ended early',
+                     segment.start, segment.end, partfile)
+        except ExpiredUrlError:
+            LOG.info('server refused the url of %s', partfile)
+            expired.set()
+            abort.set()
+            return
+        except (httplib.HTTPException, socket.error, IOError):
+            LOG.warn('segment %d-%d of %s failed',
+                     segment.start, segment.end, partfile, exc_info=True)
+
+        attempts -= 1
+        if attempts == 0:
+            return
+
+
+def open_range(url, first, last=None):
+    """requests bytes first..last of url following redirects
+
+    :last: the last byte, None for the end of the file
+    :returns: the httplib response positioned at byte first
+    :raises ExpiredUrlError: the server refused the url
+    """
+    for _ in range(MAX_REDIRECTS):
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            conn = httplib.HTTPSConnection(
+                parts.netloc, timeout=SOCKET_TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(
+                parts.netloc, timeout=SOCKET_TIMEOUT)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn.request('GET', path, None, {
+            'Range': 'bytes=%d-%s' % (first, '' if last is None else last),
+            'User-Agent': 'putio-sync-client'})
+        response = conn.getresponse()
+        if response.status in (301, 302, 303, 307):
+            url = response.getheader('Location')
+            conn.close()
+            continue
+        if response.status == 206 or (response.status == 200 and first == 0):
+            return response
+        conn.close()
+        if response.status in (403, 410):
+            raise ExpiredUrlError('status %d for %s' % (response.status, url))
+        raise IOError('unexpected status %d for range %d-%s of %s' % (
+            response.status, first, last, url))
+
+    raise IOError('too many redirects for %s' % url)
+
+
+def __plan(filesize, connections):
+    """splits the file into at most connections segments"""
+    count = max(1, min(connections or 1, filesize // MIN_SEGMENT_SIZE))
+    step = filesize // count
+    segments = []
+    for num in range(count):
+        start = num * step
+        end = filesize - 1 if num == count - 1 else start + step - 1
+        segments.append(Segment(start, end))
+    return segments
+
+
+def __load_state(statefile, partfile, filesize):
+    """reads the saved segments of an earlier attempt
+
+    :returns: list of Segment or None if there is nothing to resume
+    """
+    if not os.path.exists(statefile) or not os.path.exists(partfile):
+        return None
+    try:
+        with open(statefile, 'r') as state:
+            data = json.load(state)
+    except (IOError, ValueError):
+        LOG.warn('cant read download state %s', statefile, exc_info=True)
+        return None
+    if data.get('size') != filesize:
+        LOG.info('remote file changed since %s was saved', statefile)
+        return None
+    return [Segment(*seg) for seg in data.get('segments')]
+
+
+def __save_state(statefile, filesize, segments):
+    """writes the segment progress next to the part file"""
+    data = {'size': filesize,
+            'segments': [seg.snapshot() for seg in segments]}
+    temp = statefile[:-len(STATE_SUFFIX)] + STATE_TEMP_SUFFIX
+    with open(temp, 'w') as state:
+        json.dump(data, state)
+    os.rename(temp, statefile)
+
+
+def __discard(partfile, statefile):
+    """removes the part and state files of a transfer"""
+    for path in (partfile, statefile):
+        try:
+            os.remove(path)
+        except OSError:
+            LOG.error('cant remove %s', path, exc_info=True)
@@ -0,0 +1,139 @@
+"""the in-memory representation of the put.io account tree
+
+The tree is a dict of name -> RemoteItem per directory. Items are slotted
+and listings of unchanged directories are carried over between crawls, so
+a large account costs little more than its names in memory.
+"""
+
+import os
+
+PUTIO_DIR_FTP = 0
+# can be ebooks like .epub or .mobi
+PUTIO_DATA_FTP = 1
+PUTIO_AUDIO_FTP = 2
+PUTIO_VIDEO_FTP = 3
+PUTIO_IMAGE_FTP = 4
+PUTIO_ARCHIVE_FTP = 5
+PUTIO_PDF_FTP = 6
+PUTIO_TEXT_FTP = 8
+
+
+class RemoteItem(object):
+
+    """A remote dir or file"""
+
+    __slots__ = ('name', 'size', 'itemid', 'dirtree', 'crc32', 'parentid')
+
+    def __init__(self, name, size, itemid, dirtree, crc32=None, parentid=0):
+        """constructor"""
+        self.name = name
+        self.size = size
+        self.itemid = itemid
+        self.dirtree = dirtree
+        self.crc32 = crc32
+        self.parentid = parentid
+
+    def isdir(self):
+        """is this item a directory?"""
+        return self.dirtree is not None
+
+    def __str__(self):
+        """tostring"""
+        itemtype = 'Directory' if self.isdir() else 'File'
+        return "%s('%s', size=%d, id=%d)" % (
+            itemtype, self.name, self.size, self.itemid)
+
+    def __repr(self):
+        """representation"""
+        return self.__str__()
+
+
+def iteritems(tree):
+    """walks a tree depth first yielding every RemoteItem in it"""
+    pending = [tree]
+    while pending:
+        for remoteitem in pending.pop().itervalues():
+            if remoteitem is None:
+                continue
+            yield remoteitem
+            if remoteitem.dirtree:
+                pending.append(remoteitem.dirtree)
+
+
+def listing_size(listing):
+    """the size of the items of a directory listing"""
+    return sum(remoteitem.size for remoteitem in listing.itervalues()
+               if remoteitem is not None)
+
+
+def iterpaths(tree, root='/'):
+    """walks a tree yielding (abspath, RemoteItem) pairs
+
+    abspath follows the EXCLUDE_LIST notation, '//movies' for a top level
+    directory named movies
+    """
+    pending = [(root, tree)]
+    while pending:
+        parent, subtree = pending.pop()
+        for name, remoteitem in subtree.iteritems():
+            if remoteitem is None:
+                continue
+            abspath = parent + '/' + name
+            yield abspath, remoteitem
+            if remoteitem.dirtree:
+                pending.append((abspath, remoteitem.dirtree))
+
+
+def locations(tree):
+    """maps the id of every item in the tree to (parent id, name)
+
+    the names are shared with the tree, unlike full paths
+    """
+    return dict((remoteitem.itemid, (remoteitem.parentid, remoteitem.name))
+                for remoteitem in iteritems(tree))
+
+
+def relpath(index, itemid):
+    """the path of an item relative to the mirror root, '' for the root
+
+    :index: the locations() of a tree
+    :returns: the path, None if the item or a parent isn't in index
+    """
+    names = []
+    while itemid:
+        location = index.get(itemid)
+        if location is None:
+            return None
+        itemid, name = location
+        names.append(name)
+    return os.path.join(*reversed(names)) if names else ''
+
+
+def moves(before, after):
+    """finds the items whose path changed between two location indexes
+
+    the content of a moved directory moves along with it, so an item is
+    only reported when its own parent or name changed
+
+    :before: locations of the previous tree
+    :after: locations of the current tree
+    :returns: list of (oldpath, newpath) in the order they are applied
+    """
+    moved = []
+    for itemid, location in after.iteritems():
+        previous = before.get(itemid)
+        if previous is None or previous == location:
+            continue
+        oldparent, oldname = previous
+        # the old parent was moved already if it moved too
+        parentpath = relpath(after, oldparent)
+        if parentpath is None:
+            parentpath = relpath(before, oldparent)
+        newpath = relpath(after, itemid)
+        depth = relpath(before, itemid)
+        if parentpath is None or newpath is None or depth is None:
+            continue
+        moved.append((depth.count(os.sep),
+                      os.path.join(parentpath, oldname), newpath))
+    moved.sort()
+    return [(oldpath, newpath) for _, oldpath, newpath in moved]
@@ -7,29 +7,55 @@ directories and files that no longer exist.
 """
 
 import os
-import re
 from sync_logging import LOG
 from sync_config import OAUTH_TOKEN_SYMMETRIC_ARMOR_BASE64
 from sync_config import OAUTH_TOKEN
 from sync_config import PARALLEL_DOWNLOADS
+from sync_config import DOWNLOAD_ORDER
+from sync_config import DOWNLOAD_FOLDER_PRIORITIES
+from sync_config import URL_PREFETCH
 from sync_config import CONNECTIONS_PER_DOWNLOAD
+from sync_config import MAX_OPEN_CONNECTIONS
+from sync_config import ADAPTIVE_CONNECTIONS
+from sync_config import DOWNLOADER
+from sync_config import VERIFY_MIRROR_ON_START
+from sync_config import VERIFY_WORKERS
 from sync_config import LOCAL_MIRROR_ROOT
 from sync_config import MAX_DOWNLOAD_SPEED_BYTES_PER_SECOND
-from sync_config import EXCLUDE_LIST
+from sync_config import BANDWIDTH_SCHEDULE
+from sync_config import CRAWL_CONCURRENCY
+from sync_config import TREE_CACHE_FILE
+from sync_config import POLL_MIN_SECONDS
+from sync_config import POLL_MAX_SECONDS
+from sync_config import CONTROL_SOCKET
+from sync_config import SYNC_MODE
+from sync_config import STREAM_DOWNLOADS
+from sync_config import ZIP_BUNDLE_MAX_FILE_SIZE
+from sync_config import ZIP_BUNDLE_MIN_FILES
+from sync_config import ZIP_BUNDLE_MAX_FILES
+from sync_config import DEDUPE
+from sync_config import TRASH_RETENTION_SECONDS
+from sync_config import TRASH_PURGE_FILES_PER_SECOND
+from sync_config import EVENTS_FULL_CRAWL_SECONDS
+from sync_config import METRICS_PORT
 import exit_helper
 import sync_utils
-import putio_api
-import commands
-
-PUTIO_DIR_FTP = 0
-# can be ebooks like .epub or .mobi
-PUTIO_DATA_FTP = 1
-PUTIO_AUDIO_FTP = 2
-PUTIO_VIDEO_FTP = 3
-PUTIO_IMAGE_FTP = 4
-PUTIO_ARCHIVE_FTP = 5
-PUTIO_PDF_FTP = 6
-PUTIO_TEXT_FTP = 8
+import download_scheduler
+import tree_cache
+import tree_crawler
+import events_feed
+import remote_tree
+import ranged_download
+import checksum
+import local_index
+import disk_space
+import poll_scheduler
+import stream_diff
+import zip_bundle
+import dedupe
+import trash
+import metrics
+import time
 
 
 def __sync_account(conf):
@@ -48,180 +74,294 @@ def __sync_account(conf):
     if not os.path.exists(localdir):
         os.makedirs(localdir)
 
-    putio_dirtree = {}
-    while True:
-        try:
-            sync_utils.suspend_until_can_store_all(conf)
-            LOG.info('sync loop iteration started')
-            files_to_dirs = {}
-            putio_dirtree = __get_putio_files(conf, 0, putio_dirtree)
-            __create_local_dirs(
-                conf.get('localdir'),
-                putio_dirtree,
-                files_to_dirs)
-
-            for remoteitem, targetdir in files_to_dirs.iteritems():
-                fileid = remoteitem.itemid
-                filesize = remoteitem.size
-                download_url = putio_api.get_download_url(conf, fileid)
-                if download_url:
-                    sync_utils.start_download(
-                        filesize,
-                        download_url,
-                        targetdir,
-                        conf)
-
-        except Exception:
-            LOG.error('sync iteration failed', exc_info=True)
-
-        timenow = __gettimenow()
-        print '\n%s :. waiting...' % timenow
-        
-        sync_utils.suspend_sync()
-
-
-def __create_local_dirs(root, dirtree, files_to_dirs):
+    cache = tree_cache.TreeCache(conf.get('treecache'))
+    cache.open()
+    crawler = tree_crawler.TreeCrawler(conf)
+    putio_dirtree = cache.load()
+    if putio_dirtree and cache.getmeta('exclude_rules') != \
+            crawler.excludes.fingerprint:
+        # unchanged directories are reused without applying the rules
+        LOG.info('exclude list changed, discarding the cached tree')
+        putio_dirtree = {}
+    # where each remote id was mirrored to, used to spot moves and renames
+    placed = remote_tree.locations(putio_dirtree)
+    feed = None
+    if conf.get('syncmode') == 'events':
+        feed = events_feed.EventFeed(conf, cache)
+    scheduler = download_scheduler.DownloadScheduler(conf)
+    scheduler.start()
+    index = local_index.LocalIndex()
+    ledger = disk_space.shared(conf)
+    trashcan = trash.shared(conf)
+    poller = poll_scheduler.PollScheduler(conf)
+    priorities = dict(conf.get('folder_priorities') or {})
+    poller.handle('order', lambda policy: __control_order(scheduler, policy))
+    poller.handle('priority', lambda argument: __control_priority(
+        scheduler, priorities, argument))
+    poller.start()
+    metrics.serve(conf)
+    metrics.STATUS.update(transfers=scheduler.running,
+                          next_poll_seconds=lambda: poller.interval,
+                          iterations=0)
+    verify_pending = conf.get('verify_on_start')
+    try:
+        while True:
+            started = time.time()
+            result = 'failed'
+            try:
+                sync_utils.suspend_until_can_store_all(conf)
+                LOG.info('sync loop iteration started')
+                metrics.STATUS.update(
+                    state='crawling', iteration_started=started)
+                files_to_dirs = {}
+                streamed = {}
+                streaming = None
+                if trashcan:
+                    trashcan.begin()
+                if conf.get('stream_downloads'):
+                    content = None
+                    if conf.get('dedupe'):
+                        content = dedupe.ContentIndex(
+                            localdir, putio_dirtree, placed)
+                    streaming = stream_diff.StreamingDiff(
+                        conf, scheduler, index, placed, content, trashcan)
+                    crawler.listener = streaming.listen
+                crawl_started = time.time()
+                try:
+                    if feed:
+                        putio_dirtree = feed.sync(crawler, putio_dirtree)
+                    else:
+                        putio_dirtree = crawler.crawl(putio_dirtree)
+                finally:
+                    if streaming:
+                        crawler.listener = None
+                        streamed = streaming.finish()
+                metrics.CRAWL_SECONDS.observe(time.time() - crawl_started)
+                meta = feed.meta() if feed else {}
+                meta['exclude_rules'] = crawler.excludes.fingerprint
+                changes = cache.save(putio_dirtree, meta)
+                # files downloading since the crawl, the full pass skips them
+                busy = set(streamed.itervalues())
+
+                current = remote_tree.locations(putio_dirtree)
+                sync_utils.move_files(
+                    localdir, remote_tree.moves(placed, current))
+                placed = current
+
+                __create_local_dirs(
+                    conf.get('localdir'),
+                    putio_dirtree,
+                    files_to_dirs,
+                    index,
+                    ledger,
+                    busy,
+                    trashcan)
+                if verify_pending:
+                    __verify_mirror(conf, putio_dirtree, files_to_dirs, busy)
+                    verify_pending = False
+
+                queued = len(files_to_dirs) + len(streamed)
+                deferred = []
+                if conf.get('dedupe'):
+                    content = dedupe.ContentIndex(
+                        localdir, putio_dirtree, current)
+                    deferred = dedupe.deduplicate(
+                        conf, content, files_to_dirs, streamed)
+                    content = None
+                metrics.STATUS.update(state='downloading',
+                                      files_queued=queued)
+                for bundle in zip_bundle.plan(conf, files_to_dirs):
+                    scheduler.submit(bundle, bundle.members[0][1])
+                for remoteitem, targetdir in files_to_dirs.iteritems():
+                    scheduler.submit(remoteitem, targetdir)
+
+                jobs = scheduler.join()
+                for job in jobs:
+                    index.invalidate(os.path.dirname(job.targetfile))
+                if deferred:
+                    dedupe.link_deferred(conf, deferred)
+                    for _, target, _ in deferred:
+                        index.invalidate(os.path.dirname(target))
+                failed = [job for job in jobs
+                          if job.state != download_scheduler.JOB_DONE]
+                LOG.info('downloaded %d files, %d failed',
+                         len(jobs) - len(failed), len(failed))
+                poller.record(changes + queued)
+                result = 'ok'
+
+            except Exception:
+                LOG.error('sync iteration failed', exc_info=True)
+                poller.record(0)
+                # downloads queued during a failed crawl finish before the
+                # next full pass looks at their files
+                scheduler.join()
+
+            metrics.SYNC_ITERATIONS.labels(result).inc()
+            metrics.STATUS.update(
+                state='waiting', last_result=result,
+                last_iteration_seconds=round(time.time() - started, 3),
+                iterations=metrics.STATUS['iterations'] + 1)
+            timenow = time.strftime('%Y-%m-%d %I:%M:%S')
+            print '\n%s :. waiting %d seconds...' % (timenow, poller.interval)
+
+            poller.wait()
+    finally:
+        scheduler.shutdown()
+        poller.stop()
+        if trashcan:
+            trashcan.stop()
+        cache.close()
+
+
+def __control_order(scheduler, policy):
+    """the 'order <policy>' control command, reorders the queued downloads
+
+    :scheduler: the DownloadScheduler
+    :policy: the new download order
+    :returns: the reply to the command
+    """
+    try:
+        scheduler.reorder(policy.strip())
+    except ValueError as error:
+        return str(error)
+    return 'ok'
+
+
+def __control_priority(scheduler, priorities, argument):
+    """the 'priority <folder> <priority>' control command
+
+    :scheduler: the DownloadScheduler
+    :priorities: the current folder priorities, updated in place
+    :argument: the folder relative to the mirror root and its priority
+    :returns: the reply to the command
+    """
+    try:
+        folder, priority = argument.rsplit(None, 1)
+        priorities[folder.strip('/')] = int(priority)
+    except ValueError:
+        return 'usage: priority <folder> <priority>'
+    scheduler.reorder(priorities=priorities)
+    return 'ok'
+
+
+def __verify_mirror(conf, dirtree, files_to_dirs, busy):
+    """checks the crc32 of the mirrored files, queues the bad ones
+
+    :conf: configuration object
+    :dirtree: the tree fetched from the putio account
+    :files_to_dirs: files already queued, bad files are added to it
+    :busy: targets of the downloads already running
+    :returns: None
+
+    """
+    localdir = conf.get('localdir')
+    targets = {}
+    for relpath, remoteitem in remote_tree.iterpaths(dirtree, ''):
+        target = os.path.join(localdir, *relpath.split('/')[1:])
+        if remoteitem.isdir() or not remoteitem.crc32 or \
+                remoteitem in files_to_dirs or target in busy or \
+                not os.path.exists(target):
+            continue
+        targets[target] = remoteitem
+
+    LOG.info('verifying crc32 of %d mirrored files', len(targets))
+    mismatched = checksum.verify_files(
+        [(target, remoteitem.crc32)
+         for target, remoteitem in targets.iteritems()],
+        conf.get('verify_workers'))
+    for target in mismatched:
+        print '\n [!] %s is corrupt, fetching it again' % target
+        if not sync_utils.native_download(conf, targets[target].crc32):
+            # axel wont overwrite, the native downloader replaces on rename
+            disk_space.shared(conf).removing(target)
+            os.remove(target)
+        files_to_dirs[targets[target]] = target
+
+
+def __create_local_dirs(root, dirtree, files_to_dirs, index, ledger, busy,
+                        trashcan):
     """creates the local dir tree
 
     :conf: configuration object
     :dirtree: the tree fetched from the putio account
     :files_to_dirs: a mapping of file data to the dir the file should
             be downloaded to
+    :index: the LocalIndex caching the listings of the mirror
+    :ledger: the SpaceLedger told about deleted files
+    :busy: targets of the downloads already running, left alone
+    :trashcan: the Trash deleted files go to and are reclaimed from,
+        None to delete them right away
     :returns: None
 
     """
 
-    todelete = os.listdir(root)
+    local = index.listing(root)
+    todelete = set(local).difference(dirtree)
 
     for name, remoteitem in dirtree.iteritems():
-        if name in todelete:
-            todelete.remove(name)
-
         if remoteitem is None:
             print ('Skipping dir %s because no data for it', name)
             LOG.error('skipping dir %s because no data for it', name)
             continue
 
         target = os.path.join(root, name)
+        entry = local.get(name)
         if remoteitem.isdir():
             LOG.debug('inspecting dir: %s', name)
             # this is a directory
-            if os.path.exists(target) and not os.path.isdir(target):
+            if entry and not entry.isdir:
                 LOG.warn(
                     "remote dir and local file conflict" +
                     "removing local file: %s",
                     target)
+                ledger.removing(target)
                 os.remove(target)
+                entry = None
 
-            if not os.path.exists(target):
+            if not entry:
                 LOG.debug('creating dir: %s', target)
                 os.makedirs(target)
+                index.invalidate(root)
 
             if remoteitem.dirtree:
-                __create_local_dirs(target, remoteitem.dirtree, files_to_dirs)
-            elif os.path.exists(target):
-                todelete.append(name)
+                __create_local_dirs(target, remoteitem.dirtree,
+                                    files_to_dirs, index, ledger, busy,
+                                    trashcan)
+            else:
+                todelete.add(name)
+
+        elif target in busy:
+            LOG.debug('already downloading: %s', target)
 
         else:
             LOG.debug('inspecting file: %s', name)
             # this is a normal file
-            exists = os.path.exists(target)
-            if exists and os.path.getsize(target) != remoteitem.size:
+            if entry and (entry.isdir or entry.size != remoteitem.size):
                 LOG.warn('file size != from whats on putio: %s', target)
-                todelete.append(name)
+                todelete.add(name)
                 files_to_dirs[remoteitem] = target
-            elif not exists:
+            elif not entry and trashcan and \
+                    trashcan.reclaim(remoteitem, target):
+                index.invalidate(root)
+            elif not entry:
                 LOG.debug(
                     'file will be downloaded: %s -> %s',
                     remoteitem,
                     target)
                 files_to_dirs[remoteitem] = target
 
-    sync_utils.delete_files(root, todelete)
-
-
-def __get_putio_files(conf, parent_id=0, tree=None, root=None):
-    """fetches the file list from put.io account
-
-    :conf: configuration object
-    :parent_id: the from which to start on the account
-    :returns: a dict of dicts representing the account directory tree
-    """
-    if not tree:
-        tree = {}
-
-    if not root:
-        root = '/'
-
-    data = putio_api.getfiles(conf, parent_id)
-    putio_api.ensure_valid_oauth_token(data)
-    freshtree = {}
-    if data:
-        LOG.debug('got data for file id: %d', parent_id)
-        for remotefile in data.get('files'):
-            filename = remotefile.get('name')
-            filetype = remotefile.get('file_type')
-            fileid = remotefile.get('id')
-            filesize = remotefile.get('size')
-            abspath = root + '/' + filename
-
-            skip = False
-            for exclude in EXCLUDE_LIST:
-                skip = abspath == exclude or re.search(exclude, abspath)
-                if skip:
-                    LOG.info('skipping because exclude rule match (%s ~ %s)',
-                             exclude, abspath)
-                    break
-            if skip:
-                continue
-
-            if filetype == PUTIO_DIR_FTP:
-                cached = tree.get(filename, None)
-                cached_filesize = cached.size if cached else 0
-                if cached:
-                    freshtree[filename] = cached
-
-                if filesize != cached_filesize:
-                    subtree = cached.dirtree if cached else {}
-                    subtree = __get_putio_files(conf, fileid, subtree, abspath)
-                    freshtree[filename] = RemoteItem(
-                        filename, filesize, fileid, subtree)
-                    LOG.debug('mapped directory: %s', freshtree[filename])
-
-            else:
-                filedata = RemoteItem(filename, filesize, fileid, None)
-                LOG.debug('mapped file: %s', filedata)
-                freshtree[filename] = filedata
-
-        tree = freshtree
-
-    return tree
-
-
-class RemoteItem(object):
-
-    """A remote dir or file"""
-
-    def __init__(self, name, size, itemid, dirtree):
-        """constructor"""
-        self.name = name
-        self.size = size
-        self.itemid = itemid
-        self.dirtree = dirtree
-
-    def isdir(self):
-        """is this item a directory?"""
-        return self.dirtree is not None
-
-    def __str__(self):
-        """tostring"""
-        itemtype = 'Directory' if self.isdir() else 'File'
-        return "%s('%s', size=%d, id=%d)" % (
-            itemtype, self.name, self.size, self.itemid)
-
-    def __repr(self):
-        """representation"""
-        return self.__str__()
+    # keep the part files of downloads that will resume or are running,
+    # and the trash
+    todelete = [name for name in todelete
+                if ranged_download.partial_target(name) not in dirtree and
+                not sync_utils.in_flight(os.path.join(root, name), busy) and
+                not (trashcan and
+                     os.path.join(root, name) == trashcan.trashdir)]
+    if todelete:
+        for name in todelete:
+            index.forget(os.path.join(root, name))
+        index.invalidate(root)
+        sync_utils.delete_files(root, todelete, ledger, trashcan)
 
 
 def __getconfig():
@@ -242,16 +382,33 @@ def __getconfig():
 
     return dict(oauthtoken=oauthtoken,
                 parallel_downloads=PARALLEL_DOWNLOADS,
+                download_order=DOWNLOAD_ORDER,
+                folder_priorities=DOWNLOAD_FOLDER_PRIORITIES,
+                url_prefetch=URL_PREFETCH,
+                downloader=DOWNLOADER,
                 conn_per_downloads=CONNECTIONS_PER_DOWNLOAD,
+                max_connections=MAX_OPEN_CONNECTIONS,
+                adaptive_connections=ADAPTIVE_CONNECTIONS,
+                verify_on_start=VERIFY_MIRROR_ON_START,
+                verify_workers=VERIFY_WORKERS,
+                crawl_concurrency=CRAWL_CONCURRENCY,
                 localdir=LOCAL_MIRROR_ROOT,
-                bytes_per_second=MAX_DOWNLOAD_SPEED_BYTES_PER_SECOND)
-
-def __gettimenow():
-    try:
-        time = commands.getstatusoutput(''' echo $(date +"%F %I:%M:%S") ''')
-        return time[1]
-    except KeyboardInterrupt:
-        exit_helper.exit_interrupted()
+                treecache=TREE_CACHE_FILE,
+                poll_min_seconds=POLL_MIN_SECONDS,
+                poll_max_seconds=POLL_MAX_SECONDS,
+                control_socket=CONTROL_SOCKET,
+                syncmode=SYNC_MODE,
+                stream_downloads=STREAM_DOWNLOADS,
+                bundle_max_file_size=ZIP_BUNDLE_MAX_FILE_SIZE,
+                bundle_min_files=ZIP_BUNDLE_MIN_FILES,
+                bundle_max_files=ZIP_BUNDLE_MAX_FILES,
+                dedupe=DEDUPE,
+                trash_retention=TRASH_RETENTION_SECONDS,
+                trash_purge_rate=TRASH_PURGE_FILES_PER_SECOND,
+                full_crawl_seconds=EVENTS_FULL_CRAWL_SECONDS,
+                bytes_per_second=MAX_DOWNLOAD_SPEED_BYTES_PER_SECOND,
+                bandwidth_schedule=BANDWIDTH_SCHEDULE,
+                metrics_port=METRICS_PORT)
 
 def __readargs():
     try:
@@ -260,8 +417,10 @@ def __readargs():
         print '\n------------------'
         print "... PutIO/Sync ..."
         print '\n------------------'
-        print "Minimum Reserved: \t%i" % sync_utils.min_space_to_reserve()
-        print "Available Disk Space: \t%i" % sync_utils.total_free_space()
+        print "Minimum Reserved: \t%i" % \
+            sync_utils.min_space_to_reserve(conf)
+        print "Available Disk Space: \t%i" % \
+            sync_utils.total_free_space(conf)
         print "Local Sync Dir: \t"+conf.get('localdir')
         __sync_account(conf)
     except KeyboardInterrupt:
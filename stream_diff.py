@@ -0,0 +1,160 @@
+"""starts downloads while the crawl is still running
+
+The crawler hands every directory listing to a StreamingDiff as soon as
+it is mapped. Files of the listing that are missing from the mirror are
+queued for download right away, instead of after the whole account was
+crawled and compared.
+
+Only the safe cases are handled this early. The full pass over the tree
+after the crawl still creates new directories, deletes, moves and
+replaces files, and leaves the files queued here alone. A listing is
+skipped when its directory was moved or renamed since the last
+iteration, and so is a file that was moved into the directory from
+elsewhere. Downloading those would defeat the rename that moves the
+local copy along. A new directory is streamed when the one it was
+created in is.
+"""
+
+import os
+import threading
+import Queue
+from sync_logging import LOG
+import remote_tree
+import zip_bundle
+import dedupe
+
+# listings waiting for the diff, the crawl waits when there are more
+LISTING_QUEUE_SIZE = 64
+
+
+class StreamingDiff(object):
+
+    """Queues the downloads of directory listings as they arrive"""
+
+    def __init__(self, conf, scheduler, index, placed, content=None,
+                 trashcan=None):
+        """constructor
+
+        :conf: configuration object
+        :scheduler: the DownloadScheduler the files are submitted to
+        :index: the LocalIndex of the mirror
+        :placed: locations() of the tree of the previous iteration
+        :content: optional dedupe.ContentIndex of the mirror, files with
+            a copy in it are linked rather than downloaded
+        :trashcan: optional Trash files deleted earlier are taken back from
+        """
+        self.conf = conf
+        self.localdir = conf.get('localdir')
+        self.scheduler = scheduler
+        self.index = index
+        self.placed = placed
+        self.content = content
+        self.trashcan = trashcan
+        # content key -> target of the first queued file with that
+        # content, and the targets, which are no copies to link to yet
+        self.__fetching = {}
+        self.__targets = set()
+        # remoteitem -> target of every file queued so far
+        self.queued = {}
+        # dirid -> id of the directory it was listed in, and dirid -> was
+        # the directory found stable, parents are compared first
+        self.__parents = {}
+        self.__verdicts = {0: True}
+        self.__listings = Queue.Queue(LISTING_QUEUE_SIZE)
+        self.__thread = threading.Thread(target=self.__work, name='diff')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def listen(self, dirid, abspath, listing):
+        """takes a listing from the crawler, blocks while the queue is full
+
+        :dirid: the id of the listed directory, 0 for the root
+        :abspath: its path in the account, '/' for the root
+        :listing: dict of name -> RemoteItem
+        """
+        self.__listings.put((dirid, abspath, listing))
+
+    def finish(self):
+        """waits for the queued listings to be compared
+
+        :returns: dict of remoteitem -> target of the queued files
+        """
+        self.__listings.put(None)
+        self.__thread.join()
+        LOG.info('queued %d downloads during the crawl', len(self.queued))
+        return self.queued
+
+    def __work(self):
+        """diff loop: compares listings until a None arrives"""
+        while True:
+            job = self.__listings.get()
+            if job is None:
+                return
+            try:
+                self.__compare(*job)
+            except Exception:
+                # the full pass after the crawl covers this directory
+                LOG.error('cant compare listing of %s', job[1], exc_info=True)
+
+    def __stable(self, dirid, relpath):
+        """is the directory where it was in the last iteration?"""
+        if not self.placed or not dirid:
+            return True
+        known = remote_tree.relpath(self.placed, dirid)
+        if known is not None:
+            return known == relpath
+        # new since the last iteration, safe unless its parent moved
+        return self.__verdicts.get(self.__parents.get(dirid), False)
+
+    def __compare(self, dirid, abspath, listing):
+        """queues the files of a listing that are missing locally"""
+        relpath = os.path.join(*abspath.strip('/').split('/'))
+        for remoteitem in listing.itervalues():
+            if remoteitem is not None and remoteitem.isdir():
+                self.__parents[remoteitem.itemid] = dirid
+        stable = self.__verdicts[dirid] = self.__stable(dirid, relpath)
+        if not stable:
+            LOG.debug('%s moved, leaving it to the full pass', abspath)
+            return
+
+        root = os.path.join(self.localdir, relpath)
+        if not os.path.isdir(root):
+            if os.path.lexists(root):
+                return
+            os.makedirs(root)
+            self.index.invalidate(os.path.dirname(root))
+
+        local = self.index.listing(root)
+        missing = {}
+        for name, remoteitem in listing.items():
+            if remoteitem is None or remoteitem.isdir() or name in local:
+                continue
+            location = self.placed.get(remoteitem.itemid)
+            if location is not None and location != (dirid, name):
+                # moved here, the full pass moves the local copy
+                continue
+            target = os.path.join(root, name)
+            if self.trashcan and self.trashcan.reclaim(remoteitem, target):
+                self.index.invalidate(root)
+                continue
+            if self.content is not None:
+                key = dedupe.content_key(remoteitem)
+                if key is not None and key in self.__fetching:
+                    # the full pass links it once the copy is downloaded
+                    continue
+                source = self.content.source(remoteitem, self.__targets)
+                if source and dedupe.link(self.conf, source, target):
+                    self.index.invalidate(root)
+                    continue
+                if key is not None:
+                    self.__fetching[key] = target
+                    self.__targets.add(target)
+            LOG.debug('file will be downloaded: %s -> %s',
+                      remoteitem, target)
+            self.queued[remoteitem] = target
+            missing[remoteitem] = target
+
+        for bundle in zip_bundle.plan(self.conf, missing):
+            self.scheduler.submit(bundle, bundle.members[0][1])
+        for remoteitem, target in missing.iteritems():
+            self.scheduler.submit(remoteitem, target)
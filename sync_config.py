@@ -13,6 +13,41 @@ import os
 # ~/PutIO
 LOCAL_MIRROR_ROOT = os.path.join(os.path.expanduser('~'), 'PutIO')
 
+# the remote tree is cached here between runs so a restart only lists
+# directories that changed on put.io, must not be inside LOCAL_MIRROR_ROOT
+TREE_CACHE_FILE = os.path.join(
+    os.path.expanduser('~'), '.putiosync', 'tree.sqlite')
+
+# the wait between two polls of put.io, it drops to the minimum after
+# changes were found and doubles while the account is idle
+POLL_MIN_SECONDS = 15
+POLL_MAX_SECONDS = 15 * 60
+
+# unix socket to trigger a poll right away: echo sync | nc -U <path>
+# (sending SIGUSR1 to the process does the same), None to disable
+CONTROL_SOCKET = os.path.join(
+    os.path.expanduser('~'), '.putiosync', 'control.sock')
+
+# counters and histograms of the sync are served for prometheus on
+# http://127.0.0.1:<port>/metrics and a json status on /status when a
+# port is set, e.g. METRICS_PORT = 9136. None serves nothing
+METRICS_PORT = None
+
+# the log file and its level: 'DEBUG', 'INFO', 'WARNING' or 'ERROR'
+LOG_FILE = './putio_sync.log'
+LOG_LEVEL = 'DEBUG'
+# write one json object per line instead of plain text
+LOG_JSON = False
+# the log is rotated when it grows past LOG_ROTATE_BYTES, or at the times
+# given by LOG_ROTATE_WHEN if set ('midnight', 'h', 'W0'...), keeping
+# LOG_BACKUPS old files
+LOG_ROTATE_BYTES = 50 * 1024 * 1024
+LOG_ROTATE_WHEN = None
+LOG_BACKUPS = 5
+# share of the DEBUG records written, lower it on large accounts or set
+# LOG_LEVEL = 'INFO' to skip the per-file crawl lines entirely
+LOG_DEBUG_SAMPLE = 1.0
+
 # is the oauth token encrypted in armor format then base64 encoded
 OAUTH_TOKEN_SYMMETRIC_ARMOR_BASE64 = False
 
@@ -20,19 +55,109 @@ OAUTH_TOKEN_SYMMETRIC_ARMOR_BASE64 = False
 # (you most likely as the consumer of this script)
 OAUTH_TOKEN = 'XXXXXX'
 
+# the put.io api endpoint, can point to a local stand-in server for testing
+PUTIO_API_URL = 'https://api.put.io/v2'
+
+# how changes on put.io are detected:
+# 'crawl'  - list every directory whose size changed since the last iteration
+# 'events' - only list the directories touched by the account events feed,
+#            with a full crawl every EVENTS_FULL_CRAWL_SECONDS to pick up
+#            deletes and renames which the feed doesn't report
+SYNC_MODE = 'crawl'
+EVENTS_FULL_CRAWL_SECONDS = 6 * 60 * 60
+
+# files and directories gone from put.io are deleted right away. when set,
+# e.g. to 24 * 60 * 60, they are moved into LOCAL_MIRROR_ROOT/.putiosync-trash
+# instead and removed in the background after TRASH_RETENTION_SECONDS. a file
+# that comes back on put.io in the meantime is taken back from there, until
+# then the trash takes up disk space
+TRASH_RETENTION_SECONDS = None
+# how many files the background removal deletes per second, 0 for no limit
+TRASH_PURGE_FILES_PER_SECOND = 200
+
+# start downloading new files of a directory as soon as it is listed,
+# rather than after the whole account was crawled
+STREAM_DOWNLOADS = False
+
 # how many files to download in parallel
 PARALLEL_DOWNLOADS = 1
 
-# for each download how many connections to employ
+# files up to ZIP_BUNDLE_MAX_FILE_SIZE bytes are fetched as one zip that
+# put.io builds of up to ZIP_BUNDLE_MAX_FILES of them, when a directory
+# has at least ZIP_BUNDLE_MIN_FILES to download. saves a download url and
+# a connection per file in folders of subtitles or photos, e.g.
+# ZIP_BUNDLE_MAX_FILE_SIZE = 1024 * 1024. None fetches every file alone
+ZIP_BUNDLE_MAX_FILE_SIZE = None
+ZIP_BUNDLE_MIN_FILES = 5
+ZIP_BUNDLE_MAX_FILES = 200
+
+# a file with the size and crc32 of one already in the mirror isn't
+# downloaded but made from that copy:
+# 'hardlink' - both names are the same file, editing one in place
+#              changes the other too, falls back to reflink
+# 'reflink'  - copy on write clone on btrfs or xfs, falls back to copy
+# 'copy'     - a plain copy, saves only the download
+# None to download every copy
+DEDUPE = None
+
+# which queued file is downloaded next:
+# 'fifo'     - in the order they were found, as before
+# 'smallest' - smallest first, a large upload doesnt hold back small files
+# 'newest'   - most recently added to put.io first
+# 'fair'     - one file of each top level folder in turn
+# change it while the sync runs with: echo order newest | nc -U <socket>
+DOWNLOAD_ORDER = 'fifo'
+
+# folders relative to LOCAL_MIRROR_ROOT whose files are downloaded before
+# any other, the higher the sooner, e.g. {'tv/current': 10, 'movies': 5}
+# change it while the sync runs with:
+# echo priority tv/current 20 | nc -U <socket>
+DOWNLOAD_FOLDER_PRIORITIES = {}
+
+# which program downloads the files:
+# 'axel'   - the axel download manager, must be installed. files put.io
+#            lists a crc32 for are still fetched natively, their crc32 is
+#            checked as they arrive instead of reading them again
+# 'native' - built in, resumes interrupted downloads where they stopped
+DOWNLOADER = 'axel'
+
+# check the crc32 of every file already in the mirror when the sync starts,
+# files that dont match put.io are fetched again
+VERIFY_MIRROR_ON_START = False
+# how many files are checked at the same time
+VERIFY_WORKERS = 2
+
+# how many download urls are resolved ahead of the running downloads
+URL_PREFETCH = 4
+
+# for each download the most connections to employ, a download opens one
+# per 4MB of the file and learns how many each cdn host serves best
 CONNECTIONS_PER_DOWNLOAD = 10
+# the most connections of all parallel downloads together, 0 for no cap
+MAX_OPEN_CONNECTIONS = 16
+# False to give every large download CONNECTIONS_PER_DOWNLOAD connections
+ADAPTIVE_CONNECTIONS = True
 
-# maximum download speed ( mb * 1024 * 1024) by default
+# how many directories are listed on put.io at the same time
+CRAWL_CONCURRENCY = 4
+
+# maximum download speed ( mb * 1024 * 1024) by default, shared by all
+# parallel downloads, 0 for unlimited
 MAX_DOWNLOAD_SPEED_BYTES_PER_SECOND = 2 * 1024 * 1024
 
+# time windows (local time) with their own maximum download speed, outside
+# of them MAX_DOWNLOAD_SPEED_BYTES_PER_SECOND applies. the native downloader
+# follows a new window right away, axel is restarted at its new rate within
+# a few seconds
+# e.g. throttle office hours, full speed at night:
+# BANDWIDTH_SCHEDULE = [('09:00', '18:00', 512 * 1024),
+#                       ('22:00', '07:00', 0)]
+BANDWIDTH_SCHEDULE = []
+
 # put here names of dirs in the putio account that you dont want synced
 # possible values:
 # 1. absolute paths prefixed by two forward slashes e.g. //movies/spiderman.mkv
-# 2. python regular expression, e.g. *.txt, somefile
+# 2. python regular expression, e.g. \.txt$, somefile
 #
 EXCLUDE_LIST = ['//unsorted']
 # or as list...
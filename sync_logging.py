@@ -1,11 +1,142 @@
 """
 this module is imported by the main script to get logging setup
+
+Records are handed to a background thread which formats and writes them,
+so logging never waits for the disk. The file is rotated by size, or by
+time when LOG_ROTATE_WHEN is set, and can be written as json lines.
 """
 
+import atexit
+import json
 import logging
+import logging.handlers
+import random
+import threading
+import time
+import Queue
+from sync_config import LOG_FILE
+from sync_config import LOG_LEVEL
+from sync_config import LOG_JSON
+from sync_config import LOG_ROTATE_BYTES
+from sync_config import LOG_ROTATE_WHEN
+from sync_config import LOG_BACKUPS
+from sync_config import LOG_DEBUG_SAMPLE
 
-__LOGFILE = './putio_sync.log'
-__LEVEL = 'DEBUG'
 __FORMAT = '%(asctime)s - [%(levelname)s] %(funcName)s: %(message)s'
-logging.basicConfig(format=__FORMAT, filename=__LOGFILE, level=__LEVEL)
+# records waiting for the writer, more are dropped rather than block
+QUEUE_SIZE = 10000
+
+
+class JsonFormatter(logging.Formatter):
+
+    """Formats a record as one json object per line"""
+
+    def format(self, record):
+        """the json line of a record"""
+        entry = {'time': time.strftime(
+                     '%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'func': record.funcName,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
+
+
+class DebugSampler(logging.Filter):
+
+    """Keeps only a share of the debug records"""
+
+    def __init__(self, share):
+        """constructor
+
+        :share: between 0 and 1, the share of debug records kept
+        """
+        logging.Filter.__init__(self)
+        self.share = share
+
+    def filter(self, record):
+        """False for the debug records that are left out"""
+        return record.levelno != logging.DEBUG or \
+            random.random() < self.share
+
+
+class AsyncHandler(logging.Handler):
+
+    """Queues records for a writer thread that passes them to a handler"""
+
+    def __init__(self, target, size=QUEUE_SIZE):
+        """constructor
+
+        :target: the handler that formats and writes the records
+        :size: how many records may wait, more are dropped
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.__write, name='log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        """queues a record, the message is formatted by the writer"""
+        if record.exc_info:
+            # the traceback has to be rendered while it still exists
+            record.exc_text = self.target.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """writes the queued records and stops the writer"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+    def __write(self):
+        """writer loop: writes records until a None arrives"""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord({
+                    'name': record.name,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'funcName': 'emit',
+                    'msg': 'log queue full, dropped %d records',
+                    'args': (dropped,)}))
+            self.target.handle(record)
+
+
+def __filehandler():
+    """the rotating file handler configured in sync_config"""
+    if LOG_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS)
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_ROTATE_BYTES, backupCount=LOG_BACKUPS)
+    handler.setFormatter(
+        JsonFormatter() if LOG_JSON else logging.Formatter(__FORMAT))
+    return handler
+
+
 LOG = logging.getLogger()
+LOG.setLevel(LOG_LEVEL)
+__HANDLER = AsyncHandler(__filehandler())
+if LOG_DEBUG_SAMPLE < 1:
+    __HANDLER.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+LOG.addHandler(__HANDLER)
+atexit.register(__HANDLER.close)
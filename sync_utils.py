@@ -6,11 +6,18 @@ import shutil
 from base64 import b64decode
 import subprocess
 from subprocess import PIPE
-import binascii
 import putio_api
+import bandwidth
+import ranged_download
+import disk_space
+import connection_policy
+import metrics
 from sync_logging import LOG
 import exit_helper
 
+# axel keeps the progress of a download in <file>.st
+AXEL_STATE_SUFFIX = '.st'
+
 
 def gpgdecode(string):
     """decodes a base64 and symmetric cipher"""
@@ -26,27 +33,25 @@ def gpgdecode(string):
 
 
 def suspend_sync():
-    """simple sleep helper"""
+    """simple sleep helper used while waiting for disk space"""
     sleep_seconds = 60 * 1
     LOG.debug('sleeping for %d seconds', sleep_seconds)
     time.sleep(sleep_seconds)
 
 
-def total_free_space():
-    """total free bytes in the disk"""
-    root = os.statvfs('/')
-    return root.f_bavail * root.f_frsize
+def total_free_space(conf):
+    """total free bytes in the filesystem of the mirror"""
+    return disk_space.shared(conf).free_space()
 
 
-def total_disk_size():
-    """total bytes in the disk"""
-    root = os.statvfs('/')
-    return root.f_blocks * root.f_frsize
+def total_disk_size(conf):
+    """total bytes in the filesystem of the mirror"""
+    return disk_space.shared(conf).disk_size()
 
 
-def min_space_to_reserve():
+def min_space_to_reserve(conf):
     """minimum space on the filesystem after the sync"""
-    return total_disk_size() * 0.1
+    return disk_space.shared(conf).min_space_to_reserve()
 
 
 def putio_root_size(conf):
@@ -63,41 +68,43 @@ def suspend_until_can_store_all(conf):
     :returns:
     """
     LOG.info('ensuring enough space in filesystem')
+    ledger = disk_space.shared(conf)
     while True:
-        localsize = os.path.getsize(conf.get('localdir'))
         # we don't account for local size because it's replaced if necessary
-        free_space = total_free_space() + localsize
+        free_space = ledger.available() + ledger.mirror_size()
         putio_size = putio_root_size(conf)
-        if free_space - min_space_to_reserve() < putio_size:
-            print '\n[!] Suspending Sync: not enough space to sync local: %d remote: %d ' % free_space,putio_size
+        if free_space < putio_size:
+            print '\n[!] Suspending Sync: not enough space to sync ' \
+                'local: %d remote: %d ' % (free_space, putio_size)
             LOG.warn('not enough space to sync local: %d remote: %d',
                      free_space,
                      putio_size)
+            metrics.SPACE_SUSPENSIONS.labels('account').inc()
+            if ledger.trashcan:
+                ledger.trashcan.empty()
             suspend_sync()
         else:
             break
 
 
-def suspend_until_can_store_file(filesize, targetfile):
-    """suspends execution until filesystem can store targetfile"""
-    while True:
-        if total_free_space() - min_space_to_reserve() < filesize:
-            print '\n[!] Suspending Sync: not enough free space to download:\n %s' % targetfile
-            LOG.warn('not enough free space to download: %s',
-                     targetfile)
-            suspend_sync()
-        else:
-            break
-
+def delete_files(root, files, ledger=None, trash=None):
+    """deletes files and direcotries that exist locally but not in put.io
 
-def delete_files(root, files):
-    """deletes files and direcotries that exist locally but not in put.io"""
+    :ledger: optional SpaceLedger told about the space freed, the trash
+        tells it about the files moved there once it purges them
+    :trash: optional Trash the files are moved into, they are deleted
+        right away if it is None or they cant be moved
+    """
     for target in files:
         abspath = os.path.join(root, target)
         print '\n [!] Deleting %s since its not in the putio account' % abspath
         LOG.info('deleting %s since its not in the putio account',
                  abspath)
-        if os.path.exists(abspath):
+        if os.path.lexists(abspath):
+            if trash and trash.condemn(abspath):
+                continue
+            if ledger:
+                ledger.removing(abspath)
             try:
                 if os.path.isdir(abspath):
                     shutil.rmtree(abspath)
@@ -112,20 +119,129 @@ def delete_files(root, files):
                 abspath)
 
 
-def start_download(filesize, download_url, targetfile, conf):
-    """downloads the file"""
-    suspend_until_can_store_file(filesize, targetfile)
-    bps = conf.get('bytes_per_second')
-    connections = conf.get('conn_per_downloads')
+def move_files(root, moves):
+    """renames local files and directories that were moved on put.io
 
-    print '\nStarting download :%s' % download_url
-    LOG.info('starting download :%s into %s', download_url, targetfile)
+    :root: the local mirror root
+    :moves: list of (oldpath, newpath) relative to root, parents first
+    :returns: None
+    """
+    for oldpath, newpath in moves:
+        source = os.path.join(root, oldpath)
+        target = os.path.join(root, newpath)
+        if not os.path.exists(source):
+            # never synced, or already moved along with its parent
+            continue
+        if os.path.exists(target):
+            LOG.debug('not moving %s, %s already exists', source, target)
+            continue
+
+        print '\n [!] Moving %s to %s since it moved in the putio account' % (
+            source, target)
+        LOG.info('moving %s to %s since it moved in the putio account',
+                 source, target)
+        try:
+            parent = os.path.dirname(target)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            os.rename(source, target)
+        except OSError:
+            print '\n [E] Cant move %s' % source
+            LOG.error('cant move %s to %s', source, target, exc_info=True)
+
+
+def in_flight(path, targets):
+    """is path the target of one of the downloads, or its axel state?"""
+    if path.endswith(AXEL_STATE_SUFFIX):
+        path = path[:-len(AXEL_STATE_SUFFIX)]
+    return path in targets
+
+
+def native_download(conf, crc32):
+    """is a file with this crc32 fetched by the native downloader?
+
+    axel cant check a crc32 without reading the whole file again, files
+    put.io lists one for are checked segment by segment as they arrive
+    """
+    return conf.get('downloader') == 'native' or bool(crc32)
+
+
+def start_download(filesize, download_url, targetfile, conf, stop=None,
+                   crc32=None):
+    """downloads the file
+
+    :stop: optional threading.Event, when set the transfer is aborted
+    :crc32: expected crc32 hex string as listed by put.io, if known
+    :returns: True if the file was downloaded completely
+    """
+    writepath = targetfile
+    if native_download(conf, crc32):
+        writepath = targetfile + ranged_download.PART_SUFFIX
+    ledger = disk_space.shared(conf)
+    reservation = ledger.reserve(filesize, targetfile, writepath, stop)
+    if reservation is None:
+        return False
+
+    policy = connection_policy.shared(conf)
+    # bytes an earlier attempt left behind aren't fetched again
+    missing = max(0, filesize - disk_space.allocated(writepath))
+    grant = policy.acquire(download_url, missing, stop)
+    if grant is None:
+        ledger.release(reservation, False)
+        return False
+
+    done = False
+    succeeded = None
+    try:
+        done = __download(filesize, download_url, targetfile, conf, stop,
+                          crc32, grant.count)
+        if not (stop and stop.is_set()):
+            succeeded = done
+    finally:
+        policy.release(grant, missing, succeeded)
+        ledger.release(reservation, done)
+    return done
+
+
+def __download(filesize, download_url, targetfile, conf, stop, crc32,
+               connections):
+    """runs the downloader, see start_download
+
+    :connections: how many connections the transfer may open
+    """
+    if native_download(conf, crc32):
+        return ranged_download.download(
+            filesize, download_url, targetfile, conf, stop, crc32,
+            connections)
+
+    # axel takes a fixed rate, it runs at its share of the current limit
+    # and is restarted when the share changes, it resumes from its state
+    governor = bandwidth.shared(conf)
+    governor.started()
+    try:
+        done = __run_axel(download_url, targetfile, stop, connections,
+                          governor)
+    finally:
+        governor.finished()
+    if done and (not os.path.exists(targetfile) or
+                 os.path.getsize(targetfile) != filesize):
+        # the file stays until the native downloader replaced it
+        LOG.error('axel download %s has the wrong size, fetching it again',
+                  targetfile)
+        done = ranged_download.download(
+            filesize, download_url, targetfile, conf, stop, None,
+            connections)
+    return done
+
+
+def __start_axel(download_url, targetfile, connections, bps):
+    """starts axel at the rate of bps"""
     cmd = 'axel -o %s -n %d -a -s %d %s' % (targetfile,
                                             connections,
                                             bps,
                                             download_url)
     LOG.debug('running axel: %s', cmd)
-    axel = subprocess.Popen(
+    return subprocess.Popen(
         ['axel',
          '-o',
          targetfile,
@@ -136,12 +252,38 @@ def start_download(filesize, download_url, targetfile, conf):
          str(connections),
          download_url])
 
+
+def __run_axel(download_url, targetfile, stop, connections, governor):
+    """downloads with axel, see start_download"""
+    print '\nStarting download :%s' % download_url
+    LOG.info('starting download :%s into %s', download_url, targetfile)
+    bps = governor.share()
+    axel = __start_axel(download_url, targetfile, connections, bps)
+
     currsize = os.path.getsize(targetfile) if os.path.exists(targetfile) else 0
     pollinterval = 5
-    time.sleep(pollinterval)
+    wait = stop.wait if stop else time.sleep
+    wait(pollinterval)
     remaining_attempts = 3
     while axel.poll() is None:
-        time.sleep(pollinterval)
+        wait(pollinterval)
+        if stop and stop.is_set():
+            LOG.info('download of %s interrupted, stopping axel', targetfile)
+            axel.kill()
+            axel.wait()
+            return False
+
+        share = governor.share()
+        if share != bps and axel.poll() is None:
+            LOG.info('rate of %s is now %d bytes/s, restarting axel',
+                     targetfile, share)
+            # axel saves its state when terminated
+            axel.terminate()
+            axel.wait()
+            bps = share
+            axel = __start_axel(download_url, targetfile, connections, bps)
+            continue
+
         progress = os.path.getsize(targetfile) - currsize
         currsize = currsize + progress
         if progress == 0:
@@ -149,8 +291,9 @@ def start_download(filesize, download_url, targetfile, conf):
                      pollinterval)
             if remaining_attempts == 0:
                 LOG.error('axel seems totally stuck, aborting')
+                metrics.DOWNLOAD_STALLS.labels('axel').inc()
                 axel.kill()
-                return
+                return False
 
             remaining_attempts = remaining_attempts - 1
             pollinterval = pollinterval * 2
@@ -162,46 +305,6 @@ def start_download(filesize, download_url, targetfile, conf):
             'download %s failed with code: %d',
             download_url,
             returncode)
-        return
-
-    if os.path.exists(targetfile):
-        if os.path.getsize(targetfile) != filesize:
-            LOG.info(
-                'detected partial download %s due to file size',
-                targetfile)
-            try:
-                os.remove(targetfile)
-            except (OSError, IOError):
-                print '\n[E] Cant remove bad download %s' % targetfile
-                LOG.error(
-                    'cant remove bad download %s',
-                    targetfile,
-                    exc_info=True)
-
-
-def __check_filesize_and_crc(targetfile, expected_size, expected_crc32):
-    """check a file for expected size and crc32
-
-    :targetfile: file to check
-    :size: expected size
-    :crc: crc32 checksum
-    :returns: True if check is ok
-
-    """
-    LOG.info('doing byte count and crc32 check to file %s', targetfile)
-    if os.path.getsize(targetfile) != expected_size:
-        LOG.info(
-            'detected partial download %s due to filesize', targetfile)
         return False
-    else:
-        with open(targetfile, 'r') as binfile:
-            crc32 = binascii.crc32(binfile.read()) & 0xFFFFFFFF
-            crchex = "%08X" % crc32
-            crchex = crchex.lower()
-            if crchex.encode('utf-8') != expected_crc32.encode('utf-8'):
-                LOG.info('detected partial download due to crc32 got: ' +
-                         '%s expected: %s file: %s',
-                         crchex, expected_crc32, targetfile)
-                return False
 
     return True
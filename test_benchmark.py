@@ -0,0 +1,98 @@
+"""runs the benchmark phases and the fake api they use
+
+python -m unittest discover -p 'test_*.py'
+"""
+
+import unittest
+import benchmark
+import fake_putio
+import ranged_download
+
+
+def account_args(*extra):
+    """benchmark options for a small account: 3 dirs of 3 below the root"""
+    return benchmark.argument_parser().parse_args(
+        ['--depth', '2', '--fanout', '3', '--files', '5',
+         '--max-size', '20000'] + list(extra))
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    """The api calls of each phase"""
+
+    @classmethod
+    def setUpClass(cls):
+        """runs the benchmark once for every test"""
+        report = benchmark.run(account_args('--download', '10'))
+        cls.phases = dict((result['phase'], result) for result in report)
+
+    def test_cold_crawl_lists_every_directory(self):
+        """the root and its 12 directories are listed once"""
+        cold = self.phases['cold crawl']
+        self.assertEqual(cold['calls'], {'/v2/files/list': 13})
+        self.assertEqual(cold['statuses'], {200: 13})
+        self.assertEqual(cold['items'], self.phases['account']['items'])
+
+    def test_warm_crawl_revalidates_the_root(self):
+        """an unchanged account costs one listing answered 304"""
+        warm = self.phases['warm crawl']
+        self.assertEqual(warm['calls'], {'/v2/files/list': 1})
+        self.assertEqual(warm['statuses'], {304: 1})
+        self.assertEqual(warm['changed'], 0)
+
+    def test_incremental_crawl_lists_changed_directories(self):
+        """only the directories whose size grew are listed again"""
+        incremental = self.phases['incremental']
+        self.assertEqual(incremental['calls'], {'/v2/files/list': 11})
+        self.assertEqual(incremental['items'],
+                         self.phases['cold crawl']['items'] + 10)
+
+    def test_download_fetches_every_file(self):
+        """the downloaded files arrive and match the listed sizes"""
+        download = self.phases['download']
+        self.assertEqual(download['files'], 10)
+        self.assertEqual(download['failed'], 0)
+        self.assertEqual(download['bytes_served'], download['bytes'])
+
+
+class FakePutioTest(unittest.TestCase):
+
+    """Requests against the fake api"""
+
+    def setUp(self):
+        """serves a small account"""
+        self.account = fake_putio.SyntheticAccount(
+            depth=1, fanout=2, files=2, max_size=4096)
+        self.fake = fake_putio.FakePutio(self.account)
+        self.fake.start()
+
+    def tearDown(self):
+        """stops serving"""
+        self.fake.stop()
+
+    def test_empty_file_downloads(self):
+        """a range request of a 0 byte file is answered with no content"""
+        itemid = self.account.add_file(0, 'empty.srt', 0)
+        response = ranged_download.open_range(
+            self.fake.url.replace('/v2', '/cdn/%d' % itemid), 0)
+        try:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), '')
+        finally:
+            response.close()
+
+    def test_events_newest_first(self):
+        """added files show up in the feed with their directory"""
+        dirid = self.account.add_dir(0, 'new')
+        added = [self.account.add_file(dirid, 'a.mkv', 10),
+                 self.account.add_file(dirid, 'b.mkv', 10)]
+        events = self.account.recent_events()
+        self.assertEqual([event['file_id'] for event in events[:2]],
+                         added[::-1])
+        self.assertEqual(events[0]['parent_id'], dirid)
+        self.assertTrue(events[0]['id'] > events[1]['id'])
+        self.assertTrue(len(events) <= fake_putio.EVENTS_PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""applies account events from the fake api to a crawled tree
+
+python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import events_feed
+import fake_putio
+import putio_api
+import remote_tree
+import tree_cache
+import tree_crawler
+
+
+class EventFeedTest(unittest.TestCase):
+
+    """Deletes, renames and moves are picked up without a full crawl"""
+
+    def setUp(self):
+        """crawls a small account through the feed"""
+        self.account = fake_putio.SyntheticAccount(
+            depth=2, fanout=3, files=3, max_size=20000)
+        self.fake = fake_putio.FakePutio(self.account)
+        putio_api.CLIENT = putio_api.ApiClient(self.fake.start())
+        self.workdir = tempfile.mkdtemp()
+        self.cache = tree_cache.TreeCache(
+            os.path.join(self.workdir, 'tree.sqlite'))
+        self.cache.open()
+        self.conf = dict(oauthtoken='fake', crawl_concurrency=4,
+                         full_crawl_seconds=3600)
+        self.feed = events_feed.EventFeed(self.conf, self.cache)
+        self.crawler = tree_crawler.TreeCrawler(self.conf)
+        # the feed needs an event to start its cursor from
+        self.account.touch(1)
+        self.tree = self.feed.sync(self.crawler, {})
+
+    def tearDown(self):
+        """stops serving"""
+        putio_api.CLIENT.pool.close()
+        self.fake.stop()
+        self.cache.close()
+        shutil.rmtree(self.workdir, True)
+
+    def account_paths(self):
+        """itemid -> (abspath, size) of every item on the fake"""
+        paths = {}
+        pending = [(0, '/')]
+        while pending:
+            parent, root = pending.pop()
+            for itemid in self.account.children[parent]:
+                name, _, size, _ = self.account.items[itemid]
+                paths[itemid] = (root + '/' + name, size)
+                if itemid in self.account.children:
+                    pending.append((itemid, root + '/' + name))
+        return paths
+
+    def test_changes_are_applied_incrementally(self):
+        """the touched directories are listed, the tree matches put.io"""
+        dirs = sorted(itemid for itemid, item in self.account.items.items()
+                      if item[1] == fake_putio.PUTIO_DIR_FTP)
+        files = sorted(itemid for itemid, item in self.account.items.items()
+                       if item[1] != fake_putio.PUTIO_DIR_FTP)
+        self.account.move(files[0], dirs[-1], 'moved.mkv')
+        self.account.move(files[1], self.account.items[files[1]][3],
+                          'renamed.mkv')
+        self.account.remove(files[2])
+        self.account.move(dirs[1], dirs[-2])
+
+        before = self.fake.stats()['calls']
+        self.tree = self.feed.sync(self.crawler, self.tree)
+        calls = self.fake.stats()['calls']
+        self.assertEqual(calls['/v2/files/list'] -
+                         before['/v2/files/list'], 9)
+        self.assertEqual(calls.get('/v2/files/{id}', 0),
+                         before.get('/v2/files/{id}', 0))
+        self.assertEqual(
+            dict((remoteitem.itemid, (abspath, remoteitem.size))
+                 for abspath, remoteitem
+                 in remote_tree.iterpaths(self.tree)),
+            self.account_paths())
+
+    def test_refreshed_sizes_need_no_listing(self):
+        """a crawl after the refresh only lists the root"""
+        self.account.touch(3)
+        self.tree = self.feed.sync(self.crawler, self.tree)
+        before = self.fake.stats()['calls']['/v2/files/list']
+        tree_crawler.TreeCrawler(self.conf).crawl(self.tree)
+        self.assertEqual(
+            self.fake.stats()['calls']['/v2/files/list'] - before, 1)
+
+    def test_unchanged_directory_revalidates(self):
+        """a directory listed again without changes is answered 304"""
+        dirid = min(itemid for itemid, item in self.account.items.items()
+                    if item[1] == fake_putio.PUTIO_DIR_FTP)
+        before = dict(self.fake.stats()['statuses'])
+        self.tree = self.crawler.refresh(self.tree, [dirid])
+        statuses = self.fake.stats()['statuses']
+        self.assertEqual(statuses[304] - before.get(304, 0), 1)
+        self.assertEqual(statuses[200], before[200])
+        self.assertEqual(
+            set(remoteitem.itemid
+                for _, remoteitem in remote_tree.iterpaths(self.tree)),
+            set(self.account_paths()))
+
+
+if __name__ == '__main__':
+    unittest.main()
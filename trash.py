@@ -0,0 +1,229 @@
+"""deletes files from the mirror in the background, after a while
+
+A file or directory that is gone from put.io is renamed into a batch
+directory of the trash, which takes the same time however much it
+holds. A worker thread removes a batch file by file once it is older
+than conf['trash_retention'] seconds, at most conf['trash_purge_rate']
+files per second, so a large delete neither blocks the sync nor floods
+the disk. Until then a file that shows up on put.io again at the same
+path, with the same size and crc32, is renamed back instead of being
+downloaded.
+
+The trash is TRASH_NAME in the mirror root so renames never cross
+filesystems:
+    .putiosync-trash/<epoch of the batch>/<path in the mirror>
+"""
+
+import os
+import threading
+import time
+from sync_logging import LOG
+import checksum
+import disk_space
+import metrics
+
+TRASH_NAME = '.putiosync-trash'
+# how often the worker looks for expired batches
+PURGE_CHECK_SECONDS = 60
+
+__SHARED = []
+__SHARED_LOCK = threading.Lock()
+
+
+class Trash(object):
+
+    """Stages deletions of the mirror and purges them later"""
+
+    def __init__(self, localdir, retention, rate):
+        """constructor
+
+        :localdir: the mirror root
+        :retention: seconds a deleted file can be reclaimed
+        :rate: files removed per second by the purge, 0 for no limit
+        """
+        self.localdir = localdir
+        self.trashdir = os.path.join(localdir, TRASH_NAME)
+        self.retention = retention
+        self.rate = rate
+        # batch names, oldest first
+        self.batches = []
+        self.__batch = None
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stop = threading.Event()
+        self.__emptying = False
+        self.__thread = None
+        # optional SpaceLedger told about the space the purge frees, the
+        # files in the trash still count as part of the mirror until then
+        self.ledger = None
+
+    def start(self):
+        """finds the batches of earlier runs and starts the purge"""
+        if not os.path.isdir(self.trashdir):
+            os.makedirs(self.trashdir)
+        with self.__lock:
+            self.batches = sorted(
+                (name for name in os.listdir(self.trashdir)
+                 if name.isdigit()), key=int)
+        LOG.info('trash %s holds %d batches', self.trashdir,
+                 len(self.batches))
+        self.__thread = threading.Thread(target=self.__work, name='trash')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """stops the purge, what is left is purged by the next run"""
+        self.__stop.set()
+        self.__wake.set()
+        if self.__thread:
+            self.__thread.join()
+
+    def begin(self):
+        """the deletions from now on go into a new batch"""
+        self.__batch = None
+
+    def condemn(self, abspath):
+        """moves a file or directory of the mirror into the trash
+
+        :returns: False if it couldnt be moved
+        """
+        relpath = os.path.relpath(abspath, self.localdir)
+        try:
+            batch = self.__current()
+            staged = os.path.join(self.trashdir, batch, relpath)
+            parent = os.path.dirname(staged)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            os.rename(abspath, staged)
+        except OSError:
+            LOG.error('cant move %s into the trash', abspath, exc_info=True)
+            return False
+        LOG.info('moved %s into the trash', abspath)
+        metrics.TRASHED.inc()
+        return True
+
+    def reclaim(self, remoteitem, target):
+        """takes a file back from the trash if it was deleted from target
+
+        :remoteitem: the RemoteItem of the file
+        :target: where it belongs in the mirror
+        :returns: True if it is back in place
+        """
+        relpath = os.path.relpath(target, self.localdir)
+        with self.__lock:
+            batches = list(reversed(self.batches))
+        for batch in batches:
+            staged = os.path.join(self.trashdir, batch, relpath)
+            if not os.path.isfile(staged) or \
+                    os.path.getsize(staged) != remoteitem.size:
+                continue
+            if remoteitem.crc32 and not checksum.matches(
+                    checksum.file_crc32(staged), remoteitem.crc32):
+                continue
+            try:
+                os.rename(staged, target)
+            except OSError:
+                # purged in the meantime
+                LOG.debug('cant reclaim %s', staged, exc_info=True)
+                continue
+            print '\n [!] Took %s back from the trash' % target
+            LOG.info('took %s back from the trash', target)
+            metrics.TRASH_RECLAIMED_BYTES.inc(remoteitem.size)
+            return True
+        return False
+
+    def empty(self):
+        """purges every batch now, whatever its age, to free space"""
+        with self.__lock:
+            if not self.batches:
+                return
+            self.__emptying = True
+        LOG.info('emptying the trash to free space')
+        self.__wake.set()
+
+    def __current(self):
+        """the batch of the running deletions, created on first use"""
+        with self.__lock:
+            if self.__batch is None:
+                stamp = int(time.time())
+                while str(stamp) in self.batches:
+                    stamp += 1
+                self.__batch = str(stamp)
+                self.batches.append(self.__batch)
+            return self.__batch
+
+    def __work(self):
+        """purge loop: removes the expired batches until stopped"""
+        while not self.__stop.is_set():
+            with self.__lock:
+                emptying, self.__emptying = self.__emptying, False
+                deadline = time.time() - self.retention
+                expired = [batch for batch in self.batches
+                           if emptying or int(batch) <= deadline]
+            for batch in expired:
+                if self.__stop.is_set():
+                    return
+                self.__purge(batch)
+            self.__wake.wait(PURGE_CHECK_SECONDS)
+            self.__wake.clear()
+
+    def __purge(self, batch):
+        """removes a batch from the disk within the rate"""
+        with self.__lock:
+            if batch == self.__batch:
+                # deletions still go there, the next batch takes over
+                self.__batch = None
+        path = os.path.join(self.trashdir, batch)
+        LOG.info('purging trash batch %s', path)
+        interval = 1.0 / self.rate if self.rate else 0
+        for parent, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                if self.__stop.is_set():
+                    return
+                try:
+                    info = os.lstat(os.path.join(parent, name))
+                    os.remove(os.path.join(parent, name))
+                except OSError:
+                    LOG.error('cant purge %s', os.path.join(parent, name),
+                              exc_info=True)
+                    continue
+                if self.ledger and info.st_nlink == 1:
+                    self.ledger.freed(info.st_size)
+                metrics.TRASH_PURGED_FILES.inc()
+                if interval:
+                    time.sleep(interval)
+            for name in dirs:
+                try:
+                    if os.path.islink(os.path.join(parent, name)):
+                        os.remove(os.path.join(parent, name))
+                    else:
+                        os.rmdir(os.path.join(parent, name))
+                except OSError:
+                    LOG.error('cant purge %s', os.path.join(parent, name),
+                              exc_info=True)
+        try:
+            os.rmdir(path)
+        except OSError:
+            LOG.error('cant purge %s', path, exc_info=True)
+            return
+        with self.__lock:
+            self.batches.remove(batch)
+
+
+def shared(conf):
+    """the Trash of the process, started on first use
+
+    :conf: configuration object
+    :returns: None if files are deleted right away
+    """
+    if conf.get('trash_retention') is None:
+        return None
+    with __SHARED_LOCK:
+        if not __SHARED:
+            trash = Trash(conf.get('localdir'), conf.get('trash_retention'),
+                          conf.get('trash_purge_rate'))
+            trash.ledger = disk_space.shared(conf)
+            trash.ledger.trashcan = trash
+            trash.start()
+            __SHARED.append(trash)
+        return __SHARED[0]
@@ -0,0 +1,135 @@
+"""persists the remote account tree between runs in a sqlite database"""
+
+import os
+import sqlite3
+from sync_logging import LOG
+from remote_tree import RemoteItem
+import remote_tree
+
+# bump when the table layout changes, older caches are discarded
+SCHEMA_VERSION = 2
+
+
+class TreeCache(object):
+
+    """On-disk copy of the RemoteItem tree, written incrementally"""
+
+    def __init__(self, path):
+        """constructor
+
+        :path: the sqlite file the tree is stored in
+        """
+        self.path = path
+        self.__db = None
+        # itemid -> stored row, used to write only what changed
+        self.__rows = {}
+        # key -> stored value of the meta table, likewise
+        self.__meta = {}
+
+    def open(self):
+        """opens the database, discarding it if the schema is outdated"""
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.__db = sqlite3.connect(self.path)
+        version = self.__db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            LOG.info('tree cache %s has schema %d, rebuilding',
+                     self.path, version)
+            self.__db.execute('DROP TABLE IF EXISTS items')
+            self.__db.execute('DROP TABLE IF EXISTS meta')
+            self.__db.execute(
+                'CREATE TABLE items ('
+                'id INTEGER PRIMARY KEY, parent INTEGER NOT NULL, '
+                'name TEXT NOT NULL, size INTEGER NOT NULL, '
+                'crc32 TEXT, isdir INTEGER NOT NULL)')
+            self.__db.execute(
+                'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.__db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            self.__db.commit()
+        self.__meta = dict(
+            self.__db.execute('SELECT key, value FROM meta').fetchall())
+
+    def close(self):
+        """closes the database"""
+        if self.__db:
+            self.__db.close()
+            self.__db = None
+
+    def load(self):
+        """reads the stored tree
+
+        :returns: a dict of dicts like the one built by the crawler
+        """
+        children = {}
+        names = {}
+        self.__rows = {}
+        for row in self.__db.execute(
+                'SELECT id, parent, name, size, crc32, isdir FROM items'):
+            itemid, parentid, name, size, crc32, isdir = row
+            # repeated names share one string, the row keeps it too
+            name = names.setdefault(name, name)
+            row = (itemid, parentid, name, size, crc32, isdir)
+            self.__rows[itemid] = row
+            remoteitem = RemoteItem(
+                name, size, itemid, {} if isdir else None, crc32, parentid)
+            children.setdefault(parentid, []).append(remoteitem)
+
+        def build(parentid):
+            """assembles the nested dicts below parentid"""
+            tree = {}
+            for remoteitem in children.get(parentid, ()):
+                if remoteitem.isdir():
+                    remoteitem.dirtree = build(remoteitem.itemid)
+                tree[remoteitem.name] = remoteitem
+            return tree
+
+        tree = build(0)
+        LOG.info('loaded %d items from tree cache %s',
+                 len(self.__rows), self.path)
+        return tree
+
+    def getmeta(self, key, default=None):
+        """reads a value stored along with the tree"""
+        return self.__meta.get(key, default)
+
+    def save(self, tree, meta=None):
+        """writes the changes between the stored tree and tree
+
+        :tree: the tree returned by the crawler
+        :meta: optional dict of values stored in the same transaction, only
+            the ones that differ from the stored values are written
+        :returns: how many items changed or were removed
+        """
+        meta = [(key, str(value)) for key, value in (meta or {}).iteritems()
+                if self.__meta.get(key) != str(value)]
+        rows = {}
+        for remoteitem in remote_tree.iteritems(tree):
+            rows[remoteitem.itemid] = (
+                remoteitem.itemid,
+                remoteitem.parentid,
+                remoteitem.name,
+                remoteitem.size,
+                remoteitem.crc32,
+                1 if remoteitem.isdir() else 0)
+
+        removed = [(itemid,) for itemid in self.__rows
+                   if itemid not in rows]
+        changed = [row for itemid, row in rows.iteritems()
+                   if self.__rows.get(itemid) != row]
+        if not removed and not changed and not meta:
+            return 0
+
+        with self.__db:
+            self.__db.executemany('DELETE FROM items WHERE id = ?', removed)
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                changed)
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', meta)
+        self.__rows = rows
+        self.__meta.update(meta)
+        LOG.debug('tree cache updated: %d changed, %d removed',
+                  len(changed), len(removed))
+        return len(changed) + len(removed)
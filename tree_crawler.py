@@ -0,0 +1,288 @@
+"""lists the put.io account tree with several requests in flight"""
+
+import threading
+import Queue
+from sync_logging import LOG
+from sync_config import EXCLUDE_LIST
+from remote_tree import RemoteItem
+from remote_tree import PUTIO_DIR_FTP
+import remote_tree
+import putio_api
+import exclude_rules
+import metrics
+
+# how often the waiting thread wakes up so it stays interruptible
+WAIT_POLL_SECONDS = 0.5
+
+
+class CrawlError(Exception):
+
+    """A directory listing failed so the crawled tree is incomplete"""
+
+
+class TreeCrawler(object):
+
+    """Builds the account tree listing up to conf['crawl_concurrency']
+    directories at the same time"""
+
+    def __init__(self, conf):
+        """constructor
+
+        :conf: configuration object
+        """
+        self.conf = conf
+        self.workers = max(1, int(conf.get('crawl_concurrency') or 1))
+        self.excludes = exclude_rules.ExcludeRules(EXCLUDE_LIST)
+        pool = putio_api.CLIENT.pool
+        pool.maxidle = max(pool.maxidle, self.workers)
+        # dirid -> etag of its listing as of the last complete crawl, a
+        # listing that still matches is answered 304 and kept
+        self.__etags = {}
+        # the etags of the listings of the running crawl
+        self.__listed = {}
+        self.__pending = None
+        self.__outstanding = 0
+        self.__errors = []
+        # set when the crawl ends early, the queued listings are dropped
+        self.__cancelled = False
+        # one copy of each name seen during a crawl, many repeat
+        # (Sample, Subs, Season 1...)
+        self.__names = {}
+        self.__done = threading.Condition()
+        # called with (dirid, abspath, listing) as each listing is mapped,
+        # on the crawl threads
+        self.listener = None
+
+    def crawl(self, tree):
+        """lists the account starting at its root
+
+        :tree: the tree of the previous crawl, directories whose size is
+            unchanged are taken from it instead of being listed again
+        :returns: a dict of dicts representing the account directory tree
+        """
+        data, etag = putio_api.getfiles_if_changed(
+            self.conf, 0, self.__etags.get(0) if tree else None)
+        if data is None:
+            raise CrawlError('cant list the account root')
+        metrics.CRAWL_DIRS_LISTED.inc()
+        if data is putio_api.NOT_MODIFIED:
+            # directory sizes add up to the root, nothing changed below it
+            LOG.info('account root not modified, keeping the tree')
+            return tree
+        putio_api.ensure_valid_oauth_token(data)
+
+        fresh = {}
+        self.__etags.pop(0, None)
+        self.__run(lambda: self.__map(data, 0, '/', tree or {}, fresh))
+        self.__listed[0] = etag
+        # the etags of removed directories are dropped
+        dirids = set(remoteitem.itemid
+                     for remoteitem in remote_tree.iteritems(fresh))
+        dirids.add(0)
+        self.__etags = dict(
+            (dirid, etag) for dirid, etag in self.__etags.iteritems()
+            if dirid in dirids)
+        self.__etags.update(self.__listed)
+        return fresh
+
+    def refresh(self, tree, dirids):
+        """lists the given directories again even if their size is unchanged
+
+        :tree: the current tree, it is updated in place
+        :dirids: ids of the directories to list, 0 for the root
+        :returns: the updated tree
+        """
+        dirids = set(dirids)
+        if 0 in dirids:
+            tree = self.crawl(tree)
+            dirids.discard(0)
+
+        # (the directory and the ones above it, its path, its new listing)
+        jobs = []
+        pending = [('/', [], tree)]
+        while pending:
+            root, above, subtree = pending.pop()
+            for name, remoteitem in subtree.iteritems():
+                if remoteitem is None or not remoteitem.isdir():
+                    continue
+                abspath = root + '/' + name
+                chain = above + [remoteitem]
+                if remoteitem.itemid in dirids:
+                    jobs.append((chain, abspath, {}))
+                    dirids.discard(remoteitem.itemid)
+                if remoteitem.dirtree:
+                    pending.append((abspath, chain, remoteitem.dirtree))
+        if dirids:
+            LOG.debug('not refreshing unknown directories: %s', dirids)
+
+        def queue_jobs():
+            """queues the listing of every directory to refresh"""
+            for chain, abspath, fresh in jobs:
+                self.__queue(
+                    chain[-1].itemid, abspath, chain[-1].dirtree, fresh)
+
+        self.__run(queue_jobs)
+        self.__etags.update(self.__listed)
+        refreshed = set(chain[-1].itemid for chain, _, _ in jobs)
+        for chain, _, fresh in jobs:
+            remoteitem = chain[-1]
+            growth = remote_tree.listing_size(fresh) - \
+                remote_tree.listing_size(remoteitem.dirtree)
+            remoteitem.dirtree = fresh
+            if any(above.itemid in refreshed for above in chain[:-1]):
+                # the listing of the refreshed parent has its size
+                continue
+            # else the next crawl would compare against the old sizes
+            for above in chain:
+                above.size += growth
+        return tree
+
+    def __run(self, seed):
+        """runs the workers until every queued directory is listed
+
+        :seed: callable that queues the first directories
+        """
+        self.__pending = Queue.Queue()
+        self.__outstanding = 0
+        self.__errors = []
+        self.__cancelled = False
+        self.__names = {}
+        self.__listed = {}
+        seed()
+
+        threads = []
+        for num in range(self.workers):
+            worker = threading.Thread(
+                target=self.__work, name='crawl-%d' % num)
+            worker.daemon = True
+            worker.start()
+            threads.append(worker)
+
+        try:
+            with self.__done:
+                while self.__outstanding and not self.__errors:
+                    self.__done.wait(WAIT_POLL_SECONDS)
+        finally:
+            # no worker outlives the crawl, they finish the listing in
+            # flight and skip the rest
+            self.__cancelled = True
+            for _ in threads:
+                self.__pending.put(None)
+            for worker in threads:
+                # with a timeout so the wait stays interruptible
+                while worker.is_alive():
+                    worker.join(WAIT_POLL_SECONDS)
+            self.__names = {}
+
+        if self.__errors:
+            raise CrawlError('cant list directories: %s' % ', '.join(
+                self.__errors))
+
+    def __queue(self, dirid, abspath, cached, fresh):
+        """queues a directory listing for the workers"""
+        with self.__done:
+            self.__outstanding += 1
+        self.__pending.put((dirid, abspath, cached, fresh))
+
+    def __work(self):
+        """worker loop: lists queued directories until a None arrives"""
+        while True:
+            job = self.__pending.get()
+            if job is None:
+                return
+            if self.__cancelled:
+                continue
+
+            parent_id, root, cached, fresh = job
+            try:
+                data = etag = None
+                if not self.__errors:
+                    data, etag = putio_api.getfiles_if_changed(
+                        self.conf, parent_id,
+                        self.__etags.get(parent_id) if cached else None)
+                if data is None or data is not putio_api.NOT_MODIFIED and \
+                        data.get('status', '').lower() == 'error':
+                    raise CrawlError(root)
+                LOG.debug('got data for file id: %d', parent_id)
+                metrics.CRAWL_DIRS_LISTED.inc()
+                if data is putio_api.NOT_MODIFIED:
+                    # the listing is the cached one, so are its subtrees
+                    fresh.update(cached)
+                    if self.listener:
+                        self.listener(parent_id, root, fresh)
+                else:
+                    self.__map(data, parent_id, root, cached, fresh)
+                self.__listed[parent_id] = etag
+            except Exception:
+                LOG.error('listing %s failed', root, exc_info=True)
+                self.__errors.append(root)
+            finally:
+                with self.__done:
+                    self.__outstanding -= 1
+                    self.__done.notify()
+
+    def __map(self, data, parent_id, root, cached, fresh):
+        """fills fresh with the files of a listing, queues changed dirs
+
+        :data: the api response for the directory
+        :parent_id: the id of the directory
+        :root: the path of the directory in the account
+        :cached: the previous tree of the directory
+        :fresh: the dict the directory content is written into
+        """
+        names = self.__names
+        # queued after the listener saw the listing, so a directory
+        # always reaches it before its subdirectories
+        subdirs = []
+        for remotefile in data.get('files'):
+            filename = names.setdefault(
+                remotefile.get('name'), remotefile.get('name'))
+            filetype = remotefile.get('file_type')
+            fileid = remotefile.get('id')
+            filesize = remotefile.get('size')
+            crc32 = remotefile.get('crc32')
+            abspath = root + '/' + filename
+
+            # excluded directories are never queued, so never listed
+            exclude = self.excludes.match(abspath)
+            if exclude is not None:
+                LOG.info('skipping because exclude rule match (%s ~ %s)',
+                         exclude, abspath)
+                continue
+
+            if filetype == PUTIO_DIR_FTP:
+                previous = cached.get(filename, None)
+                # a directory replaced by another of the same size is
+                # listed again
+                if previous and previous.itemid == fileid and \
+                        previous.size == filesize:
+                    metrics.CRAWL_DIRS_SKIPPED.inc()
+                    fresh[filename] = previous
+                    continue
+
+                subtree = {}
+                fresh[filename] = RemoteItem(
+                    filename, filesize, fileid, subtree, None, parent_id)
+                LOG.debug('mapped directory: %s', fresh[filename])
+                subdirs.append((fileid, abspath,
+                                previous.dirtree if previous else {},
+                                subtree))
+
+            else:
+                filedata = cached.get(filename, None)
+                # an unchanged file is shared with the previous tree, which
+                # stays as it was for whoever still compares against it
+                if not (filedata and filedata.itemid == fileid and
+                        not filedata.isdir() and
+                        filedata.size == filesize and
+                        filedata.crc32 == crc32 and
+                        filedata.parentid == parent_id):
+                    filedata = RemoteItem(
+                        filename, filesize, fileid, None, crc32, parent_id)
+                LOG.debug('mapped file: %s', filedata)
+                fresh[filedata.name] = filedata
+
+        if self.listener:
+            self.listener(parent_id, root, fresh)
+        for subdir in subdirs:
+            self.__queue(*subdir)
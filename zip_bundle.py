@@ -0,0 +1,369 @@
+"""fetches many small files of a directory as one zip archive
+
+Every download costs a download url from the api and a new connection to
+the cdn, which for a folder of subtitles or photos takes longer than the
+transfer. Small files queued for the same directory are grouped into a
+Bundle instead, put.io builds a zip of them and the archive is extracted
+while it streams in. Each member is written to its part file, checked
+against the size and crc32 put.io listed and only then renamed into
+place. Members that didn't arrive intact are downloaded one by one.
+"""
+
+import os
+import time
+import struct
+import socket
+import httplib
+import zlib
+from sync_logging import LOG
+import putio_api
+import checksum
+import bandwidth
+import ranged_download
+import disk_space
+import connection_policy
+
+# the state of a zip is fetched again after this, doubling up to
+# ZIP_POLL_SECONDS while put.io builds it
+ZIP_FIRST_POLL_SECONDS = 0.25
+ZIP_POLL_SECONDS = 4
+# a zip that isn't built by then is given up, its files are fetched alone
+ZIP_WAIT_SECONDS = 5 * 60
+READ_CHUNK_SIZE = 64 * 1024
+
+LOCAL_SIGNATURE = 0x04034b50
+DESCRIPTOR_SIGNATURE = 0x08074b50
+# signature, version, flags, method, time, date, crc, compressed size,
+# size, name length, extra length
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP64_EXTRA = 0x0001
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class Bundle(object):
+
+    """Small files of a directory fetched as one zip
+
+    looks like the RemoteItem of a file to the download queue
+    """
+
+    def __init__(self, members):
+        """constructor
+
+        :members: list of (remoteitem, targetfile) in the same directory
+        """
+        self.members = members
+        self.name = os.path.dirname(members[0][1])
+        self.size = sum(remoteitem.size for remoteitem, _ in members)
+        self.itemid = max(remoteitem.itemid for remoteitem, _ in members)
+        self.crc32 = None
+        self.dirtree = None
+        # members not extracted yet
+        self.missing = list(members)
+
+    def isdir(self):
+        """a bundle is never a directory"""
+        return False
+
+    def __str__(self):
+        """tostring"""
+        return "Bundle('%s', files=%d, size=%d)" % (
+            self.name, len(self.members), self.size)
+
+
+def plan(conf, files_to_dirs):
+    """takes the small files out of files_to_dirs and groups them
+
+    :conf: configuration object
+    :files_to_dirs: dict of remoteitem -> targetfile, the bundled files
+        are removed from it
+    :returns: list of Bundle
+    """
+    maxsize = conf.get('bundle_max_file_size')
+    if not maxsize:
+        return []
+
+    by_dir = {}
+    for remoteitem, target in files_to_dirs.iteritems():
+        if remoteitem.size <= maxsize:
+            by_dir.setdefault(os.path.dirname(target), []).append(
+                (remoteitem, target))
+
+    minfiles = max(2, conf.get('bundle_min_files') or 2)
+    maxfiles = max(minfiles, conf.get('bundle_max_files') or minfiles)
+    bundles = []
+    for members in by_dir.itervalues():
+        if len(members) < minfiles:
+            continue
+        members.sort(key=lambda member: member[0].itemid)
+        for start in range(0, len(members), maxfiles):
+            bundle = Bundle(members[start:start + maxfiles])
+            LOG.debug('files will be downloaded as %s', bundle)
+            bundles.append(bundle)
+            for remoteitem, _ in bundle.members:
+                del files_to_dirs[remoteitem]
+    return bundles
+
+
+def resolve(conf, bundle, stop=None):
+    """asks put.io to build the zip of the missing members
+
+    :stop: optional threading.Event that ends the wait
+    :returns: the url of the zip, None if put.io didnt build it
+    """
+    zipid = putio_api.create_zip(
+        conf, [remoteitem.itemid for remoteitem, _ in bundle.missing])
+    if zipid is None:
+        LOG.error('put.io didnt create a zip for %s', bundle)
+        return None
+
+    deadline = time.time() + ZIP_WAIT_SECONDS
+    wait = stop.wait if stop else time.sleep
+    interval = ZIP_FIRST_POLL_SECONDS
+    while time.time() < deadline:
+        state = putio_api.getzip(conf, zipid)
+        if state is None:
+            return None
+        if state.get('url'):
+            if state.get('missing_files'):
+                LOG.warn('zip %d of %s lacks %d files', zipid, bundle,
+                         len(state.get('missing_files')))
+            return state.get('url')
+        wait(interval)
+        interval = min(interval * 2, ZIP_POLL_SECONDS)
+        if stop and stop.is_set():
+            return None
+
+    LOG.error('zip %d of %s wasnt built in %d seconds', zipid, bundle,
+              ZIP_WAIT_SECONDS)
+    return None
+
+
+def fetch(conf, bundle, url, stop):
+    """downloads a zip and extracts the members of the bundle from it
+
+    :conf: configuration object
+    :bundle: the Bundle, its missing list is updated
+    :url: returned by resolve()
+    :stop: threading.Event, when set the transfer is aborted
+    :returns: True if every member was extracted
+    :raises ExpiredUrlError: the url has to be resolved again
+    """
+    # a zip streams over a single connection
+    policy = connection_policy.shared(conf)
+    grant = policy.acquire(url, 0, stop)
+    if grant is None:
+        return False
+
+    print '\nStarting download :%s' % url
+    LOG.info('starting zip download :%s of %s', url, bundle)
+    try:
+        response = ranged_download.open_range(url, 0)
+        try:
+            stream = _Stream(response, bandwidth.shared(conf))
+            __extract(stream, bundle, disk_space.shared(conf), stop)
+        finally:
+            response.close()
+    except ranged_download.ExpiredUrlError:
+        raise
+    except (httplib.HTTPException, socket.error, IOError, zlib.error):
+        LOG.error('zip download of %s failed', bundle, exc_info=True)
+    finally:
+        # the rate of a zip of small files says little about the host
+        policy.release(grant, 0, None)
+
+    if bundle.missing:
+        LOG.warn('%d files of %s werent extracted', len(bundle.missing),
+                 bundle)
+    return not bundle.missing
+
+
+class _Stream(object):
+
+    """Reads the response of a zip download, bytes can be pushed back"""
+
+    def __init__(self, response, limiter):
+        """constructor"""
+        self.response = response
+        self.limiter = limiter
+        self.pushed = ''
+
+    def read(self, size=READ_CHUNK_SIZE):
+        """up to size bytes, '' at the end of the response"""
+        if self.pushed:
+            chunk, self.pushed = self.pushed[:size], self.pushed[size:]
+            return chunk
+        chunk = self.response.read(size)
+        self.limiter.consume(len(chunk))
+        return chunk
+
+    def exact(self, size):
+        """exactly size bytes
+
+        :raises: IOError if the response ends before
+        """
+        parts = []
+        while size:
+            chunk = self.read(min(size, READ_CHUNK_SIZE))
+            if not chunk:
+                raise IOError('zip ended in the middle of an entry')
+            parts.append(chunk)
+            size -= len(chunk)
+        return ''.join(parts)
+
+    def unread(self, data):
+        """pushes data back in front of the unread bytes"""
+        self.pushed = data + self.pushed
+
+
+class _Member(object):
+
+    """Writes a member of the bundle into its part file"""
+
+    def __init__(self, remoteitem, targetfile, ledger, stop):
+        """constructor"""
+        self.remoteitem = remoteitem
+        self.targetfile = targetfile
+        self.partfile = targetfile + ranged_download.PART_SUFFIX
+        self.ledger = ledger
+        self.reservation = ledger.reserve(
+            remoteitem.size, targetfile, self.partfile, stop)
+        if self.reservation is None:
+            raise IOError('stopped while waiting for disk space')
+        self.out = open(self.partfile, 'wb')
+        self.crc = 0
+        self.written = 0
+
+    def write(self, data):
+        """appends a chunk of the content"""
+        self.out.write(data)
+        self.crc = checksum.update(self.crc, data)
+        self.written += len(data)
+
+    def close(self):
+        """checks the member and renames it into place
+
+        :returns: True if it matched put.io
+        """
+        self.out.close()
+        done = self.written == self.remoteitem.size and \
+            checksum.matches(self.crc, self.remoteitem.crc32)
+        try:
+            if done:
+                os.rename(self.partfile, self.targetfile)
+            else:
+                LOG.error('%s from the zip has %d bytes and crc32 %08x, '
+                          'expected %d bytes and %s', self.targetfile,
+                          self.written, self.crc, self.remoteitem.size,
+                          self.remoteitem.crc32)
+                os.remove(self.partfile)
+        finally:
+            self.ledger.release(self.reservation, done)
+        return done
+
+    def discard(self):
+        """removes the part file of an interrupted member"""
+        self.out.close()
+        self.ledger.release(self.reservation, False)
+        try:
+            os.remove(self.partfile)
+        except OSError:
+            LOG.error('cant remove %s', self.partfile, exc_info=True)
+
+
+def __zip64_sizes(extra, size, csize):
+    """the sizes from the zip64 field of an extra block, when needed"""
+    while len(extra) >= 4:
+        fieldid, length = struct.unpack('<HH', extra[:4])
+        data = extra[4:4 + length]
+        extra = extra[4 + length:]
+        if fieldid != ZIP64_EXTRA:
+            continue
+        values = list(struct.unpack('<%dQ' % (len(data) // 8),
+                                    data[:len(data) // 8 * 8]))
+        if size == 0xffffffff and values:
+            size = values.pop(0)
+        if csize == 0xffffffff and values:
+            csize = values.pop(0)
+        return size, csize, True
+    return size, csize, False
+
+
+def __extract(stream, bundle, ledger, stop):
+    """writes the members of the bundle found in the zip stream"""
+    wanted = dict((remoteitem.name, (remoteitem, target))
+                  for remoteitem, target in bundle.missing)
+    while not stop.is_set():
+        head = stream.read(4)
+        if len(head) < 4 or struct.unpack('<I', head)[0] != LOCAL_SIGNATURE:
+            # the central directory, nothing more to extract
+            return
+        (_, _, flags, method, _, _, _, csize, size, namelen,
+         extralen) = LOCAL_HEADER.unpack(
+             head + stream.exact(LOCAL_HEADER.size - 4))
+        name = stream.exact(namelen).decode(
+            'utf-8' if flags & FLAG_UTF8 else 'cp437')
+        size, csize, zip64 = __zip64_sizes(stream.exact(extralen), size,
+                                           csize)
+        found = wanted.pop(name.rsplit('/', 1)[-1], None)
+        descriptor = flags & FLAG_DESCRIPTOR
+        if descriptor and method == METHOD_STORED:
+            if found is None:
+                raise IOError('cant skip %s, its size is unknown' % name)
+            # the header has no sizes, put.io listed it
+            csize = found[0].size
+
+        member = _Member(found[0], found[1], ledger, stop) if found else None
+        copied = False
+        try:
+            __copy(stream, method, csize, descriptor, member, stop)
+            if descriptor:
+                __skip_descriptor(stream, zip64)
+            copied = True
+        finally:
+            if member and not copied:
+                member.discard()
+        if member and member.close():
+            bundle.missing.remove(found)
+
+
+def __copy(stream, method, csize, descriptor, member, stop):
+    """passes the content of an entry to member, or skips it if None"""
+    if method not in (METHOD_STORED, METHOD_DEFLATED):
+        raise IOError('unsupported zip compression %d' % method)
+
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS) \
+        if method == METHOD_DEFLATED else None
+    # a deflated entry followed by a descriptor ends with its stream
+    remaining = None if inflater and descriptor else csize
+    while remaining is None or remaining > 0:
+        if stop.is_set():
+            raise IOError('zip download interrupted')
+        chunk = stream.read(READ_CHUNK_SIZE if remaining is None
+                            else min(READ_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError('zip ended in the middle of an entry')
+        if remaining is not None:
+            remaining -= len(chunk)
+        if inflater:
+            chunk = inflater.decompress(chunk)
+        if member:
+            member.write(chunk)
+        if inflater and inflater.unused_data:
+            stream.unread(inflater.unused_data)
+            break
+
+    if inflater and member:
+        member.write(inflater.flush())
+
+
+def __skip_descriptor(stream, zip64):
+    """reads past the data descriptor following an entry"""
+    head = stream.exact(4)
+    if struct.unpack('<I', head)[0] != DESCRIPTOR_SIGNATURE:
+        # the signature is optional, these were the crc
+        stream.unread(head)
+    stream.exact(4 + (16 if zip64 else 8))